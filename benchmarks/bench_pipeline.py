@@ -0,0 +1,188 @@
+'''
+End-to-end benchmark of the monitoring pipeline against in-process fakes of
+Reddit and Discord, so it runs without network access or credentials.
+
+N guilds each monitor the same M users in the same K subreddits, so every comment
+from a monitored user is delivered to N channels. Stream, pipeline and dispatch
+settings are read from config.json, like the bot does.
+
+Run from the repository root:
+
+    python -m benchmarks.bench_pipeline --guilds 50 --users 200 --subreddits 20 --rate 200
+'''
+import argparse
+import asyncio
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+
+import main
+from benchmarks.fakes import FakeDiscordBot, FakeReddit
+from caches import EnrichmentCache
+from checkpoint import StreamCheckpoint
+from dispatcher import DiscordDispatcher
+from metrics import REGISTRY
+from pipeline import NotificationPipeline
+from replay import KINDS, StreamRecorder
+from routing import RoutingIndex
+from streams import ShardedSubredditStream
+from utils import read_config_file
+
+
+def build_guilds_conf(guilds: int, users: int, subreddits: int) -> dict:
+    '''
+    Returns:
+        dict: A guilds config where every guild monitors every user in every subreddit
+    '''
+    subs = {f'sub{k}': {'flairs_to_monitor': []} for k in range(subreddits)}
+    return {str(1000 + g): {'name': f'guild{g}', 'notification_channel': str(5000 + g),
+                            'subreddits_to_monitor': subs,
+                            'users_to_monitor': [f'user{m}' for m in range(users)]}
+            for g in range(guilds)}
+
+
+async def run_benchmark(args: argparse.Namespace) -> dict:
+    bot_config = read_config_file(args.config)
+    guilds_conf = build_guilds_conf(args.guilds, args.users, args.subreddits)
+    tracemalloc.start()
+    started_mem = tracemalloc.get_traced_memory()[0]
+
+    routing_index = RoutingIndex.from_guilds_conf(guilds_conf)
+    reddit = FakeReddit(sorted(routing_index.subreddits()), sorted(routing_index.users()),
+                        rate=args.rate, monitored_share=args.monitored_share, author_skew=args.author_skew,
+                        thread_reuse=args.thread_reuse, reply_share=args.reply_share,
+                        api_latency=args.api_latency, seed=args.seed)
+    bot = FakeDiscordBot(list(routing_index.channels.values()), latency=args.send_latency,
+                         rate_limit_prob=args.rate_limit_prob, retry_after=args.retry_after, seed=args.seed)
+
+    stream_settings = bot_config['stream_settings']
+    cadence_settings = dict(bot_config['poll_cadence_settings'])
+    if args.min_poll_interval is not None:
+        cadence_settings['min_interval'] = args.min_poll_interval
+    comments = ShardedSubredditStream(reddit, routing_index.subreddits(), cadence_settings=cadence_settings,
+                                      skip_existing=False, max_chars=stream_settings['max_shard_chars'],
+                                      max_rate=stream_settings['max_shard_rate'],
+                                      queue_size=stream_settings['queue_size'], idle_timeout=1,
+                                      kind='comments')
+    cache_settings = bot_config['cache_settings']
+    enrichment_cache = EnrichmentCache(max_items=cache_settings['max_items'], ttl=cache_settings['ttl'])
+    dispatch_settings = bot_config['dispatch_settings']
+    dispatcher = DiscordDispatcher(bot, global_rate=dispatch_settings['global_rate'],
+                                   global_per=dispatch_settings['global_per'],
+                                   channel_rate=dispatch_settings['channel_rate'],
+                                   channel_per=dispatch_settings['channel_per'],
+                                   max_retries=dispatch_settings['max_retries'],
+                                   channel_queue_size=dispatch_settings['channel_queue_size'])
+    if args.digest_window:
+        for guild_id, guild_info in guilds_conf.items():
+            guild_info['delivery'] = {'mode': 'digest', 'window': args.digest_window,
+                                      'max_items': bot_config['digest_settings']['max_items'],
+                                      'format': args.digest_format}
+            dispatcher.on_guild_change(guild_id, guild_info)
+    pipeline_settings = bot_config['pipeline_settings']
+    checkpoint = StreamCheckpoint(os.path.join(tempfile.mkdtemp(), 'checkpoint.json'))
+    pipeline = NotificationPipeline(routing_index, enrichment_cache, dispatcher.send,
+                                    workers=pipeline_settings['workers'],
+                                    queue_sizes=pipeline_settings['queue_sizes'],
+                                    on_done=lambda kind, item: checkpoint.done(KINDS[kind], item),
+                                    max_retries=pipeline_settings['max_retries'],
+                                    retry_delay=pipeline_settings['retry_delay'])
+    recorder = StreamRecorder(args.record) if args.record else None
+
+    pipeline.start()
+    monitor = asyncio.ensure_future(main.monitor_new_comments(comments, pipeline, enrichment_cache,
+                                                              dispatcher, checkpoint, recorder))
+    began = time.monotonic()
+    await reddit.run(args.duration)
+    generated_in = time.monotonic() - began
+
+    # Let the streams catch up and everything queued be delivered
+    ingested = REGISTRY.metrics['reddisc_items_ingested_total']
+    async def drain():
+        # Items that fell off the listing pages never arrive, stop once polls find nothing new
+        settle = 2 * cadence_settings['min_interval'] + 1
+        last_count, last_change = -1, time.monotonic()
+        while ingested.total(kind='comments') < reddit.generated \
+                and time.monotonic() - last_change < settle:
+            if ingested.total(kind='comments') != last_count:
+                last_count, last_change = ingested.total(kind='comments'), time.monotonic()
+            await asyncio.sleep(0.1)
+        await pipeline.join()
+        await dispatcher.join()
+    try:
+        await asyncio.wait_for(drain(), args.drain_timeout)
+    except asyncio.TimeoutError:
+        print(f'Not drained after {args.drain_timeout}s, results include undelivered notifications')
+    elapsed = time.monotonic() - began
+    monitor.cancel()
+    pipeline.stop()
+    if recorder is not None:
+        recorder.close()
+
+    current_mem, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    lag = REGISTRY.metrics['reddisc_ingest_lag_seconds']
+    latency = dispatcher.latency_stats()
+    delivered = sum(channel.sent for channel in bot.channels.values())
+    return {
+        'guilds': args.guilds, 'users': args.users, 'subreddits': args.subreddits,
+        'generated': reddit.generated, 'generated_monitored': reddit.generated_monitored,
+        'ingested': int(ingested.total(kind='comments')),
+        'missed': max(0, reddit.generated - int(ingested.total(kind='comments'))),
+        'ingest_per_s': round(ingested.total(kind='comments') / elapsed, 1),
+        'generate_s': round(generated_in, 2), 'elapsed_s': round(elapsed, 2),
+        'notifications': latency['count'], 'messages_delivered': delivered,
+        'messages_per_s': round(delivered / elapsed, 1),
+        'ingest_lag_p50_s': round(lag.quantile(0.5, kind='comments') or 0, 3),
+        'ingest_lag_p99_s': round(lag.quantile(0.99, kind='comments') or 0, 3),
+        'notify_p50_s': latency.get('p50'), 'notify_p99_s': latency.get('p99'),
+        'rate_limited': dispatcher.rate_limited, 'api_calls': reddit.api_calls,
+        'cache': enrichment_cache.stats(),
+        'mem_current_mb': round((current_mem - started_mem) / 2**20, 2), 'mem_peak_mb': round(peak_mem / 2**20, 2),
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('--guilds', type=int, default=10, help='N, number of guilds')
+    parser.add_argument('--users', type=int, default=50, help='M, monitored users per guild')
+    parser.add_argument('--subreddits', type=int, default=10, help='K, monitored subreddits per guild')
+    parser.add_argument('--rate', type=float, default=100, help='Comments per second across all subreddits')
+    parser.add_argument('--duration', type=float, default=20, help='Seconds of comments to generate')
+    parser.add_argument('--monitored-share', type=float, default=0.02,
+                        help='Share of comments written by monitored users')
+    parser.add_argument('--author-skew', type=float, default=1.0,
+                        help='Zipf exponent of activity across monitored users, 0 for uniform')
+    parser.add_argument('--thread-reuse', type=float, default=0.9,
+                        help='Chance a comment is posted in an existing thread')
+    parser.add_argument('--reply-share', type=float, default=0.5,
+                        help='Chance a comment replies to another comment')
+    parser.add_argument('--api-latency', type=float, default=0.05, help='Seconds per fake Reddit API call')
+    parser.add_argument('--send-latency', type=float, default=0.05, help='Seconds per fake channel.send')
+    parser.add_argument('--rate-limit-prob', type=float, default=0.0, help='Chance a send gets a 429')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='retry_after of injected 429s')
+    parser.add_argument('--digest-window', type=float, default=0,
+                        help='Deliver to every guild as digests collected over this many seconds')
+    parser.add_argument('--digest-format', choices=['embeds', 'text'], default='embeds')
+    parser.add_argument('--min-poll-interval', type=float, default=None,
+                        help='Overrides poll_cadence_settings.min_interval')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='Seconds to wait for queued notifications after generation stops')
+    parser.add_argument('--record', metavar='FILE',
+                        help='Record the generated comments to FILE (.jsonl.gz) for benchmarks.replay_pipeline')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--json', action='store_true', help='Print the results as one JSON line')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    results = asyncio.run(run_benchmark(args))
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print(f'{key:>22}: {value}')
@@ -0,0 +1,229 @@
+import asyncio
+import bisect
+import itertools
+import random
+import time
+from collections import deque
+from typing import Dict, List, Optional
+
+import discord as dc
+
+
+class FakeAuthor():
+    def __init__(self, name: str):
+        self.name = name
+
+
+class FakeSubredditRef():
+    def __init__(self, display_name: str):
+        self.display_name = display_name
+
+
+class FakeSubmission():
+    '''
+    Stands in for an asyncpraw Submission, load() takes api_latency seconds
+    '''
+    def __init__(self, reddit: 'FakeReddit', submission_id: str, subreddit: str, author: str):
+        self._reddit = reddit
+        self.id = submission_id
+        self.fullname = f't3_{submission_id}'
+        self.subreddit = FakeSubredditRef(subreddit)
+        self.author = FakeAuthor(author)
+        self.title = f'Thread {submission_id}'
+        self.link_flair_text = None
+        self.selftext = ''
+        self.permalink = f'/r/{subreddit}/comments/{submission_id}/'
+        self.created_utc = time.time()
+
+    async def load(self) -> None:
+        await self._reddit.api_call('submission')
+
+
+class FakeComment():
+    '''
+    Stands in for an asyncpraw Comment, parent() and the submission's load() go
+    through the fake API
+    '''
+    def __init__(self, reddit: 'FakeReddit', comment_id: str, submission: FakeSubmission,
+                 author: str, parent: Optional['FakeComment']):
+        self._reddit = reddit
+        self._parent = parent
+        self.id = comment_id
+        self.fullname = f't1_{comment_id}'
+        self.subreddit = submission.subreddit
+        self.author = FakeAuthor(author)
+        self.body = f'Comment {comment_id} by {author}'
+        self.link_id = submission.fullname
+        self.parent_id = parent.fullname if parent is not None else submission.fullname
+        self.link_permalink = f'https://www.reddit.com{submission.permalink}'
+        self.created_utc = time.time()
+        self._submission = submission
+
+    @property
+    def submission(self) -> FakeSubmission:
+        # A fresh lazy object every time, like asyncpraw
+        return FakeSubmission(self._reddit, self._submission.id, self.subreddit.display_name,
+                              self._submission.author.name)
+
+    async def parent(self) -> 'FakeComment':
+        return self._parent
+
+    async def load(self) -> None:
+        await self._reddit.api_call('comment')
+
+
+class FakeMultireddit():
+    def __init__(self, reddit: 'FakeReddit', name: str):
+        self._reddit = reddit
+        self.subs = name.lower().split('+')
+
+    def _listing(self, kind: str, limit: int):
+        async def generate():
+            await self._reddit.api_call(f'{kind}_listing')
+            for item in self._reddit.newest(kind, self.subs, limit):
+                yield item
+        return generate()
+
+    def comments(self, limit: int = 100):
+        return self._listing('comments', limit)
+
+    def new(self, limit: int = 100):
+        return self._listing('submissions', limit)
+
+
+class FakeReddit():
+    '''
+    In-process stand-in for the parts of asyncpraw.Reddit the bot uses. Comments
+    are generated by run() at `rate` per second across subreddits.
+
+    Args:
+        subreddits (List[str]): Subreddits comments are posted in
+        users (List[str]): Monitored users
+        rate (float): Comments per second
+        monitored_share (float): Share of comments written by a monitored user
+        author_skew (float): Zipf exponent of how monitored users' comments are spread, 0 for uniform
+        thread_reuse (float): Chance a comment goes into an existing thread instead of a new one
+        reply_share (float): Chance a comment replies to an earlier comment rather than the post
+        api_latency (float): Seconds every API call takes
+        seed (int): Random seed
+    '''
+    def __init__(self, subreddits: List[str], users: List[str], rate: float = 100,
+                 monitored_share: float = 0.01, author_skew: float = 1.0, thread_reuse: float = 0.9,
+                 reply_share: float = 0.5, api_latency: float = 0.05, seed: int = 0):
+        self.subreddits = subreddits
+        self.users = users
+        self.rate = rate
+        self.monitored_share = monitored_share
+        self.thread_reuse = thread_reuse
+        self.reply_share = reply_share
+        self.api_latency = api_latency
+        self.random = random.Random(seed)
+        weights = [1 / (rank + 1) ** author_skew for rank in range(len(users))]
+        self._cum_weights = list(itertools.accumulate(weights))
+        self._ids = itertools.count(1)
+        self._items = {'comments': {sub: deque(maxlen=1000) for sub in subreddits},
+                       'submissions': {sub: deque(maxlen=1000) for sub in subreddits}}
+        self._threads = {sub: deque(maxlen=50) for sub in subreddits}
+        self.generated = 0
+        self.generated_monitored = 0
+        self.api_calls = {}
+
+    async def api_call(self, call: str) -> None:
+        self.api_calls[call] = self.api_calls.get(call, 0) + 1
+        if self.api_latency:
+            await asyncio.sleep(self.api_latency)
+
+    async def subreddit(self, name: str) -> FakeMultireddit:
+        return FakeMultireddit(self, name)
+
+    def newest(self, kind: str, subs: List[str], limit: int) -> List:
+        items = [item for sub in subs for item in itertools.islice(reversed(self._items[kind].get(sub, ())), limit)]
+        items.sort(key=lambda item: item.created_utc, reverse=True)
+        return items[:limit]
+
+    def _author(self) -> str:
+        if self.users and self.random.random() < self.monitored_share:
+            self.generated_monitored += 1
+            x = self.random.random() * self._cum_weights[-1]
+            return self.users[bisect.bisect_left(self._cum_weights, x)]
+        return f'lurker{self.random.randrange(100000)}'
+
+    def post_comment(self) -> FakeComment:
+        sub = self.random.choice(self.subreddits)
+        threads = self._threads[sub]
+        if threads and self.random.random() < self.thread_reuse:
+            submission, comments = self.random.choice(threads)
+        else:
+            submission = FakeSubmission(self, f's{next(self._ids)}', sub, self._author())
+            comments = deque(maxlen=20)
+            threads.append((submission, comments))
+            self._items['submissions'][sub].append(submission)
+        parent = self.random.choice(comments) if comments and self.random.random() < self.reply_share else None
+        comment = FakeComment(self, f'c{next(self._ids)}', submission, self._author(), parent)
+        comments.append(comment)
+        self._items['comments'][sub].append(comment)
+        self.generated += 1
+        return comment
+
+    async def run(self, duration: float) -> None:
+        '''
+        Posts comments at `rate` per second for duration seconds
+        '''
+        started = time.monotonic()
+        tick = 0.01
+        owed = 0.0
+        while time.monotonic() - started < duration:
+            owed += self.rate * tick
+            while owed >= 1:
+                self.post_comment()
+                owed -= 1
+            await asyncio.sleep(tick)
+
+
+class _FakeResponse():
+    def __init__(self, status: int):
+        self.status = status
+        self.reason = 'Too Many Requests' if status == 429 else 'Error'
+
+
+class FakeChannel():
+    '''
+    Stands in for a Discord text channel. send() takes `latency` seconds and fails
+    with a 429 (retry_after `retry_after`) with probability `rate_limit_prob`.
+    '''
+    def __init__(self, channel_id: int, latency: float = 0.05, rate_limit_prob: float = 0.0,
+                 retry_after: float = 0.5, rng: Optional[random.Random] = None):
+        self.id = channel_id
+        self.latency = latency
+        self.rate_limit_prob = rate_limit_prob
+        self.retry_after = retry_after
+        self.random = rng or random.Random(channel_id)
+        self.sent = 0
+        self.rate_limited = 0
+
+    async def send(self, content: Optional[str] = None, embeds: Optional[List[dc.Embed]] = None) -> None:
+        await asyncio.sleep(self.latency)
+        if self.rate_limit_prob and self.random.random() < self.rate_limit_prob:
+            self.rate_limited += 1
+            error = dc.HTTPException(_FakeResponse(429), 'You are being rate limited.')
+            error.retry_after = self.retry_after
+            raise error
+        self.sent += 1
+
+
+class FakeDiscordBot():
+    '''
+    Stands in for the discord.py Bot as far as the DiscordDispatcher is concerned
+    '''
+    def __init__(self, channel_ids: List[int], latency: float = 0.05, rate_limit_prob: float = 0.0,
+                 retry_after: float = 0.5, seed: int = 0):
+        rng = random.Random(seed)
+        self.channels: Dict[int, FakeChannel] = {
+            channel_id: FakeChannel(channel_id, latency, rate_limit_prob, retry_after, rng)
+            for channel_id in channel_ids}
+
+    def get_channel(self, channel_id: int) -> Optional[FakeChannel]:
+        return self.channels.get(channel_id)
+
+    async def fetch_channel(self, channel_id: int) -> FakeChannel:
+        raise dc.NotFound(_FakeResponse(404), 'Unknown Channel')
@@ -0,0 +1,189 @@
+'''
+Replays a recording of the Reddit streams (written with replay_settings.record,
+or by bench_pipeline --record) through the monitoring pipeline, with Reddit
+answered from the recording and Discord faked, so real traffic shapes can be
+profiled offline.
+
+By default the guilds config of the bot is used. With --guilds N, N guilds are
+made up instead, each monitoring every subreddit in the recording and its
+--users most active authors.
+
+Run from the repository root:
+
+    python -m benchmarks.replay_pipeline DynamicMemoryFiles/stream_recording.jsonl.gz --speed 10
+'''
+import argparse
+import asyncio
+import cProfile
+import gzip
+import json
+import os
+import tempfile
+import time
+import tracemalloc
+from collections import Counter
+
+import main
+from benchmarks.fakes import FakeDiscordBot
+from caches import EnrichmentCache
+from checkpoint import StreamCheckpoint
+from config_store import open_guilds_conf_store
+from dispatcher import DiscordDispatcher
+from metrics import REGISTRY
+from pipeline import NotificationPipeline
+from replay import KINDS, ReplaySource
+from routing import RoutingIndex
+from tracing import Tracer
+from utils import read_config_file
+
+
+def build_guilds_conf(recording: str, guilds: int, users: int) -> dict:
+    '''
+    Returns:
+        dict: A guilds config where every guild monitors every subreddit of the
+              recording and its `users` most active authors
+    '''
+    subreddits, authors = set(), Counter()
+    with gzip.open(recording, 'rt', encoding='utf-8') as fp:
+        for line in fp:
+            try:
+                data = json.loads(line)['data']
+            except (ValueError, KeyError):
+                continue
+            subreddits.add(str(data.get('subreddit', '')).lower())
+            if data.get('author') not in (None, '[deleted]'):
+                authors[str(data['author']).lower()] += 1
+    subs = {sub: {'flairs_to_monitor': []} for sub in subreddits if sub}
+    monitored = [author for author, _ in authors.most_common(users)]
+    return {str(1000 + g): {'name': f'guild{g}', 'notification_channel': str(5000 + g),
+                            'subreddits_to_monitor': subs, 'users_to_monitor': monitored}
+            for g in range(guilds)}
+
+
+async def run_replay(args: argparse.Namespace) -> dict:
+    bot_config = read_config_file(args.config)
+    if args.guilds:
+        guilds_conf = build_guilds_conf(args.recording, args.guilds, args.users)
+    else:
+        guilds_conf = open_guilds_conf_store(bot_config).guilds_conf
+    tracemalloc.start()
+    started_mem = tracemalloc.get_traced_memory()[0]
+
+    routing_index = RoutingIndex.from_guilds_conf(guilds_conf)
+    bot = FakeDiscordBot(list(routing_index.channels.values()), latency=args.send_latency,
+                         rate_limit_prob=args.rate_limit_prob, retry_after=args.retry_after, seed=args.seed)
+    replay = ReplaySource(args.recording, speed=args.speed,
+                          queue_size=bot_config['stream_settings']['queue_size'])
+
+    cache_settings = bot_config['cache_settings']
+    enrichment_cache = EnrichmentCache(max_items=cache_settings['max_items'], ttl=cache_settings['ttl'])
+    dispatch_settings = bot_config['dispatch_settings']
+    dispatcher = DiscordDispatcher(bot, global_rate=dispatch_settings['global_rate'],
+                                   global_per=dispatch_settings['global_per'],
+                                   channel_rate=dispatch_settings['channel_rate'],
+                                   channel_per=dispatch_settings['channel_per'],
+                                   max_retries=dispatch_settings['max_retries'],
+                                   channel_queue_size=dispatch_settings['channel_queue_size'])
+    for guild_id, guild_info in guilds_conf.items():
+        if isinstance(guild_info, dict):
+            dispatcher.on_guild_change(guild_id, guild_info)
+    trace_settings = bot_config['trace_settings']
+    tracer = Tracer(args.trace, slow_threshold=trace_settings['slow_threshold'],
+                    sample_rate=args.trace_sample) if args.trace else None
+    pipeline_settings = bot_config['pipeline_settings']
+    checkpoint = StreamCheckpoint(os.path.join(tempfile.mkdtemp(), 'checkpoint.json'))
+    pipeline = NotificationPipeline(routing_index, enrichment_cache, dispatcher.send,
+                                    workers=pipeline_settings['workers'],
+                                    queue_sizes=pipeline_settings['queue_sizes'],
+                                    max_selftext=bot_config['static_settings']['max_selftext_chars'],
+                                    tracer=tracer, on_done=lambda kind, item: checkpoint.done(KINDS[kind], item),
+                                    max_retries=pipeline_settings['max_retries'],
+                                    retry_delay=pipeline_settings['retry_delay'])
+
+    pipeline.start()
+    monitors = [
+        asyncio.ensure_future(main.monitor_new_comments(replay.stream('comments'), pipeline, enrichment_cache,
+                                                        dispatcher, checkpoint)),
+        asyncio.ensure_future(main.monitor_new_submissions(replay.stream('submissions'), pipeline,
+                                                           enrichment_cache, checkpoint)),
+    ]
+    began = time.monotonic()
+    await replay.run()
+    replayed_in = time.monotonic() - began
+
+    async def drain():
+        for stream in replay.streams.values():
+            while not stream.queue.empty():
+                await asyncio.sleep(0.05)
+        await pipeline.join()
+        await dispatcher.join()
+    try:
+        await asyncio.wait_for(drain(), args.drain_timeout)
+    except asyncio.TimeoutError:
+        print(f'Not drained after {args.drain_timeout}s, results include undelivered notifications')
+    elapsed = time.monotonic() - began
+    for monitor in monitors:
+        monitor.cancel()
+    pipeline.stop()
+    if tracer is not None:
+        tracer.flush()
+
+    current_mem, peak_mem = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    lag = REGISTRY.metrics['reddisc_ingest_lag_seconds']
+    latency = dispatcher.latency_stats()
+    delivered = sum(channel.sent for channel in bot.channels.values())
+    return {
+        'guilds': len(guilds_conf), 'speed': args.speed, **replay.stats(),
+        'replay_s': round(replayed_in, 2), 'elapsed_s': round(elapsed, 2),
+        'items_per_s': round(replay.replayed / elapsed, 1) if elapsed else 0,
+        'notifications': latency['count'], 'messages_delivered': delivered,
+        'messages_per_s': round(delivered / elapsed, 1) if elapsed else 0,
+        'ingest_lag_p50_s': round(lag.quantile(0.5, kind='comments') or 0, 3),
+        'ingest_lag_p99_s': round(lag.quantile(0.99, kind='comments') or 0, 3),
+        'notify_p50_s': latency.get('p50'), 'notify_p99_s': latency.get('p99'),
+        'rate_limited': dispatcher.rate_limited, 'rules': routing_index.rules.stats(),
+        'cache': enrichment_cache.stats(),
+        'mem_current_mb': round((current_mem - started_mem) / 2**20, 2), 'mem_peak_mb': round(peak_mem / 2**20, 2),
+        'traces': tracer.stats() if tracer is not None else None,
+    }
+
+
+def parse_args() -> argparse.Namespace:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('recording', help='A .jsonl.gz stream recording')
+    parser.add_argument('--speed', type=float, default=1,
+                        help='Playback speed, 1 for real time, 0 for as fast as possible')
+    parser.add_argument('--guilds', type=int, default=0,
+                        help='Make up this many guilds instead of using the bot\'s guilds config')
+    parser.add_argument('--users', type=int, default=50,
+                        help='With --guilds, how many of the most active authors each guild monitors')
+    parser.add_argument('--send-latency', type=float, default=0.05, help='Seconds per fake channel.send')
+    parser.add_argument('--rate-limit-prob', type=float, default=0.0, help='Chance a send gets a 429')
+    parser.add_argument('--retry-after', type=float, default=0.5, help='retry_after of injected 429s')
+    parser.add_argument('--drain-timeout', type=float, default=60,
+                        help='Seconds to wait for queued notifications after the recording ends')
+    parser.add_argument('--profile', metavar='FILE', help='Write a cProfile of the replay to FILE')
+    parser.add_argument('--trace', metavar='FILE', help='Write the traces of slow and sampled notifications to FILE')
+    parser.add_argument('--trace-sample', type=float, default=1,
+                        help='With --trace, the share of the notifications that aren\'t slow to write')
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--config', default='config.json')
+    parser.add_argument('--json', action='store_true', help='Print the results as one JSON line')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_args()
+    profiler = cProfile.Profile() if args.profile else None
+    if profiler is not None:
+        profiler.enable()
+    results = asyncio.run(run_replay(args))
+    if profiler is not None:
+        profiler.disable()
+        profiler.dump_stats(args.profile)
+    if args.json:
+        print(json.dumps(results))
+    else:
+        for key, value in results.items():
+            print(f'{key:>22}: {value}')
@@ -0,0 +1,192 @@
+import asyncio
+import heapq
+import itertools
+import time
+from contextlib import asynccontextmanager
+from typing import AsyncIterator, Optional
+
+import asyncpraw as pr
+
+from metrics import REDDIT_API_LATENCY, REGISTRY
+from utils import log_and_print
+
+
+# Request priorities, lower goes first
+STREAM = 0      # subreddit listings, author polls and backfill
+ENRICHMENT = 1  # submission and parent comment loads for notifications
+ADMIN = 2       # existence checks and flair templates for the commands
+PRIORITY_NAMES = {STREAM: 'stream', ENRICHMENT: 'enrichment', ADMIN: 'admin'}
+
+BUDGET_WAIT = REGISTRY.histogram('reddisc_reddit_budget_wait_seconds',
+                                 'Time Reddit requests waited for the API budget', ['priority'])
+
+
+class RedditBudget():
+    '''
+    Single gate in front of every Reddit API request, deciding which waiting
+    request goes next.
+
+    At most max_concurrent requests are in flight at once, and when more are
+    waiting the highest priority one gets the next slot, so a burst of enrichment
+    loads can't hold up the subreddit listings. On top of that, the quota Reddit
+    reports in the x-ratelimit headers is shared out: enrichment only goes ahead
+    while more than enrichment_reserve of the window's requests are left, admin
+    lookups while more than admin_reserve are. Below that they wait for the
+    window to reset and the remaining requests go to the streams.
+
+    The quota is read from the asyncprawcore sessions of the client given to
+    attach(). Until the first response (or without a client) only the
+    concurrency limit applies.
+    '''
+    def __init__(self, max_concurrent: int = 4, enrichment_reserve: float = 0.1, admin_reserve: float = 0.25):
+        self.max_concurrent = max_concurrent
+        self.reserves = {STREAM: 0.0, ENRICHMENT: enrichment_reserve, ADMIN: admin_reserve}
+        self.remaining = None   # requests left in the current window, None until Reddit says
+        self.used = None        # requests used in the current window
+        self.reset_at = None    # time.monotonic() at which the window resets
+        self.in_flight = 0
+        self.granted = {priority: 0 for priority in PRIORITY_NAMES}
+        self._waiting = []      # heap of (priority, sequence, future)
+        self._sequence = itertools.count()
+        self._timer = None
+
+    def configure(self, max_concurrent: int, enrichment_reserve: float, admin_reserve: float) -> None:
+        self.max_concurrent = max_concurrent
+        self.reserves.update({ENRICHMENT: enrichment_reserve, ADMIN: admin_reserve})
+        self._dispatch()
+
+    def attach(self, reddit_instance: pr.Reddit) -> None:
+        '''
+        Follows the x-ratelimit headers of every response reddit_instance gets
+        '''
+        sessions = {getattr(reddit_instance, name, None) for name in ('_authorized_core', '_read_only_core')}
+        for session in sessions - {None}:
+            limiter = getattr(session, '_rate_limiter', None)
+            if limiter is not None:
+                limiter.update = self._header_listener(limiter.update)
+
+    def _header_listener(self, update):
+        def listener(*, response_headers) -> None:
+            update(response_headers=response_headers)
+            self.on_headers(response_headers)
+        return listener
+
+    def on_headers(self, headers) -> None:
+        if 'x-ratelimit-remaining' not in headers:
+            return
+        self.remaining = int(float(headers['x-ratelimit-remaining']))
+        self.used = int(float(headers['x-ratelimit-used']))
+        self.reset_at = time.monotonic() + float(headers['x-ratelimit-reset'])
+        self._dispatch()
+
+    def _window_left(self) -> Optional[float]:
+        # Fraction of the window's requests still available, None when unknown or reset since
+        if self.remaining is None or self.reset_at is None or time.monotonic() >= self.reset_at:
+            return None
+        window = self.remaining + (self.used or 0)
+        return self.remaining / window if window else 0.0
+
+    def _allowed(self, priority: int) -> bool:
+        left = self._window_left()
+        return left is None or priority == STREAM or left > self.reserves[priority]
+
+    def _dispatch(self) -> None:
+        # Hands free slots to the waiting requests, highest priority first
+        while self._waiting and self._waiting[0][2].done():
+            heapq.heappop(self._waiting) # cancelled while waiting
+        while self._waiting and self.in_flight < self.max_concurrent:
+            priority, _, future = self._waiting[0]
+            if not self._allowed(priority):
+                # Lower priorities have larger reserves, so they have to wait too
+                self._wake_at_reset()
+                return
+            heapq.heappop(self._waiting)
+            if future.done():
+                continue
+            self.in_flight += 1
+            self.granted[priority] += 1
+            future.set_result(None)
+
+    def _wake_at_reset(self) -> None:
+        if self._timer is not None or self.reset_at is None:
+            return
+        def wake():
+            self._timer = None
+            self._dispatch()
+        delay = max(0.1, self.reset_at - time.monotonic())
+        self._timer = asyncio.get_event_loop().call_later(delay, wake)
+
+    async def acquire(self, priority: int) -> None:
+        future = asyncio.get_event_loop().create_future()
+        heapq.heappush(self._waiting, (priority, next(self._sequence), future))
+        self._dispatch()
+        try:
+            await future
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self.release() # granted just as it was cancelled
+            raise
+
+    def release(self) -> None:
+        self.in_flight -= 1
+        self._dispatch()
+
+    @asynccontextmanager
+    async def request(self, priority: int, call: str) -> AsyncIterator[None]:
+        '''
+        Holds a slot for one Reddit request (or a listing being paged through)
+        and times it in reddisc_reddit_api_seconds
+
+        Args:
+            priority (int): STREAM, ENRICHMENT or ADMIN
+            call (str): The call label of the latency histogram
+        '''
+        started = time.monotonic()
+        await self.acquire(priority)
+        waited = time.monotonic() - started
+        BUDGET_WAIT.observe(waited, priority=PRIORITY_NAMES[priority])
+        if waited > 10:
+            log_and_print(f'{call} waited {waited:.1f}s for the Reddit API budget', level='warning',
+                          terminal_print=False)
+        try:
+            with REDDIT_API_LATENCY.time(call=call):
+                yield
+        finally:
+            self.release()
+
+    def waiting(self) -> dict:
+        '''
+        Returns:
+            dict: Priority name -> number of requests waiting
+        '''
+        counts = {name: 0 for name in PRIORITY_NAMES.values()}
+        for priority, _, future in self._waiting:
+            if not future.done():
+                counts[PRIORITY_NAMES[priority]] += 1
+        return counts
+
+    def headroom(self) -> dict:
+        '''
+        Returns:
+            dict: Requests remaining and used in the window, seconds until it resets,
+                  the request rate that would use up exactly what is left by then, and
+                  what is in flight and waiting
+        '''
+        reset_in = max(0.0, self.reset_at - time.monotonic()) if self.reset_at is not None else None
+        sustainable = None
+        if self.remaining is not None and reset_in:
+            sustainable = round(self.remaining / reset_in, 2)
+        return {'remaining': self.remaining, 'used': self.used,
+                'reset_in': round(reset_in, 1) if reset_in is not None else None,
+                'sustainable_rate': sustainable, 'in_flight': self.in_flight, 'waiting': self.waiting()}
+
+
+# Shared by every module that talks to Reddit, main configures and attaches it
+REDDIT_BUDGET = RedditBudget()
+
+REGISTRY.gauge('reddisc_reddit_ratelimit_remaining', 'Reddit API requests left in the rate limit window',
+               func=lambda: {(): REDDIT_BUDGET.remaining} if REDDIT_BUDGET.remaining is not None else {})
+REGISTRY.gauge('reddisc_reddit_ratelimit_reset_seconds', 'Seconds until the Reddit rate limit window resets',
+               func=lambda: {(): REDDIT_BUDGET.headroom()['reset_in']} if REDDIT_BUDGET.reset_at is not None else {})
+REGISTRY.gauge('reddisc_reddit_budget_waiting', 'Reddit requests waiting for the API budget', ['priority'],
+               lambda: {(name,): count for name, count in REDDIT_BUDGET.waiting().items()})
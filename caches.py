@@ -0,0 +1,240 @@
+import asyncio
+import re
+import time
+from collections import OrderedDict, namedtuple
+from typing import Any, Awaitable, Callable, Dict, Hashable, Iterable, List, Optional
+
+import asyncpraw as pr
+
+from budget import ADMIN, ENRICHMENT, REDDIT_BUDGET
+from utils import log_and_print
+
+
+SubmissionInfo = namedtuple('SubmissionInfo', ['title', 'flair'])
+ParentInfo = namedtuple('ParentInfo', ['author', 'body'])
+# Names Reddit could have, anything else doesn't exist and isn't sent to the API
+SUBREDDIT_NAME = re.compile(r'[a-z0-9][a-z0-9_]{1,20}')
+USERNAME = re.compile(r'[a-z0-9_-]{3,20}')
+
+
+class TTLCache():
+    '''
+    Bounded LRU cache whose entries expire ttl seconds after they were stored.
+
+    Keeps hit/miss counters, and get_or_load() makes concurrent misses on the same
+    key share a single load.
+    '''
+    def __init__(self, max_items: int = 5000, ttl: float = 900):
+        self.max_items = max_items
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._items = OrderedDict() # key -> (expiry, value)
+        self._loading = {}
+
+    def __len__(self) -> int:
+        return len(self._items)
+
+    def get(self, key: Hashable) -> Optional[Any]:
+        '''
+        Returns:
+            Optional[Any]: The cached value, None on a miss or when it expired
+        '''
+        entry = self._items.get(key)
+        if entry is not None:
+            if entry[0] > time.monotonic():
+                self._items.move_to_end(key)
+                self.hits += 1
+                return entry[1]
+            del self._items[key]
+        self.misses += 1
+        return None
+
+    def set(self, key: Hashable, value: Any) -> None:
+        self._items[key] = (time.monotonic() + self.ttl, value)
+        self._items.move_to_end(key)
+        while len(self._items) > self.max_items:
+            self._items.popitem(last=False)
+
+    async def get_or_load(self, key: Hashable, loader: Callable[[], Awaitable[Any]]) -> Any:
+        '''
+        Returns the cached value for key, calling loader() to fetch and cache it on a miss
+        '''
+        value = self.get(key)
+        if value is not None:
+            return value
+        pending = self._loading.get(key)
+        if pending is not None:
+            # Someone else is already fetching it, that costs no extra API call
+            self.misses -= 1
+            self.hits += 1
+            return await asyncio.shield(pending)
+
+        pending = asyncio.ensure_future(loader())
+        self._loading[key] = pending
+        try:
+            value = await asyncio.shield(pending)
+        finally:
+            self._loading.pop(key, None)
+        self.set(key, value)
+        return value
+
+    def hit_rate(self) -> float:
+        lookups = self.hits + self.misses
+        return self.hits / lookups if lookups else 0.0
+
+    def stats(self) -> dict:
+        return {'size': len(self._items), 'hits': self.hits, 'misses': self.misses,
+                'hit_rate': round(self.hit_rate(), 3)}
+
+
+class EnrichmentCache():
+    '''
+    Caches what a notification needs to know about a comment's submission (title,
+    flair) and parent comment (author, body), keyed by fullname.
+
+    Replies to the post itself never need a parent fetch, and comments and
+    submissions seen on the streams are remembered with remember_comment() /
+    remember_submission() so replies to them can be enriched without an API call.
+    '''
+    def __init__(self, max_items: int = 5000, ttl: float = 900):
+        self.submissions = TTLCache(max_items, ttl)
+        self.parents = TTLCache(max_items, ttl)
+
+    @staticmethod
+    def _author_name(item) -> str:
+        return item.author.name if item.author is not None else '[deleted]'
+
+    def remember_comment(self, comment: pr.models.Comment) -> None:
+        self.parents.set(comment.fullname, ParentInfo(self._author_name(comment), comment.body))
+
+    def remember_submission(self, submission: pr.models.Submission) -> None:
+        self.submissions.set(submission.fullname, SubmissionInfo(submission.title, submission.link_flair_text))
+
+    async def submission(self, comment: pr.models.Comment) -> SubmissionInfo:
+        '''
+        Returns:
+            SubmissionInfo: Title and flair of the submission comment was posted on
+        '''
+        async def load():
+            submission = comment.submission
+            async with REDDIT_BUDGET.request(ENRICHMENT, call='submission'):
+                await submission.load()
+            return SubmissionInfo(submission.title, submission.link_flair_text)
+        return await self.submissions.get_or_load(comment.link_id, load)
+
+    async def parent(self, comment: pr.models.Comment) -> Optional[ParentInfo]:
+        '''
+        Returns:
+            Optional[ParentInfo]: Author and body of the comment being replied to,
+                                  None if comment is a reply to the post itself
+        '''
+        if comment.parent_id.startswith('t3_'):
+            return None
+        async def load():
+            async with REDDIT_BUDGET.request(ENRICHMENT, call='parent_comment'):
+                parent = await comment.parent()
+                await parent.load()
+            return ParentInfo(self._author_name(parent), parent.body)
+        return await self.parents.get_or_load(comment.parent_id, load)
+
+    def stats(self) -> dict:
+        return {'submissions': self.submissions.stats(), 'parents': self.parents.stats()}
+
+
+class RedditLookups():
+    '''
+    Answers the checks behind add_subreddit, add_reddit_user and add_flair on the
+    shared asyncpraw client, so they never block the event loop, and keeps the
+    answers for ttl seconds so repeated lookups don't hit the API at all.
+
+    Negative answers are cached too, failed requests are not.
+
+    The bulk commands check many names at once: subreddits 100 to an /api/info
+    request, users concurrently, max_concurrent at a time.
+    '''
+    def __init__(self, reddit_instance: pr.Reddit, max_items: int = 1000, ttl: float = 3600,
+                 max_concurrent: int = 8):
+        self.reddit = reddit_instance
+        self.max_concurrent = max_concurrent
+        self.subreddits = TTLCache(max_items, ttl)  # subreddit -> exists
+        self.users = TTLCache(max_items, ttl)       # user -> exists
+        self.flairs = TTLCache(max_items, ttl)      # subreddit -> link flair texts
+
+    async def sub_exists(self, sub: str) -> Optional[bool]:
+        '''
+        Returns:
+            Optional[bool]: Whether sub exists, None if it couldn't be looked up
+        '''
+        return (await self.subs_exist([sub]))[sub.lower()]
+
+    async def user_exists(self, username: str) -> Optional[bool]:
+        '''
+        Returns:
+            Optional[bool]: Whether the account exists, None if it couldn't be looked up
+        '''
+        username = username.lower()
+        if not USERNAME.fullmatch(username):
+            return False
+        async def load():
+            async with REDDIT_BUDGET.request(ADMIN, call='username_available'):
+                return not await self.reddit.username_available(username)
+        try:
+            return await self.users.get_or_load(username, load)
+        except Exception as e:
+            log_and_print(f'Looking up u/{username} failed: {e!r}', level='warning', terminal_print=False)
+            return None
+
+    async def subs_exist(self, subs: Iterable[str]) -> Dict[str, Optional[bool]]:
+        '''
+        Returns:
+            Dict[str, Optional[bool]]: subreddit (lower case) -> whether it exists,
+                                       None if it couldn't be looked up
+        '''
+        result = {sub.lower(): None for sub in subs}
+        for sub in result:
+            result[sub] = self.subreddits.get(sub) if SUBREDDIT_NAME.fullmatch(sub) else False
+        missing = sorted(sub for sub, exists in result.items() if exists is None)
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        async def load_batch(batch: List[str]) -> None:
+            try:
+                async with semaphore:
+                    async with REDDIT_BUDGET.request(ADMIN, call='info'):
+                        found = {subreddit.display_name.lower() 
+                                 async for subreddit in self.reddit.info(subreddits=batch)}
+            except Exception as e:
+                log_and_print(f'Looking up {len(batch)} subreddits failed: {e!r}', level='warning')
+                return
+            for sub in batch:
+                result[sub] = sub in found
+                self.subreddits.set(sub, result[sub])
+        await asyncio.gather(*(load_batch(missing[i:i + 100]) for i in range(0, len(missing), 100)))
+        return result
+
+    async def users_exist(self, usernames: Iterable[str]) -> Dict[str, Optional[bool]]:
+        '''
+        Returns:
+            Dict[str, Optional[bool]]: username (lower case) -> whether the account exists,
+                                       None if it couldn't be looked up
+        '''
+        usernames = sorted({username.lower() for username in usernames})
+        semaphore = asyncio.Semaphore(self.max_concurrent)
+        async def check(username: str) -> Optional[bool]:
+            async with semaphore:
+                return await self.user_exists(username)
+        return dict(zip(usernames, await asyncio.gather(*(check(username) for username in usernames))))
+
+    async def sub_flairs(self, sub: str) -> List[str]:
+        '''
+        Returns:
+            List[str]: The text of every link flair template in sub
+        '''
+        async def load():
+            subreddit = await self.reddit.subreddit(sub)
+            async with REDDIT_BUDGET.request(ADMIN, call='link_flair'):
+                return [fl_dict['text'] async for fl_dict in subreddit.flair.link_templates]
+        return await self.flairs.get_or_load(sub.lower(), load)
+
+    def stats(self) -> dict:
+        return {'subreddits': self.subreddits.stats(), 'users': self.users.stats(),
+                'flairs': self.flairs.stats()}
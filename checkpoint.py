@@ -0,0 +1,181 @@
+import asyncio
+import heapq
+import json
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Iterable, List, Optional
+
+import asyncpraw as pr
+
+from budget import REDDIT_BUDGET, STREAM
+from streams import SeenIds, plan_shards
+from utils import log_and_print, utc_str_now
+
+
+class StreamCheckpoint():
+    '''
+    Remembers, per stream kind ('comments' / 'submissions'), the newest item that was
+    processed and the ids seen most recently, and saves them to a JSON file so a
+    restart can pick up where the last run stopped.
+
+    Items are registered with begin() when they enter the pipeline and reported
+    with done() once the pipeline is finished with them (handed to the outbox or
+    dispatcher, or dropped). The checkpoint only moves up to the newest done item
+    older than every item still in flight, and in-flight ids are left out of the
+    saved seen ids, so whatever was still queued when the bot stopped is
+    backfilled and processed again after a restart.
+
+    begin() and done() only touch memory, the file is rewritten (atomically) by
+    run() every save_interval seconds when something changed, and once more when
+    run() is cancelled.
+    '''
+    def __init__(self, path: str, max_seen_ids: int = 2000):
+        self.path = path
+        self.max_seen_ids = max_seen_ids
+        self.state = {}         # kind -> {'last': fullname, 'created_utc': float}
+        self.restored = {}      # kind -> the state loaded at startup
+        self._seen_ids = {}     # kind -> SeenIds of the stream
+        self._in_flight = {}    # kind -> {item id: created_utc} of items begun and not done
+        self._oldest = {}       # kind -> heap of (created_utc, item id) of items begun, lazily cleaned
+        self._done = {}         # kind -> heap of (created_utc, fullname) done but newer than something in flight
+        self._dirty = False
+        self._executor = ThreadPoolExecutor(max_workers=1)
+
+    def load(self) -> None:
+        try:
+            with open(self.path) as fp:
+                saved = json.load(fp)
+        except (FileNotFoundError, json.JSONDecodeError) as e:
+            log_and_print(f'No usable stream checkpoint at {self.path}: {e!r}', level='warning')
+            return
+        for kind in ['comments', 'submissions']:
+            if isinstance(saved.get(kind), dict) and saved[kind].get('last'):
+                self.restored[kind] = saved[kind]
+                self.state[kind] = {'last': saved[kind]['last'], 'created_utc': saved[kind]['created_utc']}
+
+    def attach(self, kind: str, seen_ids: SeenIds) -> None:
+        '''
+        Restores the saved seen ids of kind into seen_ids, and saves seen_ids from now on
+        '''
+        restored = self.restored.get(kind, {})
+        for item_id in restored.get('seen_ids', []):
+            seen_ids.add(item_id)
+        if restored:
+            seen_ids.add(restored['last'].split('_', 1)[-1])
+        self._seen_ids[kind] = seen_ids
+
+    def begin(self, kind: str, item) -> None:
+        '''
+        Registers item as in flight, the checkpoint won't move past it until done()
+        '''
+        self._in_flight.setdefault(kind, {})[item.id] = item.created_utc
+        heapq.heappush(self._oldest.setdefault(kind, []), (item.created_utc, item.id))
+
+    def done(self, kind: str, item) -> None:
+        '''
+        Reports that the pipeline is finished with item, moving the checkpoint up to
+        the newest done item created before everything still in flight
+        '''
+        in_flight = self._in_flight.get(kind, {})
+        in_flight.pop(item.id, None)
+        done = self._done.setdefault(kind, [])
+        heapq.heappush(done, (item.created_utc, item.fullname))
+        oldest = self._oldest.get(kind, [])
+        while oldest and oldest[0][1] not in in_flight:
+            heapq.heappop(oldest)
+        # Strictly older, backfill could skip an item created in the same second
+        limit = oldest[0][0] if oldest else float('inf')
+        newest = None
+        while done and done[0][0] < limit:
+            newest = heapq.heappop(done)
+        if newest is None:
+            return
+        last = self.state.get(kind)
+        if last is None or newest[0] >= last['created_utc']:
+            self.state[kind] = {'last': newest[1], 'created_utc': newest[0]}
+            self._dirty = True
+
+    def in_flight(self, kind: str) -> int:
+        return len(self._in_flight.get(kind, {}))
+
+    def _snapshot(self) -> dict:
+        snapshot = {'last_modified_time': utc_str_now()}
+        for kind, last in self.state.items():
+            seen_ids = self._seen_ids.get(kind)
+            in_flight = self._in_flight.get(kind, {})
+            recent = seen_ids.recent(self.max_seen_ids) if seen_ids else []
+            snapshot[kind] = dict(last, seen_ids=[item_id for item_id in recent if item_id not in in_flight])
+        return snapshot
+
+    def _write(self, snapshot: dict) -> None:
+        tmp_path = self.path + '.tmp'
+        with open(tmp_path, mode = 'w') as fp:
+            json.dump(snapshot, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.path)
+
+    async def save(self) -> None:
+        snapshot = self._snapshot()
+        self._dirty = False
+        await asyncio.get_running_loop().run_in_executor(self._executor, self._write, snapshot)
+
+    async def run(self, save_interval: float = 30) -> None:
+        try:
+            while True:
+                await asyncio.sleep(save_interval)
+                if self._dirty:
+                    try:
+                        await self.save()
+                    except OSError as e:
+                        log_and_print(f'Failed to save the stream checkpoint: {e!r}', level='error')
+        finally:
+            if self._dirty:
+                self._write(self._snapshot())
+
+
+async def backfill(reddit_instance: pr.Reddit, subreddits: Iterable[str], kind: str,
+                   checkpoint: Optional[dict], max_items: int = 1000, max_age: float = 21600,
+                   max_chars: int = 1000) -> List:
+    '''
+    Pages back through the newest comments (or submissions) of subreddits until the
+    checkpointed item, to recover what was posted while the bot was down
+
+    Paging stops at the checkpoint, at items older than max_age seconds, or after
+    max_items items per `r/a+b+c` group, whichever comes first.
+
+    Args:
+        reddit_instance (pr.Reddit): The shared Reddit client
+        subreddits (Iterable[str]): The subreddits that are about to be streamed
+        kind (str): 'comments' or 'submissions'
+        checkpoint (Optional[dict]): The 'last' fullname and its 'created_utc', None if there is none
+        max_items (int, optional): Most items fetched per group. Defaults to 1000.
+        max_age (float, optional): Oldest item fetched, in seconds. Defaults to 21600.
+        max_chars (int, optional): Maximum length of a `+` joined group. Defaults to 1000.
+
+    Returns:
+        List: The missed items, oldest first
+    '''
+    if checkpoint is None:
+        return []
+    cutoff = max(checkpoint['created_utc'], time.time() - max_age)
+    missed = []
+    truncated = False
+    for group in plan_shards(subreddits, max_chars=max_chars):
+        subreddit = await reddit_instance.subreddit('+'.join(group))
+        listing = subreddit.comments if kind == 'comments' else subreddit.new
+        count = 0
+        async with REDDIT_BUDGET.request(STREAM, call=f'backfill_{kind}'):
+            async for item in listing(limit=max_items):
+                count += 1
+                if item.fullname == checkpoint['last'] or item.created_utc < cutoff:
+                    break
+                missed.append(item)
+            else:
+                truncated = truncated or count >= max_items
+    if truncated:
+        log_and_print(f'Backfill of {kind} stopped after {max_items} items, some may have been missed',
+                      level='warning')
+    missed.sort(key=lambda item: item.created_utc)
+    return missed
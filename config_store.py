@@ -0,0 +1,341 @@
+import asyncio
+import copy
+import json
+import os
+import sqlite3
+from concurrent.futures import ThreadPoolExecutor
+from typing import Any, Callable, Optional
+
+from utils import log_and_print, utc_str_now
+
+
+_RELOAD = object()
+
+
+class GuildsConfStore():
+    '''
+    Holds guilds_conf in memory and funnels every change through a single writer task.
+
+    Commands read from the in-memory copy and submit mutations with update_guild(),
+    which are applied one at a time by the writer, so two commands running at once
+    can't overwrite each other. Only the guild that changed is handed to the backend
+    to persist. Subclasses implement load() and _persist().
+
+    Listeners registered with add_listener() are called as
+    listener(guild_id, guild_info) after every committed change, guild_info is None
+    when the guild was removed. Edits made to the backing file by something other
+    than the store are picked up by watch_external_changes() and announced the
+    same way.
+    '''
+    def __init__(self):
+        self.guilds_conf = {}
+        self._listeners = []
+        self._queue = None
+        self._writer = None
+        self._known_mtimes = ()
+        # One thread does all the disk I/O, which also keeps sqlite connections on one thread
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='guilds_conf')
+
+    def _read(self) -> dict:
+        raise NotImplementedError
+
+    def _backing_paths(self) -> list:
+        raise NotImplementedError
+
+    def _persist(self, guild_id: str, guild_info: Optional[dict], last_modified_time: str) -> None:
+        raise NotImplementedError
+
+    def _mtimes(self) -> tuple:
+        mtimes = []
+        for path in self._backing_paths():
+            try:
+                mtimes.append(os.stat(path).st_mtime_ns)
+            except FileNotFoundError:
+                mtimes.append(0)
+        return tuple(mtimes)
+
+    def load(self) -> dict:
+        '''
+        (Re)loads the whole guilds config from the backend. Listeners are not notified.
+
+        Returns:
+            dict: guilds_conf, in the same layout as guilds_conf.json
+        '''
+        self.guilds_conf = self._read()
+        self._known_mtimes = self._mtimes()
+        return self.guilds_conf
+
+    def add_listener(self, listener: Callable[[str, Optional[dict]], None]) -> None:
+        self._listeners.append(listener)
+
+    def guild_ids(self) -> list:
+        return [g for g, info in self.guilds_conf.items() if isinstance(info, dict)]
+
+    def get_guild(self, guild_id: str) -> Optional[dict]:
+        '''
+        Returns a copy of a guild's config, or None if the guild isn't known
+        '''
+        guild_info = self.guilds_conf.get(str(guild_id))
+        return copy.deepcopy(guild_info) if isinstance(guild_info, dict) else None
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None or self._writer.done():
+            self._queue = asyncio.Queue()
+            self._writer = asyncio.ensure_future(self._write_loop())
+
+    async def _write_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            guild_id, func, create, fut = await self._queue.get()
+            try:
+                if func is _RELOAD:
+                    result = await self._reload()
+                    if not fut.done():
+                        fut.set_result(result)
+                    continue
+
+                old_info = self.guilds_conf.get(guild_id)
+                if func is None:
+                    new_info, result = None, old_info
+                else:
+                    if isinstance(old_info, dict):
+                        new_info = copy.deepcopy(old_info)
+                    elif create:
+                        new_info = {}
+                    else:
+                        raise KeyError(f'Guild {guild_id} not found in guilds_conf')
+                    result = func(new_info)
+
+                if new_info != old_info:
+                    lmt = utc_str_now()
+                    await loop.run_in_executor(self._executor, self._persist_and_stat, guild_id, new_info, lmt)
+                    if new_info is None:
+                        self.guilds_conf.pop(guild_id, None)
+                    else:
+                        self.guilds_conf[guild_id] = new_info
+                    self.guilds_conf['last_modified_time'] = lmt
+                    self._notify(guild_id, new_info)
+                if not fut.done():
+                    fut.set_result(result)
+            except Exception as e:
+                if not fut.done():
+                    fut.set_exception(e)
+            finally:
+                self._queue.task_done()
+
+    def _persist_and_stat(self, guild_id: str, guild_info: Optional[dict], last_modified_time: str) -> None:
+        self._persist(guild_id, guild_info, last_modified_time)
+        self._known_mtimes = self._mtimes()
+
+    async def _reload(self) -> int:
+        loop = asyncio.get_running_loop()
+        old_conf = self.guilds_conf
+        new_conf = await loop.run_in_executor(self._executor, self.load)
+        changed = 0
+        for guild_id in set(old_conf) | set(new_conf):
+            new_info = new_conf.get(guild_id)
+            if guild_id == 'last_modified_time' or old_conf.get(guild_id) == new_info:
+                continue
+            self._notify(guild_id, new_info if isinstance(new_info, dict) else None)
+            changed += 1
+        if changed:
+            log_and_print(f'guilds config changed on disk, reloaded {changed} guilds')
+        return changed
+
+    async def reload(self) -> int:
+        '''
+        Re-reads the backend and notifies listeners about every guild that differs
+
+        Returns:
+            int: The number of guilds that changed
+        '''
+        return await self._submit(None, _RELOAD)
+
+    async def watch_external_changes(self, interval: float) -> None:
+        '''
+        Polls the modification time of the backing file(s) every interval seconds and
+        reloads when they change without the store having written to them.
+        '''
+        while True:
+            await asyncio.sleep(interval)
+            if self._mtimes() != self._known_mtimes:
+                try:
+                    await self.reload()
+                except Exception as e:
+                    log_and_print(f'Failed to reload the guilds config: {e!r}', level='error')
+
+    def _notify(self, guild_id: str, guild_info: Optional[dict]) -> None:
+        for listener in self._listeners:
+            try:
+                listener(guild_id, guild_info)
+            except Exception as e:
+                log_and_print(f'guilds_conf listener failed for guild {guild_id}: {e!r}', level='error')
+
+    async def _submit(self, guild_id: str, func: Optional[Callable], create: bool = False) -> Any:
+        self._ensure_writer()
+        fut = asyncio.get_running_loop().create_future()
+        await self._queue.put((guild_id if guild_id is None else str(guild_id), func, create, fut))
+        return await fut
+
+    async def update_guild(self, guild_id: str, func: Callable[[dict], Any]) -> Any:
+        '''
+        Applies func to the guild's config and persists the result if anything changed
+
+        Args:
+            guild_id (str): The guild to update
+            func (Callable[[dict], Any]): Mutates the guild's config dict in place
+
+        Returns:
+            Any: Whatever func returned
+        '''
+        return await self._submit(guild_id, func)
+
+    async def put_guild(self, guild_id: str, guild_info: dict) -> None:
+        '''
+        Adds (or replaces) a guild's config
+        '''
+        guild_info = copy.deepcopy(guild_info)
+        def replace(info):
+            info.clear()
+            info.update(guild_info)
+        await self._submit(guild_id, replace, create=True)
+
+    async def remove_guild(self, guild_id: str) -> Optional[dict]:
+        '''
+        Removes a guild's config
+
+        Returns:
+            Optional[dict]: The removed config, None if the guild wasn't known
+        '''
+        return await self._submit(guild_id, None)
+
+    async def close(self) -> None:
+        if self._queue is not None:
+            await self._queue.join()
+        if self._writer is not None:
+            self._writer.cancel()
+        self._executor.shutdown(wait=True)
+
+
+class JsonGuildsConfStore(GuildsConfStore):
+    '''
+    Keeps the original guilds_conf.json layout. Writes still rewrite the whole file,
+    but they are serialized through the writer and replace the file atomically.
+    '''
+    def __init__(self, json_path: str):
+        super().__init__()
+        self.json_path = json_path
+
+    def _backing_paths(self) -> list:
+        return [self.json_path]
+
+    def _read(self) -> dict:
+        with open(self.json_path) as fp:
+            return json.load(fp)
+
+    def _persist(self, guild_id: str, guild_info: Optional[dict], last_modified_time: str) -> None:
+        guilds_conf = dict(self.guilds_conf)
+        if guild_info is None:
+            guilds_conf.pop(guild_id, None)
+        else:
+            guilds_conf[guild_id] = guild_info
+        guilds_conf['last_modified_time'] = last_modified_time
+
+        tmp_path = self.json_path + '.tmp'
+        with open(tmp_path, mode = 'w') as fp:
+            json.dump(guilds_conf, fp)
+            fp.flush()
+            os.fsync(fp.fileno())
+        os.replace(tmp_path, self.json_path)
+
+
+class SqliteGuildsConfStore(GuildsConfStore):
+    '''
+    Stores one row per guild in a SQLite database running in WAL mode.
+
+    The first time the database is opened it imports the guilds from
+    guilds_conf.json (if there is one). The JSON file is left untouched as a backup.
+    '''
+    SCHEMA_VERSION = '1'
+
+    def __init__(self, db_path: str, json_path: Optional[str] = None):
+        super().__init__()
+        self.db_path = db_path
+        self.json_path = json_path
+        self._conn = None
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.db_path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS guilds (guild_id TEXT PRIMARY KEY, conf TEXT NOT NULL)')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT)')
+            self._conn.commit()
+        return self._conn
+
+    def _migrate_from_json(self, conn: sqlite3.Connection) -> None:
+        guilds_conf = {}
+        if self.json_path is not None and os.path.exists(self.json_path):
+            with open(self.json_path) as fp:
+                guilds_conf = json.load(fp)
+
+        guilds = [(g, json.dumps(info)) for g, info in guilds_conf.items() if isinstance(info, dict)]
+        lmt = guilds_conf.get('last_modified_time', utc_str_now())
+        with conn:
+            conn.executemany('INSERT OR REPLACE INTO guilds VALUES (?, ?)', guilds)
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_modified_time', ?)", (lmt,))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('schema_version', ?)", (self.SCHEMA_VERSION,))
+        if guilds:
+            log_and_print(f'Migrated {len(guilds)} guilds from {self.json_path} to {self.db_path}')
+
+    def _backing_paths(self) -> list:
+        return [self.db_path, self.db_path + '-wal']
+
+    def _read(self) -> dict:
+        conn = self._connect()
+        meta = dict(conn.execute('SELECT key, value FROM meta'))
+        if 'schema_version' not in meta:
+            self._migrate_from_json(conn)
+            meta = dict(conn.execute('SELECT key, value FROM meta'))
+
+        guilds_conf = {g: json.loads(conf) for g, conf in conn.execute('SELECT guild_id, conf FROM guilds')}
+        guilds_conf['last_modified_time'] = meta.get('last_modified_time', utc_str_now())
+        return guilds_conf
+
+    def _persist(self, guild_id: str, guild_info: Optional[dict], last_modified_time: str) -> None:
+        conn = self._connect()
+        with conn:
+            if guild_info is None:
+                conn.execute('DELETE FROM guilds WHERE guild_id = ?', (guild_id,))
+            else:
+                conn.execute('INSERT OR REPLACE INTO guilds VALUES (?, ?)', (guild_id, json.dumps(guild_info)))
+            conn.execute("INSERT OR REPLACE INTO meta VALUES ('last_modified_time', ?)", (last_modified_time,))
+
+    async def close(self) -> None:
+        await super().close()
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+
+def open_guilds_conf_store(bot_config: dict) -> GuildsConfStore:
+    '''
+    Creates and loads the guilds config store selected by static_settings.config_backend
+
+    Args:
+        bot_config (dict): The contents of config.json
+
+    Returns:
+        GuildsConfStore: A loaded store, either 'json' or 'sqlite' backed
+    '''
+    backend = bot_config['static_settings'].get('config_backend', 'json')
+    json_path = bot_config['dir_paths']['guilds_conf']
+    if backend == 'sqlite':
+        store = SqliteGuildsConfStore(bot_config['dir_paths']['guilds_db'], json_path)
+    elif backend == 'json':
+        store = JsonGuildsConfStore(json_path)
+    else:
+        raise ValueError(f"Unknown config_backend `{backend}`, must be one of ['json', 'sqlite']")
+    store.load()
+    return store
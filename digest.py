@@ -0,0 +1,103 @@
+from typing import Iterable, List
+
+import discord as dc
+
+
+MESSAGE_LIMIT = 2000            # characters of content per message
+EMBEDS_PER_MESSAGE = 10
+EMBED_DESCRIPTION_LIMIT = 4096
+EMBEDS_TOTAL_LIMIT = 6000       # characters across all the embeds of a message
+DELIVERY_MODES = ['immediate', 'digest']
+DIGEST_FORMATS = ['embeds', 'text']
+
+
+def _split_long(text: str, limit: int) -> List[str]:
+    '''
+    Splits text into pieces of at most limit characters, at line breaks where possible
+    '''
+    pieces = []
+    current = ''
+    for line in text.splitlines(keepends=True):
+        while len(line) > limit:
+            # A single line that doesn't fit anywhere, cut it (at a space if there is one)
+            if current:
+                pieces.append(current)
+                current = ''
+            cut = line.rfind(' ', 0, limit)
+            cut = cut if cut > 0 else limit
+            pieces.append(line[:cut])
+            line = line[cut:]
+        if len(current) + len(line) > limit:
+            pieces.append(current)
+            current = ''
+        current += line
+    if current:
+        pieces.append(current)
+    return pieces
+
+
+def paginate(bodies: Iterable[str], limit: int = MESSAGE_LIMIT, separator: str = '\n') -> List[str]:
+    '''
+    Packs message bodies into as few messages as possible, each at most limit
+    characters. Bodies are only split when a single one is longer than limit.
+
+    Args:
+        bodies (Iterable[str]): The notification message bodies, in order
+        limit (int, optional): Characters per message. Defaults to 2000.
+        separator (str, optional): Put between bodies sharing a message. Defaults to a newline.
+
+    Returns:
+        List[str]: The pages
+    '''
+    pages = []
+    current = ''
+    for body in bodies:
+        for piece in _split_long(body, limit):
+            joined = current + separator + piece if current else piece
+            if len(joined) <= limit:
+                current = joined
+            else:
+                pages.append(current)
+                current = piece
+    if current:
+        pages.append(current)
+    return pages
+
+
+def embed_batches(bodies: Iterable[str]) -> List[List[dc.Embed]]:
+    '''
+    Turns every body into an embed and groups them into messages of at most 10
+    embeds and 6000 characters
+
+    Returns:
+        List[List[dc.Embed]]: The embeds of each message
+    '''
+    batches = []
+    current, chars = [], 0
+    for body in bodies:
+        for piece in _split_long(body, EMBED_DESCRIPTION_LIMIT):
+            if len(current) == EMBEDS_PER_MESSAGE or chars + len(piece) > EMBEDS_TOTAL_LIMIT:
+                batches.append(current)
+                current, chars = [], 0
+            current.append(dc.Embed(description=piece))
+            chars += len(piece)
+    if current:
+        batches.append(current)
+    return batches
+
+
+def render_messages(bodies: List[str], digest_format: str = 'text') -> List[dict]:
+    '''
+    Lays out bodies as Discord messages within the length limits, for a single
+    notification (one body) as well as for a digest
+
+    Args:
+        bodies (List[str]): The notification message bodies, in order
+        digest_format (str, optional): 'embeds' or 'text'. Defaults to 'text'.
+
+    Returns:
+        List[dict]: The keyword arguments of each channel.send() making up the messages
+    '''
+    if digest_format == 'embeds':
+        return [{'embeds': embeds} for embeds in embed_batches(bodies)]
+    return [{'content': page} for page in paginate(bodies)]
@@ -0,0 +1,406 @@
+import asyncio
+import time
+from collections import deque
+from typing import Callable, List, Optional, Tuple
+
+import discord as dc
+from discord.ext import commands
+
+from digest import render_messages
+from gateway import ShardHealth
+from metrics import REGISTRY
+from tracing import CURRENT_TRACE
+from utils import log_and_print
+
+
+DISCORD_SEND_LATENCY = REGISTRY.histogram('reddisc_discord_send_seconds', 'Latency of channel.send calls',
+                                          ['shard'])
+DISCORD_RATE_LIMITED = REGISTRY.counter('reddisc_discord_rate_limited_total', 'Sends that got a 429 from Discord',
+                                        ['shard'])
+NOTIFICATION_LATENCY = REGISTRY.histogram('reddisc_notification_latency_seconds',
+                                          'Time from an item being received to its last channel send',
+                                          buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 30, 60, 120, 300))
+DIGEST_SIZE = REGISTRY.histogram('reddisc_digest_notifications', 'Notifications batched into each digest',
+                                 buckets=(1, 2, 5, 10, 25, 50, 100, 250))
+
+# What became of a send: it went out, it never will (the channel is gone or
+# forbidden), or it didn't this time (Discord errors or unreachable) and can be retried
+DELIVERED = 'delivered'
+DROPPED = 'dropped'
+FAILED = 'failed'
+
+
+class RateLimiter():
+    '''
+    Token bucket allowing `rate` acquisitions every `per` seconds
+    '''
+    def __init__(self, rate: int, per: float):
+        self.rate = rate
+        self.per = per
+        self._tokens = float(rate)
+        self._updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self._tokens = min(self.rate, self._tokens + (now - self._updated) * self.rate / self.per)
+                self._updated = now
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) * self.per / self.rate)
+
+    def pause(self, seconds: float) -> None:
+        '''
+        Empties the bucket so nothing is let through for about `seconds`
+        '''
+        self._tokens = -seconds * self.rate / self.per
+        self._updated = time.monotonic()
+
+
+class _Delivery():
+    '''
+    One notification being fanned out to several channels
+    '''
+    def __init__(self, msg_body: str, received: float, channels: int, outbox_ids: Optional[dict] = None,
+                 pages_sent: Optional[dict] = None):
+        self.msg_body = msg_body
+        self.received = received
+        self.remaining = channels
+        self.delivered = 0
+        self.outbox_ids = outbox_ids or {}  # channel id -> outbox entry id
+        self.pages_sent = pages_sent or {}  # channel id -> pages of msg_body that already went out
+        self.trace = None                   # the pipeline's Trace, finished once every channel settled
+        self.queued = time.perf_counter()
+
+
+class _Digest():
+    '''
+    Notifications for one channel collected to be sent together
+    '''
+    def __init__(self, settings: dict):
+        self.settings = settings
+        self.deliveries = []
+        self.flusher = None     # task that sends the digest once its window is over
+
+
+class DiscordDispatcher():
+    '''
+    Sends notifications to their channels concurrently while staying within
+    Discord's global rate limit and the per-channel message route limit.
+
+    Every channel gets its own queue and worker, so one slow or rate limited channel
+    doesn't hold up the others, while messages to the same channel keep their order.
+    Sends that get a 429 are retried after the retry_after Discord asks for, other
+    server errors are retried with backoff. Sends to channels that can't be found or
+    written to (404/403) are dropped with an error in the log, other rejected sends
+    are reported as failed.
+
+    The delivery latency of each notification (from the moment its item was
+    received to the last channel send) is logged, and kept for latency_stats().
+
+    Given a ShardHealth, every channel is attributed to the gateway shard that owns
+    its guild. Sends to a guild whose shard is reconnecting wait (up to shard_wait
+    seconds) for it to come back rather than failing to resolve the channel, and
+    send latency and 429s are reported per shard.
+
+    Guilds whose config has delivery mode 'digest' don't get a message per
+    notification. Their notifications are collected per channel for up to `window`
+    seconds or `max_items` notifications, and then sent together as a few messages
+    of up to 10 embeds each (or as text split into 2000 character pages). Single
+    notifications longer than Discord allows are split into pages the same way,
+    and when a page fails the pages before it aren't sent again: the number of
+    pages that went out is reported with the result, and a resend given it
+    starts from the first page that didn't.
+    on_guild_change keeps the delivery settings in step with the guilds config.
+
+    Notifications sent with outbox_ids have the outcome of every channel send
+    (DELIVERED, DROPPED or FAILED) and the pages sent reported to the result
+    listeners, so the NotificationOutbox can mark them delivered or retry them later.
+
+    A notification sent while CURRENT_TRACE is set gets a send span for each
+    channel, from a channel worker picking it up to the send settling, and its
+    trace is finished once every channel has settled.
+    '''
+    def __init__(self, discord_instance: commands.Bot, global_rate: int = 50, global_per: float = 1,
+                 channel_rate: int = 5, channel_per: float = 5, max_retries: int = 5,
+                 channel_queue_size: int = 100, idle_timeout: float = 60,
+                 shard_health: Optional[ShardHealth] = None, shard_wait: float = 60):
+        self.bot = discord_instance
+        self.shard_health = shard_health
+        self.shard_wait = shard_wait
+        self.global_limiter = RateLimiter(global_rate, global_per)
+        self.channel_rate = channel_rate
+        self.channel_per = channel_per
+        self.max_retries = max_retries
+        self.channel_queue_size = channel_queue_size
+        self.idle_timeout = idle_timeout
+        self.rate_limited = 0
+        self.latencies = deque(maxlen=1000)
+        self.first_delivery = asyncio.Event()
+        self._channels = {}     # channel id -> (queue, limiter, worker task)
+        self._resolved = {}     # channel id -> channel object
+        self._guilds = {}       # channel id -> guild id
+        self._delivery = {}     # guild id -> delivery settings, only for guilds getting digests
+        self._digests = {}      # channel id -> _Digest being collected
+        self._result_listeners = []
+
+    def on_guild_change(self, guild_id: str, guild_info: Optional[dict]) -> None:
+        '''
+        Listener for GuildsConfStore, picks up the guild's delivery settings
+        '''
+        delivery = (guild_info or {}).get('delivery') or {}
+        if delivery.get('mode') == 'digest':
+            self._delivery[guild_id] = delivery
+            return
+        self._delivery.pop(guild_id, None)
+        # Whatever was being collected for the guild goes out now
+        for chan_id in [c for c in self._digests if self._guilds.get(c) == guild_id]:
+            asyncio.ensure_future(self._flush(chan_id))
+
+    def add_result_listener(self, listener: Callable[[int, str, int], None]) -> None:
+        '''
+        listener is called with (outbox id, DELIVERED / DROPPED / FAILED, pages sent)
+        for every channel send of a notification that was sent with outbox_ids
+        '''
+        self._result_listeners.append(listener)
+
+    async def send(self, srvs_to_send: List[Tuple[str, int]], msg_body: str,
+                   received: Optional[float] = None, outbox_ids: Optional[List[int]] = None,
+                   pages_sent: Optional[List[int]] = None) -> None:
+        '''
+        Queues msg_body for every (guild id, channel id) in srvs_to_send.
+        Returns once it is queued, only waits when a channel's queue is full.
+
+        Args:
+            outbox_ids (List[int], optional): The outbox entry of each (guild id, channel id)
+            pages_sent (List[int], optional): Pages of msg_body each (guild id, channel id) already got
+        '''
+        chan_ids = [chan_id for _, chan_id in srvs_to_send]
+        outbox_ids = dict(zip(chan_ids, outbox_ids)) if outbox_ids else None
+        pages_sent = dict(zip(chan_ids, pages_sent)) if pages_sent else None
+        delivery = _Delivery(msg_body, received if received is not None else time.time(), len(srvs_to_send),
+                             outbox_ids, pages_sent)
+        if srvs_to_send:
+            delivery.trace = CURRENT_TRACE.get()
+            if delivery.trace is not None:
+                delivery.trace.handed_off = True
+        for srv, chan_id in srvs_to_send:
+            self._guilds[chan_id] = srv
+            settings = self._delivery.get(srv)
+            if settings is None:
+                await self._channel_queue(chan_id).put(delivery)
+            else:
+                await self._collect(chan_id, delivery, settings)
+
+    async def _collect(self, chan_id: int, delivery: _Delivery, settings: dict) -> None:
+        digest = self._digests.get(chan_id)
+        if digest is None:
+            digest = self._digests[chan_id] = _Digest(settings)
+            digest.flusher = asyncio.ensure_future(self._flush_after(chan_id, digest, settings['window']))
+        digest.deliveries.append(delivery)
+        if len(digest.deliveries) >= settings['max_items']:
+            await self._flush(chan_id)
+
+    async def _flush_after(self, chan_id: int, digest: _Digest, window: float) -> None:
+        await asyncio.sleep(window)
+        if self._digests.get(chan_id) is digest:
+            digest.flusher = None
+            await self._flush(chan_id)
+
+    async def _flush(self, chan_id: int) -> None:
+        '''
+        Queues the digest collected for chan_id to be sent
+        '''
+        digest = self._digests.pop(chan_id, None)
+        if digest is None:
+            return
+        if digest.flusher is not None:
+            digest.flusher.cancel()
+        DIGEST_SIZE.observe(len(digest.deliveries))
+        await self._channel_queue(chan_id).put(digest)
+
+    def _channel_queue(self, chan_id: int) -> asyncio.Queue:
+        entry = self._channels.get(chan_id)
+        if entry is None or entry[2].done():
+            queue = entry[0] if entry is not None else asyncio.Queue(maxsize=self.channel_queue_size)
+            limiter = entry[1] if entry is not None else RateLimiter(self.channel_rate, self.channel_per)
+            worker = asyncio.ensure_future(self._channel_worker(chan_id, queue, limiter))
+            entry = (queue, limiter, worker)
+            self._channels[chan_id] = entry
+        return entry[0]
+
+    async def _resolve(self, chan_id: int) -> Optional[dc.abc.Messageable]:
+        channel = self._resolved.get(chan_id) or self.bot.get_channel(chan_id)
+        if channel is None:
+            try:
+                channel = await self.bot.fetch_channel(chan_id)
+            except (dc.NotFound, dc.Forbidden):
+                return None
+        self._resolved[chan_id] = channel
+        return channel
+
+    async def _channel_worker(self, chan_id: int, queue: asyncio.Queue, limiter: RateLimiter) -> None:
+        while True:
+            try:
+                delivery = await asyncio.wait_for(queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                if queue.empty():
+                    self._channels.pop(chan_id, None)
+                    return
+                continue
+            picked = time.perf_counter()
+            if isinstance(delivery, _Digest):
+                await self._send_digest(chan_id, delivery, limiter, picked)
+                queue.task_done()
+                continue
+            result = FAILED
+            try:
+                result, delivery.pages_sent[chan_id] = await self._send_messages(
+                    chan_id, limiter, render_messages([delivery.msg_body]), delivery.pages_sent.get(chan_id, 0))
+            finally:
+                queue.task_done()
+                self._settle(delivery, chan_id, result, picked)
+
+    async def _send_digest(self, chan_id: int, digest: _Digest, limiter: RateLimiter, picked: float) -> None:
+        result = FAILED
+        try:
+            messages = render_messages([delivery.msg_body for delivery in digest.deliveries],
+                                       digest.settings['format'])
+            # Digests are put together anew every time, so they are always sent whole
+            result, _ = await self._send_messages(chan_id, limiter, messages)
+        finally:
+            for delivery in digest.deliveries:
+                self._settle(delivery, chan_id, result, picked, digest=len(digest.deliveries))
+
+    async def _send_messages(self, chan_id: int, limiter: RateLimiter, messages: List[dict],
+                             start: int = 0) -> Tuple[str, int]:
+        '''
+        Sends the pages of a notification or digest in order from page start,
+        stopping at the first one that doesn't go out
+
+        Returns:
+            Tuple[str, int]: DELIVERED if every page was sent, else the result of the
+                             page that wasn't, and how many pages have been sent
+        '''
+        result = DELIVERED if messages else FAILED
+        sent = start
+        for message in messages[start:]:
+            result = await self._send_one(chan_id, limiter, **message)
+            if result != DELIVERED:
+                break
+            sent += 1
+        return result, sent
+
+    def _settle(self, delivery: _Delivery, chan_id: int, result: str, picked: float, digest: int = 0) -> None:
+        if delivery.trace is not None:
+            attrs = {'digest': digest} if digest else {}
+            delivery.trace.add_span('send', picked, time.perf_counter(), guild=self._guilds.get(chan_id),
+                                    channel=chan_id, result=result,
+                                    waited_ms=round((picked - delivery.queued) * 1000, 3), **attrs)
+        if result == DELIVERED:
+            delivery.delivered += 1
+        outbox_id = delivery.outbox_ids.get(chan_id)
+        if outbox_id is not None:
+            for listener in self._result_listeners:
+                listener(outbox_id, result, delivery.pages_sent.get(chan_id, 0))
+        delivery.remaining -= 1
+        if delivery.remaining == 0:
+            self._finished(delivery)
+
+    def shard_of(self, chan_id: int) -> int:
+        if self.shard_health is None:
+            return 0
+        return self.shard_health.shard_for(self._guilds.get(chan_id))
+
+    async def _send_one(self, chan_id: int, limiter: RateLimiter, **message) -> str:
+        '''
+        Returns:
+            str: DELIVERED, DROPPED or FAILED
+        '''
+        shard_id = self.shard_of(chan_id)
+        if self.shard_health is not None and not self.shard_health.is_connected(shard_id):
+            if not await self.shard_health.wait_connected(shard_id, self.shard_wait):
+                log_and_print(f'Shard {shard_id} still down, sending to channel {chan_id} anyway',
+                              level='warning', terminal_print=False)
+        try:
+            channel = await self._resolve(chan_id)
+        except Exception as e:
+            # Discord unreachable, not a reason to give up on the channel
+            log_and_print(f'Failed to look up channel {chan_id}: {e!r}', level='error')
+            return FAILED
+        if channel is None:
+            log_and_print(f'Notification channel {chan_id} not found, dropping message', level='error')
+            return DROPPED
+
+        for attempt in range(self.max_retries + 1):
+            await limiter.acquire()
+            await self.global_limiter.acquire()
+            try:
+                with DISCORD_SEND_LATENCY.time(shard=shard_id):
+                    await channel.send(**message)
+                return DELIVERED
+            except dc.HTTPException as e:
+                if e.status == 429:
+                    self.rate_limited += 1
+                    DISCORD_RATE_LIMITED.inc(shard=shard_id)
+                    retry_after = getattr(e, 'retry_after', None) or 2 ** attempt
+                    limiter.pause(retry_after)
+                    log_and_print(f'Rate limited sending to {chan_id}, retrying in {retry_after:.1f}s',
+                                  level='warning', terminal_print=False)
+                    await asyncio.sleep(retry_after)
+                elif e.status >= 500:
+                    await asyncio.sleep(2 ** attempt)
+                elif e.status in (403, 404):
+                    # The channel is gone or the bot may no longer write to it, retrying won't help
+                    self._resolved.pop(chan_id, None)
+                    log_and_print(f'Failed to send to channel {chan_id}, dropping message: {e!r}', level='error')
+                    return DROPPED
+                else:
+                    # Rejected for something about this message, the outbox tries it again later
+                    log_and_print(f'Discord rejected a message to channel {chan_id}: {e!r}', level='error')
+                    return FAILED
+            except Exception as e:
+                log_and_print(f'Failed to send to channel {chan_id}: {e!r}', level='error')
+                return FAILED
+        log_and_print(f'Gave up sending to channel {chan_id} after {self.max_retries} retries', level='error')
+        return FAILED
+
+    def _finished(self, delivery: _Delivery) -> None:
+        latency = time.time() - delivery.received
+        self.latencies.append(latency)
+        NOTIFICATION_LATENCY.observe(latency)
+        if delivery.delivered:
+            self.first_delivery.set()
+        if delivery.trace is not None:
+            delivery.trace.finish()
+        log_and_print(f'Notification delivered to {delivery.delivered} channel(s) in {latency:.2f}s',
+                      terminal_print=False)
+
+    def latency_stats(self) -> dict:
+        '''
+        Returns:
+            dict: p50/p99/max delivery latency in seconds over the last 1000 notifications
+        '''
+        if not self.latencies:
+            return {'count': 0}
+        ordered = sorted(self.latencies)
+        pick = lambda q: ordered[min(len(ordered) - 1, int(q * len(ordered)))]
+        return {'count': len(ordered), 'p50': round(pick(0.5), 3), 'p99': round(pick(0.99), 3),
+                'max': round(ordered[-1], 3), 'rate_limited': self.rate_limited}
+
+    async def join(self) -> None:
+        '''
+        Waits until every notification queued so far has been sent (or dropped),
+        digests still being collected are sent right away
+        '''
+        for chan_id in list(self._digests):
+            await self._flush(chan_id)
+        for queue, _, _ in list(self._channels.values()):
+            await queue.join()
+
+    def queue_depth(self) -> int:
+        collected = sum(len(digest.deliveries) for digest in self._digests.values())
+        return collected + sum(entry[0].qsize() for entry in self._channels.values())
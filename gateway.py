@@ -0,0 +1,161 @@
+import asyncio
+import time
+from typing import List, Optional
+
+import discord as dc
+from discord.ext import commands
+
+from metrics import REGISTRY
+from utils import log_and_print
+
+
+SHARD_RECONNECTS = REGISTRY.counter('reddisc_discord_shard_disconnects_total',
+                                    'Times each gateway shard lost its connection', ['shard'])
+
+
+def shard_for(guild_id: Optional[str], shard_count: Optional[int]) -> int:
+    '''
+    The gateway shard Discord assigns a guild to
+
+    Args:
+        guild_id (str): The guild id, as used in guilds_conf
+        shard_count (int): Total number of shards, None when unsharded
+
+    Returns:
+        int: The shard id, 0 when unsharded or the guild is unknown
+    '''
+    if not shard_count or guild_id is None:
+        return 0
+    return (int(guild_id) >> 22) % shard_count
+
+
+def open_discord_bot(command_prefix: str, intents: dc.Intents, discord_settings: dict) -> commands.Bot:
+    '''
+    Creates the Discord bot, sharded over several gateway connections unless
+    discord_settings['sharding'] is off
+
+    Args:
+        command_prefix (str): Prefix of the bot commands
+        intents (dc.Intents): Gateway intents
+        discord_settings (dict): 'sharding' (bool), 'shard_count' (int, null to use the
+                                 count Discord recommends) and 'shard_ids' (list, null for
+                                 all of them, set when shards are split across processes)
+
+    Returns:
+        commands.Bot: An AutoShardedBot, or a plain Bot when sharding is off
+    '''
+    if not discord_settings['sharding']:
+        return commands.Bot(command_prefix=command_prefix, intents=intents)
+    return commands.AutoShardedBot(command_prefix=command_prefix, intents=intents,
+                                   shard_count=discord_settings['shard_count'],
+                                   shard_ids=discord_settings['shard_ids'])
+
+
+class ShardHealth():
+    '''
+    Tracks the connection state of every gateway shard from the shard events,
+    logs when shards drop or come back, and exposes their state and heartbeat
+    latency as gauges. The dispatcher uses it to hold messages for a guild while
+    the shard that owns it is reconnecting.
+
+    Works for an unsharded Bot too, which is treated as shard 0 of 1.
+    '''
+    def __init__(self, bot: commands.Bot):
+        self.bot = bot
+        self.connected = {}         # shard id -> bool
+        self.disconnected_at = {}   # shard id -> time.monotonic() of the last disconnect
+        self._changed = asyncio.Event()
+        for event in ('on_shard_connect', 'on_shard_ready', 'on_shard_resumed', 'on_shard_disconnect'):
+            bot.add_listener(getattr(self, event), event)
+        if not self.sharded:
+            for event, connected in (('on_connect', True), ('on_resumed', True), ('on_disconnect', False)):
+                bot.add_listener(self._unsharded_listener(connected), event)
+
+        REGISTRY.gauge('reddisc_discord_shard_up', 'Whether each gateway shard is connected', ['shard'],
+                       lambda: {(str(shard['shard']),): int(shard['connected']) for shard in self.describe()})
+        REGISTRY.gauge('reddisc_discord_shard_latency_seconds', 'Heartbeat latency of each gateway shard',
+                       ['shard'], lambda: {(str(shard['shard']),): shard['latency'] for shard in self.describe()
+                                           if shard['latency'] is not None})
+        REGISTRY.gauge('reddisc_discord_shard_guilds', 'Guilds served by each gateway shard', ['shard'],
+                       lambda: {(str(shard['shard']),): shard['guilds'] for shard in self.describe()})
+
+    @property
+    def sharded(self) -> bool:
+        return isinstance(self.bot, dc.AutoShardedClient)
+
+    @property
+    def shard_count(self) -> int:
+        return (self.bot.shard_count or 0) if self.sharded else 1
+
+    def shard_for(self, guild_id: Optional[str]) -> int:
+        return shard_for(guild_id, self.shard_count)
+
+    def _set(self, shard_id: int, connected: bool) -> None:
+        was_connected = self.connected.get(shard_id)
+        self.connected[shard_id] = connected
+        if connected and was_connected is False:
+            down_for = time.monotonic() - self.disconnected_at.get(shard_id, time.monotonic())
+            log_and_print(f'Gateway shard {shard_id} reconnected after {down_for:.1f}s')
+        elif not connected and was_connected:
+            self.disconnected_at[shard_id] = time.monotonic()
+            SHARD_RECONNECTS.inc(shard=shard_id)
+            log_and_print(f'Gateway shard {shard_id} disconnected', level='warning')
+        self._changed.set()
+
+    async def on_shard_connect(self, shard_id: int) -> None:
+        self._set(shard_id, True)
+
+    async def on_shard_ready(self, shard_id: int) -> None:
+        guilds = sum(1 for guild in self.bot.guilds if guild.shard_id == shard_id)
+        log_and_print(f'Gateway shard {shard_id} ready with {guilds} guild(s)')
+        self._set(shard_id, True)
+
+    async def on_shard_resumed(self, shard_id: int) -> None:
+        self._set(shard_id, True)
+
+    async def on_shard_disconnect(self, shard_id: int) -> None:
+        self._set(shard_id, False)
+
+    def _unsharded_listener(self, connected: bool):
+        # A plain Bot only sends the events without a shard id
+        async def listener():
+            self._set(0, connected)
+        return listener
+
+    def is_connected(self, shard_id: int) -> bool:
+        return self.connected.get(shard_id, False)
+
+    async def wait_connected(self, shard_id: int, timeout: float) -> bool:
+        '''
+        Waits up to timeout seconds for shard_id to be connected
+
+        Returns:
+            bool: Whether it is connected
+        '''
+        async def wait():
+            while not self.is_connected(shard_id):
+                self._changed.clear()
+                await self._changed.wait()
+        try:
+            await asyncio.wait_for(wait(), timeout)
+        except asyncio.TimeoutError:
+            pass
+        return self.is_connected(shard_id)
+
+    def describe(self) -> List[dict]:
+        '''
+        Returns:
+            List[dict]: Every shard's id, state, heartbeat latency in seconds and guild count
+        '''
+        guilds = {}
+        for guild in self.bot.guilds:
+            guilds[guild.shard_id] = guilds.get(guild.shard_id, 0) + 1
+        if self.sharded:
+            latencies = {shard_id: shard.latency for shard_id, shard in self.bot.shards.items()}
+        else:
+            latencies = {0: self.bot.latency}
+        shard_ids = sorted(set(latencies) | set(self.connected))
+        latency = lambda value: round(value, 3) if value == value and value != float('inf') else None
+        return [{'shard': shard_id, 'connected': self.is_connected(shard_id),
+                 'latency': latency(latencies.get(shard_id, float('nan'))),
+                 'guilds': guilds.get(shard_id, 0)} for shard_id in shard_ids]
@@ -0,0 +1,253 @@
+import asyncio
+import heapq
+import time
+from typing import Dict, Optional, Set, Tuple
+
+import asyncpraw as pr
+
+from budget import REDDIT_BUDGET, STREAM
+from routing import RoutingIndex
+from streams import ShardedSubredditStream, plan_shards
+from utils import log_and_print
+
+
+class AuthorPoller():
+    '''
+    Watches monitored users by polling their /comments and /submitted listings
+    instead of streaming every comment in the subreddits they post in.
+
+    Each user is polled on their own schedule: the interval aims for about one new
+    item per poll, based on how active the user has been, and stays between
+    min_interval and max_interval seconds. Only items posted in one of the user's
+    polled subreddits are kept, and they are handed to the comment/submission
+    streams with inject(), so they go down the same path as streamed items and are
+    never delivered twice.
+    '''
+    def __init__(self, reddit_instance: pr.Reddit, comment_stream: ShardedSubredditStream,
+                 submission_stream: ShardedSubredditStream, min_interval: float = 30,
+                 max_interval: float = 900, limit: int = 25, max_concurrent: int = 4):
+        self.reddit = reddit_instance
+        self.comment_stream = comment_stream
+        self.submission_stream = submission_stream
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.limit = limit
+        self.user_subs = {}     # user -> subreddits polled for them
+        self.activity = {}      # user -> EWMA of new items per hour
+        self._since = {}        # user -> created_utc before which items are ignored
+        self._schedule = []     # heap of (next poll time, user)
+        self._next_poll = {}    # user -> the next poll time that is still current
+        self._semaphore = asyncio.Semaphore(max_concurrent)
+        self._wakeup = asyncio.Event()
+
+    def reconfigure(self, user_subs: Dict[str, Set[str]]) -> None:
+        '''
+        Sets which users to poll, and the subreddits to keep their items from
+
+        Args:
+            user_subs (Dict[str, Set[str]]): user -> subreddits
+        '''
+        now = time.time()
+        for user in user_subs:
+            if user not in self.user_subs:
+                # Look back a little so nothing is lost while a subreddit moves off the stream
+                self._since[user] = now - self.min_interval
+                self._push(user, time.monotonic())
+        for user in set(self.user_subs) - set(user_subs):
+            self._since.pop(user, None)
+            self.activity.pop(user, None)
+            self._next_poll.pop(user, None)
+        self.user_subs = {user: set(subs) for user, subs in user_subs.items()}
+        self._wakeup.set()
+
+    def _push(self, user: str, due: float) -> None:
+        self._next_poll[user] = due
+        heapq.heappush(self._schedule, (due, user))
+
+    def interval(self, user: str) -> float:
+        '''
+        Returns:
+            float: Seconds until user should be polled again
+        '''
+        per_hour = self.activity.get(user, 0)
+        if per_hour <= 0:
+            return self.max_interval
+        return min(self.max_interval, max(self.min_interval, 3600 / per_hour))
+
+    async def _poll_listing(self, listing, subs: Set[str], since: float,
+                            stream: ShardedSubredditStream) -> Tuple[int, bool]:
+        new, count = 0, 0
+        async with REDDIT_BUDGET.request(STREAM, call=f'user_{stream.kind}'):
+            items = []
+            async for item in listing(limit=self.limit):
+                count += 1
+                if item.created_utc < since:
+                    break
+                items.append(item)
+        for item in items:
+            if item.subreddit.display_name.lower() not in subs:
+                continue
+            if await stream.inject(item):
+                new += 1
+        # Every item on the page was new, the user may have posted more than we saw
+        return new, count >= self.limit
+
+    async def poll(self, user: str) -> None:
+        '''
+        Fetches the newest comments and submissions of user
+        '''
+        subs = self.user_subs.get(user)
+        if not subs:
+            return
+        since = self._since.get(user, 0)
+        started = time.time()
+        redditor = await self.reddit.redditor(user)
+        new_comments, comments_full = await self._poll_listing(
+            redditor.comments.new, subs, since, self.comment_stream)
+        new_submissions, submissions_full = await self._poll_listing(
+            redditor.submissions.new, subs, since, self.submission_stream)
+
+        # Seen ids catch anything fetched twice, so only go back one interval next time
+        self._since[user] = started - self.min_interval
+        hours = max(self.interval(user), self.min_interval) / 3600
+        observed = (new_comments + new_submissions) / hours
+        self.activity[user] = 0.5 * observed + 0.5 * self.activity.get(user, observed)
+        if comments_full or submissions_full:
+            self.activity[user] *= 2
+
+    async def run(self) -> None:
+        while True:
+            if not self._schedule:
+                self._wakeup.clear()
+                await self._wakeup.wait()
+                continue
+
+            due, user = self._schedule[0]
+            delay = due - time.monotonic()
+            if delay > 0:
+                self._wakeup.clear()
+                try:
+                    await asyncio.wait_for(self._wakeup.wait(), delay)
+                except asyncio.TimeoutError:
+                    pass
+                continue
+
+            heapq.heappop(self._schedule)
+            if self._next_poll.get(user) == due:
+                asyncio.ensure_future(self._poll_and_reschedule(user))
+
+    async def _poll_and_reschedule(self, user: str) -> None:
+        try:
+            async with self._semaphore:
+                await self.poll(user)
+        except Exception as e:
+            log_and_print(f'Failed to poll u/{user}: {e!r}', level='error')
+        if user in self.user_subs:
+            self._push(user, time.monotonic() + self.interval(user))
+            self._wakeup.set()
+
+
+class IngestionPlanner():
+    '''
+    Decides, per subreddit, whether to stream every comment (the firehose) or to poll
+    the monitored users instead, and keeps the streams and the AuthorPoller in line
+    with that decision.
+
+    A subreddit is polled once its comment rate has been observed and the number of
+    users monitored in it per comment per minute is below max_users_per_rate, i.e.
+    few users in a busy subreddit, and no guild has keyword or regex rules there. Submissions from polled subreddits keep being
+    streamed when a guild monitors flairs there. Subreddits without monitored users
+    are never polled.
+
+    The comment rate of polled subreddits is sampled from their newest comments
+    before every replan, and a polled subreddit only goes back to streaming once
+    its users per rate reaches hysteresis times max_users_per_rate, so subreddits
+    near the threshold don't flip back and forth.
+    '''
+    def __init__(self, routing_index: RoutingIndex, comment_stream: ShardedSubredditStream,
+                 submission_stream: ShardedSubredditStream, poller: AuthorPoller,
+                 max_users_per_rate: float = 0.01, replan_interval: float = 300, hysteresis: float = 2,
+                 sample_limit: int = 100):
+        self.routing_index = routing_index
+        self.comment_stream = comment_stream
+        self.submission_stream = submission_stream
+        self.poller = poller
+        self.max_users_per_rate = max_users_per_rate
+        self.replan_interval = replan_interval
+        self.hysteresis = hysteresis
+        self.sample_limit = sample_limit
+        self.polled = set()
+
+    def should_poll(self, subreddit: str) -> bool:
+        if self.routing_index.rules.has_rules(subreddit):
+            return False # keyword rules need every comment
+        users = self.routing_index.subreddit_users(subreddit)
+        if not users:
+            return False # nobody to poll for, whatever is monitored there needs the stream
+        rate = self.comment_stream.rates.rate(subreddit)
+        if rate <= 0:
+            return False
+        threshold = self.max_users_per_rate * (self.hysteresis if subreddit in self.polled else 1)
+        return len(users) / rate < threshold
+
+    async def sample_rates(self) -> None:
+        '''
+        Measures the comment rate of the polled subreddits from their newest comments,
+        one request per `r/a+b+c` group, as they aren't seen by the comment stream
+        '''
+        rates = self.comment_stream.rates
+        for group in plan_shards(self.polled, rates, self.comment_stream.max_chars, self.comment_stream.max_rate):
+            try:
+                subreddit = await self.poller.reddit.subreddit('+'.join(group))
+                counts, oldest = {}, time.time()
+                async with REDDIT_BUDGET.request(STREAM, call='sample_rates'):
+                    async for comment in subreddit.comments(limit=self.sample_limit):
+                        sub = comment.subreddit.display_name.lower()
+                        counts[sub] = counts.get(sub, 0) + 1
+                        oldest = min(oldest, comment.created_utc)
+            except Exception as e:
+                log_and_print(f'Failed to sample the comment rates of {group}: {e!r}', level='error')
+                continue
+            minutes = max(time.time() - oldest, 60) / 60
+            for sub in group:
+                rates.sample(sub, counts.get(sub, 0) / minutes)
+
+    def replan(self) -> None:
+        '''
+        Re-evaluates every subreddit and reconfigures the streams and the poller
+        '''
+        subreddits = self.routing_index.subreddits()
+        polled = {sub for sub in subreddits if self.should_poll(sub)}
+        for sub in polled - self.polled:
+            log_and_print(f'r/{sub} switched to polling its monitored users')
+        for sub in (self.polled & subreddits) - polled:
+            log_and_print(f'r/{sub} switched back to streaming')
+        self.polled = polled
+
+        # Polled subreddits aren't observed by the stream, sample_rates() keeps their rate up to date
+        self.comment_stream.rates.frozen = polled
+        self.comment_stream.reconfigure(subreddits - polled)
+        self.submission_stream.reconfigure(
+            {sub for sub in subreddits if sub not in polled or self.routing_index.has_flairs(sub)})
+
+        user_subs = {}
+        for sub in polled:
+            for user in self.routing_index.subreddit_users(sub):
+                user_subs.setdefault(user, set()).add(sub)
+        self.poller.reconfigure(user_subs)
+
+    def on_guild_change(self, guild_id: str, guild_info: Optional[dict]) -> None:
+        '''
+        Listener for GuildsConfStore
+        '''
+        self.replan()
+
+    async def run(self) -> None:
+        poller = asyncio.ensure_future(self.poller.run())
+        try:
+            while True:
+                await asyncio.sleep(self.replan_interval)
+                await self.sample_rates()
+                self.replan()
+        finally:
+            poller.cancel()
@@ -1,27 +1,40 @@
+import time
+IMPORT_STARTED = time.perf_counter()
+
 import discord as dc
 from discord.ext import commands
 
-from typing import Any
+from typing import Any, Coroutine, Optional
 import asyncpraw as pr
-from praw import Reddit
-from prawcore import NotFound
 import sys
 import json
 import asyncio
+import functools
+import re
 import nest_asyncio
-from numpy import logical_and
-import pandas as pd
+
+from budget import REDDIT_BUDGET
+from caches import EnrichmentCache, RedditLookups
+from checkpoint import StreamCheckpoint, backfill
+from config_store import open_guilds_conf_store
+from digest import DELIVERY_MODES, DIGEST_FORMATS, paginate
+from dispatcher import DiscordDispatcher
+from gateway import ShardHealth, open_discord_bot
+from ingestion import AuthorPoller, IngestionPlanner
+import metrics
+from outbox import NotificationOutbox
+from pipeline import NotificationPipeline
+from replay import KINDS, StreamRecorder
+from routing import RoutingIndex
+from rules import KEYWORD_RULES, REGEX_RULES, REGEX_SANDBOX, normalize_keyword, validate_regex
+from streams import ShardedSubredditStream
+from tracing import HotPathProfiler, Tracer
+from utils import log_and_print, setup_logging, read_config_file
+from workers import Coordinator
 
 # Datetime packages
 from datetime import datetime as dt
-from datetime import timedelta, tzinfo, date
-from datetime import datetime as dt
-# from datetime import timedelta
-# from dateutil import parser
-# from dateutil.parser import parse
-from dateutil.tz import gettz
 from typing import Collection, Union
-import logging as log
 import os
 
 # Debugging async stuff
@@ -73,9 +86,9 @@ class RedDiscConsts():
                 self.reddit_username = input('Enter the reddit_username: ')
                 log_and_print(self.ENVVAR_NOT_SET)  
             
-    def init_discord_bot(self) -> dc.Client:
-        # Initialize a Discord client
-        disc_bot = commands.Bot(command_prefix=self.COMMAND_PREFIX, intents = self.intents)
+    def init_discord_bot(self, discord_settings: dict) -> dc.Client:
+        # Initialize a Discord client, sharded unless turned off in config.json
+        disc_bot = open_discord_bot(self.COMMAND_PREFIX, self.intents, discord_settings)
         return disc_bot
 
     def init_reddit_bot(self) -> pr.Reddit:
@@ -97,74 +110,7 @@ class RedDiscConsts():
             
         return reddit
 
-def log_and_print(message: str, level: str = 'info', terminal_print: bool = True) -> None:
-    '''
-    str, str -> None
-    
-    Custom function for logging and printing a message. Function doesn't output anything.
-    Possible levels:
-    - debug
-    - info
-    - warning
-    - error
-    - critical
-    '''
-    
-    if terminal_print:
-        print(message)
-    
-    # Encode emojis differently    
-    log_message = message#.encode('unicode_escape') # No longer required
-    if level == 'debug':
-        log.debug(log_message)
-    elif level == 'info':
-        log.info(log_message)
-    elif level == 'warning':
-        log.warning(log_message)
-    elif level == 'error':
-        log.error(log_message)
-    elif level == 'critical':
-        log.critical(log_message)
-        
-def utc_str_now() -> str:
-    '''
-    Returns the current time in UTC
-
-    Returns:
-        str: The current datetime
-    '''
-    return str(dt.utcnow()) + ' UTC' 
-        
-def read_config_file(config_dir: str) -> dict:
-    '''
-    Reads in the given ...config.json file
-
-    Args:
-        config_dir (str): File path to the ...config.json file
-
-    Returns:
-        dict: Contains the configuration parameters for the bot
-    '''
-    
-    with open(config_dir) as fp:
-        config_dict = json.load(fp)
-    
-    return config_dict
-
-def update_config_file(config_dir: str, config_dict: dict) -> None:
-    '''
-    Updates the ...config.json file using config_dict
-
-    Args:
-        config_dir (str): File path to the ...config.json file
-        config_dict (dict): Dictionary containing the config settings for the bot
-    '''
-
-    config_dict['last_modified_time'] = utc_str_now()
-    with open(config_dir, mode = 'w') as fp:
-        json.dump(config_dict, fp)   
-        
-def read_csv_set_idx(csv_file_path: str, idx_keys: Union[str, list] = None) -> pd.DataFrame:
+def read_csv_set_idx(csv_file_path: str, idx_keys: Union[str, list] = None) -> 'pd.DataFrame':
     '''
     Reads in a csv as a Pandas Dataframe and sets the index to idx_keys
 
@@ -177,13 +123,14 @@ def read_csv_set_idx(csv_file_path: str, idx_keys: Union[str, list] = None) -> p
     Returns:
         pd.DataFrame: Dataframe with it's index set to idx_keys
     '''
+    import pandas as pd # Only needed here, and slow to import
     if idx_keys is None:
         df = pd.read_csv(csv_file_path)
     else:
         df = pd.read_csv(csv_file_path).set_index(idx_keys)
     return df
 
-def return_awaited_value(coroutine: asyncio.coroutine) -> Any:
+def return_awaited_value(coroutine: Coroutine) -> Any:
   
     loop = asyncio.get_event_loop()
     result = loop.run_until_complete(coroutine)
@@ -191,31 +138,6 @@ def return_awaited_value(coroutine: asyncio.coroutine) -> Any:
     # Use the line below in debug console
     # result = return_awaited_value(x)
         
-def sub_exists(sub) -> bool:
-    bot_config = read_config_file(RedDiscConsts().config_path)
-    bot_username = bot_config['metadata']['reddit_username']
-    exists = True
-    try:
-        Reddit(bot_username).subreddits.search_by_name(sub, exact=True)
-    except NotFound:
-        exists = False
-    return exists   
-     
-def user_exists(username) -> bool:
-    bot_config = read_config_file(RedDiscConsts().config_path)
-    bot_username = bot_config['metadata']['reddit_username']
-    return not(Reddit(bot_username).username_available(username))
-
-def sub_flairs(sub) -> list:
-    bot_config = read_config_file(RedDiscConsts().config_path)
-    bot_username = bot_config['metadata']['reddit_username']
-    response = list(Reddit(bot_username).subreddit(sub).flair.link_templates)
-    flairs = []
-    for fl_dict in response:
-        flairs.append(fl_dict['text'])
-
-    return flairs   
-
 def return_monitored_subreddits(comments) -> str:
     return comments.ag_frame.f_locals['function'].subreddit.display_name
     
@@ -239,166 +161,418 @@ def create_repair_files(bot_config: dict):
             
             log_and_print(f'{fpath} created')
             
-def red_monitoring_update(obj_type: str) -> dict:
-    assert_msg = "`obj_type` must be one of ['subreddits', 'flairs', 'users']"
-    assert obj_type in ['subreddits', 'flairs', 'users'], assert_msg
-    
-    # Load config file
-    rdc = RedDiscConsts()
-    config_path = rdc.config_path
-    bot_config = read_config_file(config_path)
-    guilds_conf = read_config_file(bot_config['dir_paths']['guilds_conf'])
-    
-    strs_to_monitor = {}
-    for srv in guilds_conf:
-        if srv == 'last_modified_time':
-            continue 
-        else:
-            # for k in guilds_conf[srv]:
-            if obj_type == 'users':
-                users = set(guilds_conf[srv]['users_to_monitor'])
-                for usr in users:
-                    if usr not in strs_to_monitor:
-                        strs_to_monitor[usr] = []
-                    strs_to_monitor[usr].append(srv)
-            else:
-                subreddits = set(guilds_conf[srv]['subreddits_to_monitor'].keys())
-                
-                for sub in subreddits:
-                    if obj_type == 'subreddits':
-                        if sub not in strs_to_monitor:
-                            strs_to_monitor[sub] = []
-                        strs_to_monitor[sub].append(srv)
-                    else:
-                        flairs = set(guilds_conf[srv]['subreddits_to_monitor'][sub]['flairs_to_monitor'])
-                        for fl in flairs:
-                            if fl not in strs_to_monitor:
-                                strs_to_monitor[fl] = []
-                            strs_to_monitor[fl].append(srv)
-                    
-    return strs_to_monitor
-                    
-async def monitor_new_comments(reddit_instance: pr.Reddit, discord_instance: commands.Bot):
-    # Load config file and necessary variables
-    rdc = RedDiscConsts()
-    config_path = rdc.config_path
-    bot_config = read_config_file(config_path)
-    pause_after = bot_config['static_settings']['pause_after']
-    idle_time = bot_config['static_settings']['idle_time']
-    guilds_conf = read_config_file(bot_config['dir_paths']['guilds_conf'])
-    guilds_conf_lmt = guilds_conf['last_modified_time']
-       
-    # Extract the subreddits to monitor
-    subreddits_to_monitor = red_monitoring_update('subreddits')
-    print('Monitoring the following subreddits:')
-    for sub in subreddits_to_monitor:
-        print(f'- {sub}')
-    subreddits_to_monitor = '+'.join(subreddits_to_monitor)
+def open_subreddit_stream(reddit_instance: pr.Reddit, subreddits: Collection[str], 
+                          kind: str, bot_config: dict) -> ShardedSubredditStream:
+    '''
+    Creates a sharded comment or submission stream using the settings in config.json
+
+    Args:
+        reddit_instance (pr.Reddit): The shared Reddit client
+        subreddits (Collection[str]): The subreddits to stream from
+        kind (str): 'comments' or 'submissions'
+        bot_config (dict): The contents of config.json
+
+    Returns:
+        ShardedSubredditStream: The (not yet started) stream
+    '''
+    static_settings = bot_config['static_settings']
+    stream_settings = bot_config['stream_settings']
+    return ShardedSubredditStream(reddit_instance, subreddits, 
+                                  cadence_settings=bot_config['poll_cadence_settings'], 
+                                  skip_existing=static_settings['skip_existing'],
+                                  max_chars=stream_settings['max_shard_chars'],
+                                  max_rate=stream_settings['max_shard_rate'],
+                                  queue_size=stream_settings['queue_size'],
+                                  idle_timeout=static_settings['idle_time'],
+                                  rebalance_interval=stream_settings['rebalance_interval'],
+                                  kind=kind)
+
+async def monitor_new_comments(comments: ShardedSubredditStream, pipeline: NotificationPipeline, 
+                               enrichment_cache: EnrichmentCache, dispatcher: Optional[DiscordDispatcher],
+                               checkpoint: StreamCheckpoint, recorder: Optional[StreamRecorder] = None):
+    # The subreddits to stream are kept up to date by the IngestionPlanner
+    log_and_print('Monitoring the following subreddits:')
+    for sub in comments.subreddits:
+        log_and_print(f'- {sub}')
                 
-    # Monitor comments loop
+    # Monitor comments loop, everything after ingestion happens in the pipeline
     log_and_print('Monitoring Reddit comments')
-    subreddit = await reddit_instance.subreddit(subreddits_to_monitor)
-    comments = subreddit.stream.comments(skip_existing = True, pause_after=pause_after)
+    comment_count = 0
     async for comment in comments: 
         if comment is None:
-            guilds_conf = read_config_file(bot_config['dir_paths']['guilds_conf'])
-            if guilds_conf_lmt != guilds_conf['last_modified_time']:
-                subreddits_to_monitor = red_monitoring_update('subreddits')
-                log_and_print('Update - now monitoring the following subreddits:')
-                for sub in subreddits_to_monitor:
-                    log_and_print(f'- {sub}')
-                subreddits_to_monitor = '+'.join(subreddits_to_monitor)
-                comments = subreddit.stream.comments(skip_existing = True, pause_after=2)
-                guilds_conf_lmt = guilds_conf['last_modified_time']
-                
-            log_and_print('No comment detected. Starting idle')
-            await asyncio.sleep(idle_time)
+            log_and_print('No comment detected. Starting idle', level='debug', terminal_print=False)
             continue
         
-        comment_url = comment.link_permalink + comment.id
-        author_ori = comment.author.name
-        author = author_ori.lower()
-        body = comment.body
-        log_and_print(f'New comment detected: {comment_url}')
-        
-        # Check if user is on monitor list
-        monitored_users = red_monitoring_update('users')
-        if author in monitored_users:
-            srvs_to_send = monitored_users[author].copy()
-            from_sub_ori = comment.subreddit.display_name
-            from_sub = from_sub_ori.lower()
-            for i in srvs_to_send:
-                if from_sub not in guilds_conf[i]['subreddits_to_monitor']:
-                    srvs_to_send.remove(i)
-            
-            # Send the comment to servers listed in srvs_to_send
-            submission = comment.submission
-            await submission.load()
-            msg_body = f'**__r/{from_sub_ori}__**:\n'
-            msg_body += f'New comment from __u/{author_ori}__ on a post titled **{submission.title}**:\n'
-            body = body.replace('\n', '\n> ')
-            msg_body += f'> {body}'
-            msg_body += '\n'
-            
-            # Send parent comment too
-            parent = await comment.parent()
-            await parent.load()
-            if type(parent) == pr.models.reddit.comment.Comment:
-                msg_body += f'This was a reply to __u/{parent.author.name}__ who said:\n'
-                replied_to_body = parent.body
-                replied_to_body = replied_to_body.replace('\n', '\n> ')
-                msg_body += f'> {replied_to_body}'
-                msg_body += '\n'
-            else:
-                msg_body += f'This was a reply to the original post\n'
-            
-            msg_body += f'{comment_url}\n'
-            dc_bot = discord_instance
-            for srv in srvs_to_send:
-                chan_id = int(guilds_conf[srv]['notification_channel'])
-                channel = dc_bot.get_channel(int(chan_id))
-                await channel.send(msg_body)
-        
-        # x = comment.parent()
-        # import ipdb; ipdb.set_trace()
-        # import pdb; pdb.set_trace()
-        # return_awaited_value(x)
-        print('')
+        # Any comment could be the parent of a reply from a monitored user
+        enrichment_cache.remember_comment(comment)
+        comment_count += 1
+        if comment_count % 1000 == 0:
+            log_and_print(f'Enrichment cache stats: {enrichment_cache.stats()}', terminal_print=False)
+            log_and_print(f'Pipeline queue depths: {pipeline.queue_depths()}', terminal_print=False)
+            if dispatcher is not None: # None in a worker process
+                log_and_print(f'Delivery latency: {dispatcher.latency_stats()}', terminal_print=False)
+        
+        log_and_print(f'New comment detected: {comment.link_permalink}{comment.id}', 
+                      level='debug', terminal_print=False)
+        if recorder is not None:
+            recorder.record('comment', comment)
+        # The checkpoint moves past it once the pipeline is done with it
+        checkpoint.begin('comments', comment)
+        await pipeline.ingest('comment', comment, comments.last_source)
+
+async def monitor_new_submissions(submissions: ShardedSubredditStream, pipeline: NotificationPipeline, 
+                                  enrichment_cache: EnrichmentCache, checkpoint: StreamCheckpoint,
+                                  recorder: Optional[StreamRecorder] = None):
+    # Monitor submissions loop
+    log_and_print('Monitoring Reddit submissions')
+    async for submission in submissions:
+        if submission is None:
+            log_and_print('No submission detected. Starting idle', level='debug', terminal_print=False)
+            continue
+        enrichment_cache.remember_submission(submission)
+        
+        log_and_print(f'New submission detected: https://www.reddit.com{submission.permalink}',
+                      level='debug', terminal_print=False)
+        if recorder is not None:
+            recorder.record('submission', submission)
+        checkpoint.begin('submissions', submission)
+        await pipeline.ingest('submission', submission, submissions.last_source)
+
+class RedditMonitor():
+    '''
+    The Reddit side of the bot: comment and submission streams, user polling, the
+    stream checkpoint, enrichment and the notification pipeline, covering whatever
+    routing_index monitors. Runs in the bot's process, or in each worker process 
+    in coordinator/worker mode.
+
+    Args:
+        red_bot (pr.Reddit): The Reddit client
+        routing_index (RoutingIndex): What to monitor and who to notify
+        bot_config (dict): The contents of config.json
+        send (Callable): Coroutine function the pipeline hands notifications to, 
+                         called with (srvs_to_send, msg_body, received)
+        checkpoint_path (str): Where the stream checkpoint is kept
+        record_path (str, optional): Where to record the streamed items for replay, None to not record
+        trace_path (str, optional): Where to write the traces of slow and sampled items, None to not trace
+    '''
+    def __init__(self, red_bot: pr.Reddit, routing_index: RoutingIndex, bot_config: dict, 
+                 send, checkpoint_path: str, record_path: Optional[str] = None, trace_path: Optional[str] = None):
+        self.red_bot = red_bot
+        self.bot_config = bot_config
+        
+        # Streams and user polling, the planner decides which subreddits go where 
+        # and is told about config changes after the routing index has been updated
+        self.comment_stream = open_subreddit_stream(red_bot, [], 'comments', bot_config)
+        self.submission_stream = open_subreddit_stream(red_bot, [], 'submissions', bot_config)
+        self.streams = [self.comment_stream, self.submission_stream]
+        poll_settings = bot_config['author_poll_settings']
+        self.poller = AuthorPoller(red_bot, self.comment_stream, self.submission_stream, 
+                                   min_interval=poll_settings['min_interval'],
+                                   max_interval=poll_settings['max_interval'],
+                                   limit=poll_settings['limit'],
+                                   max_concurrent=poll_settings['max_concurrent'])
+        self.planner = IngestionPlanner(routing_index, self.comment_stream, self.submission_stream, self.poller,
+                                        max_users_per_rate=poll_settings['max_users_per_rate'],
+                                        replan_interval=poll_settings['replan_interval'],
+                                        hysteresis=poll_settings['hysteresis'],
+                                        sample_limit=poll_settings['sample_limit'])
+        self.planner.replan()
+        
+        # Pick up where the last run stopped: restore the seen ids and backfill 
+        # whatever was posted while the bot was down before streaming
+        checkpoint_settings = bot_config['checkpoint_settings']
+        self.checkpoint = StreamCheckpoint(checkpoint_path, max_seen_ids=checkpoint_settings['max_seen_ids'])
+        self.checkpoint.load()
+        for kind, stream in [('comments', self.comment_stream), ('submissions', self.submission_stream)]:
+            self.checkpoint.attach(kind, stream.seen_ids)
+            if kind in self.checkpoint.restored:
+                stream.backfill_first(functools.partial(backfill, red_bot, kind=kind, 
+                                                        checkpoint=self.checkpoint.restored[kind],
+                                                        max_items=checkpoint_settings['backfill_max_items'],
+                                                        max_age=checkpoint_settings['backfill_max_age'],
+                                                        max_chars=bot_config['stream_settings']['max_shard_chars']),
+                                      since=self.checkpoint.restored[kind]['created_utc'])
+        
+        # Submissions and parent comments fetched for notifications
+        cache_settings = bot_config['cache_settings']
+        self.enrichment_cache = EnrichmentCache(max_items=cache_settings['max_items'], ttl=cache_settings['ttl'])
+        
+        # Every item's way through the pipeline can be timed, slow ones are written out
+        trace_settings = bot_config['trace_settings']
+        self.tracer = Tracer(trace_path, slow_threshold=trace_settings['slow_threshold'],
+                             sample_rate=trace_settings['sample_rate']) if trace_path is not None else None
+        
+        # Matching, enrichment and sending run in their own workers
+        pipeline_settings = bot_config['pipeline_settings']
+        self.pipeline = NotificationPipeline(routing_index, self.enrichment_cache, send,
+                                             workers=pipeline_settings['workers'],
+                                             queue_sizes=pipeline_settings['queue_sizes'],
+                                             max_selftext=bot_config['static_settings']['max_selftext_chars'],
+                                             tracer=self.tracer, on_done=self.on_done,
+                                             max_retries=pipeline_settings['max_retries'],
+                                             retry_delay=pipeline_settings['retry_delay'])
+        
+        # Everything streamed can be recorded, to be replayed offline by benchmarks/replay_pipeline.py
+        self.recorder = StreamRecorder(record_path) if record_path is not None else None
+    
+    def on_done(self, kind: str, item) -> None:
+        self.checkpoint.done(KINDS[kind], item)
+    
+    async def take_over(self, positions: dict) -> None:
+        '''
+        Backfills subreddits taken over from another worker from where that worker
+        had got to, so nothing posted while they changed hands is missed. Items
+        already delivered by the streams are dropped by their seen ids.
+
+        Args:
+            positions (dict): subreddit -> {'comments': created_utc, 'submissions': created_utc}
+        '''
+        checkpoint_settings = self.bot_config['checkpoint_settings']
+        for kind, stream in [('comments', self.comment_stream), ('submissions', self.submission_stream)]:
+            since = [position[kind] for position in positions.values() if position.get(kind) is not None]
+            if not since:
+                continue
+            try:
+                missed = await backfill(self.red_bot, sorted(positions), kind, {'last': None, 'created_utc': min(since)},
+                                        max_items=checkpoint_settings['backfill_max_items'],
+                                        max_age=checkpoint_settings['backfill_max_age'],
+                                        max_chars=self.bot_config['stream_settings']['max_shard_chars'])
+            except Exception as e:
+                log_and_print(f'Failed to backfill the {kind} of {len(positions)} taken over subreddits: {e!r}', 
+                              level='error')
+                continue
+            injected = 0
+            for item in missed:
+                injected += await stream.inject(item)
+            log_and_print(f'Backfilled {injected} {kind} of {len(positions)} taken over subreddits')
+    
+    def caches(self) -> dict:
+        return {'submissions': self.enrichment_cache.submissions, 'parents': self.enrichment_cache.parents}
+    
+    def coroutines(self, dispatcher: Optional[DiscordDispatcher] = None) -> list:
+        '''
+        Returns:
+            list: The coroutines that keep the monitoring running, to be scheduled as tasks
+        '''
+        coroutines = [
+            monitor_new_comments(self.comment_stream, self.pipeline, self.enrichment_cache, dispatcher, 
+                                 self.checkpoint, self.recorder),
+            monitor_new_submissions(self.submission_stream, self.pipeline, self.enrichment_cache, 
+                                    self.checkpoint, self.recorder),
+            self.checkpoint.run(self.bot_config['checkpoint_settings']['save_interval']),
+            self.planner.run(),
+        ]
+        if self.recorder is not None:
+            coroutines.append(self.recorder.run(self.bot_config['replay_settings']['flush_interval']))
+        if self.tracer is not None:
+            coroutines.append(self.tracer.run(self.bot_config['trace_settings']['flush_interval']))
+        return coroutines
+
+def register_gauges(streams: Collection[ShardedSubredditStream], pipeline: Optional[NotificationPipeline], 
+                    dispatcher: Optional[DiscordDispatcher], caches: dict) -> None:
+    '''
+    Exposes queue depths, cache hit rates and shard polling cadence as metrics gauges
+
+    Args:
+        streams (Collection[ShardedSubredditStream]): The comment and submission streams
+        pipeline (NotificationPipeline, optional): The notification pipeline, None in the coordinator
+        dispatcher (DiscordDispatcher, optional): The Discord dispatcher, None in a worker
+        caches (dict): name -> TTLCache
+    '''
+    def queue_depths():
+        depths = {}
+        if pipeline is not None:
+            depths.update({(stage,): depth for stage, depth in pipeline.queue_depths().items()})
+        if dispatcher is not None:
+            depths[('dispatch_channels',)] = dispatcher.queue_depth()
+        for stream in streams:
+            depths[(f'{stream.kind}_stream',)] = stream.queue.qsize()
+        return depths
+    def poll_intervals():
+        return {(stream.kind, shard['shard']): shard['poll_interval'] 
+                for stream in streams for shard in stream.describe()}
+    
+    metrics.REGISTRY.gauge('reddisc_queue_depth', 'Items waiting in each queue', ['queue'], queue_depths)
+    metrics.REGISTRY.gauge('reddisc_cache_hit_ratio', 'Hit rate of each cache', ['cache'],
+                           lambda: {(name,): cache.hit_rate() for name, cache in caches.items()})
+    metrics.REGISTRY.gauge('reddisc_cache_items', 'Entries in each cache', ['cache'],
+                           lambda: {(name,): len(cache) for name, cache in caches.items()})
+    metrics.REGISTRY.gauge('reddisc_shard_poll_interval_seconds', 'Current poll interval of each shard', 
+                           ['kind', 'shard'], poll_intervals)
+
+def stats_summary(streams: Collection[ShardedSubredditStream], pipeline: Optional[NotificationPipeline], 
+                  dispatcher: DiscordDispatcher, caches: dict, coordinator: Optional[Coordinator] = None,
+                  shard_health: Optional[ShardHealth] = None, routing_index: Optional[RoutingIndex] = None,
+                  outbox: Optional[NotificationOutbox] = None) -> str:
+    '''
+    Summarises the metrics for the $stats command. In coordinator/worker mode the
+    stream and Reddit API numbers live in the workers (and their metrics endpoints),
+    so only the workers' partitions are listed instead.
+
+    Returns:
+        str: The reply, formatted for Discord
+    '''
+    registry = metrics.REGISTRY.metrics
+    ingested = registry['reddisc_items_ingested_total']
+    matched = registry['reddisc_items_matched_total']
+    lag = registry['reddisc_ingest_lag_seconds']
+    api = metrics.REDDIT_API_LATENCY
+    fmt = lambda value: '-' if value is None else f'{value:.2f}s'
+    
+    reply_msg = '**Streams**\n'
+    if coordinator is not None:
+        for worker in coordinator.describe():
+            reply_msg += f'- worker {worker["worker"]}: {worker["subreddits"]} subreddit(s)\n'
+        reply_msg += f'- {coordinator.notifications} notifications received from workers\n'
+    for stream in streams:
+        kind = stream.kind
+        reply_msg += f'- {kind}: {ingested.total(kind=kind):.0f} ingested, '
+        reply_msg += f'{matched.total(kind=kind[:-1]):.0f} matched, '
+        reply_msg += f'lag p50 {fmt(lag.quantile(0.5, kind=kind))} / p99 {fmt(lag.quantile(0.99, kind=kind))}, '
+        reply_msg += f'{len(stream.shards)} shard(s)\n'
+    reply_msg += '**Reddit API**\n'
+    headroom = REDDIT_BUDGET.headroom()
+    if headroom['remaining'] is not None:
+        reply_msg += f'- {headroom["remaining"]} requests left, window resets in {headroom["reset_in"]:.0f}s '
+        reply_msg += f'({headroom["sustainable_rate"] or 0:.2f}/s sustainable)\n'
+    waiting = ', '.join(f'{count} {name}' for name, count in headroom['waiting'].items() if count)
+    reply_msg += f'- {headroom["in_flight"]} in flight, waiting: {waiting or "none"}\n'
+    for (call,), series in sorted(api.series.items()):
+        reply_msg += f'- {call}: {series[2]} calls, p50 {fmt(api.quantile(0.5, call=call))} / '
+        reply_msg += f'p99 {fmt(api.quantile(0.99, call=call))}\n'
+    latency = dispatcher.latency_stats()
+    reply_msg += '**Discord**\n'
+    reply_msg += f'- {latency["count"]} notifications, p50 {fmt(latency.get("p50"))} / '
+    reply_msg += f'p99 {fmt(latency.get("p99"))}, {dispatcher.rate_limited} rate limited\n'
+    if outbox is not None:
+        outbox_stats = outbox.stats()
+        reply_msg += f'- outbox: {outbox_stats["pending"]} pending, {outbox_stats["retried"]} retried\n'
+    if shard_health is not None:
+        send_latency = registry['reddisc_discord_send_seconds']
+        for shard in shard_health.describe():
+            state = 'up' if shard['connected'] else '**down**'
+            reply_msg += f'- shard {shard["shard"]}: {state}, {shard["guilds"]} guild(s), '
+            reply_msg += f'heartbeat {fmt(shard["latency"])}, '
+            reply_msg += f'send p99 {fmt(send_latency.quantile(0.99, shard=shard["shard"]))}\n'
+    if routing_index is not None:
+        rules = routing_index.rules.stats()
+        reply_msg += f'**Rules**\n- {rules["keywords"]} keyword(s), {rules["regexes"]} regex(es)\n'
+    reply_msg += '**Caches**\n'
+    for name, cache in caches.items():
+        reply_msg += f'- {name}: {cache.hit_rate():.0%} hits, {len(cache)} items\n'
+    pipeline_depths = pipeline.queue_depths() if pipeline is not None else {}
+    reply_msg += f'**Queues**\n- {pipeline_depths}, channels: {dispatcher.queue_depth()}\n'
+    if pipeline is not None and pipeline.tracer is not None:
+        traces = pipeline.tracer.stats()
+        reply_msg += f'**Traces**\n- {traces["finished"]} finished, {traces["slow"]} slow, '
+        reply_msg += f'{traces["written"]} written to {pipeline.tracer.path}\n'
+    return reply_msg
 
 def main():
-    # red_monitoring_update('flairs')
+    startup = metrics.StartupTimer(IMPORT_STARTED)
+    startup.mark('import')
     
     rdc = RedDiscConsts(True)
+    deci_config = read_config_file(rdc.config_path)
     
-    # Initialize Discord Bot
-    bot = rdc.init_discord_bot()
+    # Initialize Discord Bot, shard health is tracked from the gateway events
+    bot = rdc.init_discord_bot(deci_config['discord_settings'])
+    shard_health = ShardHealth(bot)
     disc_bot_token = rdc.disc_bot_token
     
     # Initialize Reddit Bot
     red_bot = rdc.init_reddit_bot()
         
-    # Configure logging
-    root_logger= log.getLogger()
-    root_logger.setLevel(log.DEBUG) 
-    today = str(date.today())
-    deci_config = read_config_file(rdc.config_path)
-    log_file_path = deci_config["dir_paths"]["log_file_dir"] + f"/rnd_log_{today}.log"
-    handler = log.FileHandler(log_file_path, 
-                            mode = 'a', 
-                            encoding = 'utf-8',
-                            ) 
-    # handler.setStream(sys.stderr)
-    handler.setFormatter(log.Formatter('%(asctime)s [%(levelname)s]: %(message)s'))
-    root_logger.addHandler(handler)   
-    root_logger.removeHandler(root_logger.handlers[0])   
+    # Configure logging, files are written (and rotated) by a background thread
+    logging_settings = deci_config['logging_settings']
+    setup_logging(deci_config["dir_paths"]["log_file_dir"], 
+                  level=logging_settings['level'],
+                  retention_days=logging_settings['retention_days'],
+                  terminal_echo=logging_settings['terminal_echo'],
+                  module_levels=logging_settings['module_levels'])
         
     ## Load config.json
     with open('config.json') as f:
         bot_config = json.load(f)
+    
+    # Every Reddit request goes through the shared budget, which follows the 
+    # rate limit headers and lets the streams go ahead of everything else
+    REDDIT_BUDGET.configure(**bot_config['budget_settings'])
+    REDDIT_BUDGET.attach(red_bot)
+    
+    # Regex rules are matched in their own processes, with a time budget
+    rule_settings = bot_config['rule_settings']
+    REGEX_SANDBOX.configure(processes=rule_settings['regex_processes'], timeout=rule_settings['regex_timeout'])
         
     # Create/repair missing files
     create_repair_files(bot_config)
     
+    # Load the guilds config and build the routing index once, 
+    # every committed change to the store is pushed into the index
+    guilds_store = open_guilds_conf_store(bot_config)
+    routing_index = RoutingIndex.from_guilds_conf(guilds_store.guilds_conf)
+    guilds_store.add_listener(routing_index.apply)
+    
+    # Existence checks and flair templates for the commands, answered from cache when possible
+    cache_settings = bot_config['cache_settings']
+    lookups = RedditLookups(red_bot, max_items=cache_settings['max_items'], ttl=cache_settings['lookup_ttl'],
+                            max_concurrent=bot_config['bulk_settings']['max_concurrent_lookups'])
+    
+    # Notifications are fanned out to the channels by the dispatcher
+    dispatch_settings = bot_config['dispatch_settings']
+    dispatcher = DiscordDispatcher(bot, 
+                                   global_rate=dispatch_settings['global_rate'],
+                                   global_per=dispatch_settings['global_per'],
+                                   channel_rate=dispatch_settings['channel_rate'],
+                                   channel_per=dispatch_settings['channel_per'],
+                                   max_retries=dispatch_settings['max_retries'],
+                                   channel_queue_size=dispatch_settings['channel_queue_size'],
+                                   shard_health=shard_health,
+                                   shard_wait=bot_config['discord_settings']['shard_wait'])
+    # Guilds can choose to get their notifications as periodic digests
+    for guild_id, guild_info in guilds_store.guilds_conf.items():
+        if isinstance(guild_info, dict):
+            dispatcher.on_guild_change(guild_id, guild_info)
+    guilds_store.add_listener(dispatcher.on_guild_change)
+    
+    # Notifications are stored before they are sent, and retried until they go out
+    outbox_settings = bot_config['outbox_settings']
+    if outbox_settings['enabled']:
+        outbox = NotificationOutbox(outbox_settings['path'], dispatcher, 
+                                    retry_base=outbox_settings['retry_base'],
+                                    retry_max=outbox_settings['retry_max'],
+                                    max_age=outbox_settings['max_age'],
+                                    keep_finished=outbox_settings['keep_finished'])
+        send = outbox.send
+    else:
+        outbox = None
+        send = dispatcher.send
+    
+    # Either monitor Reddit in this process, or partition the subreddits across 
+    # worker processes that send their notifications back to the dispatcher
+    worker_settings = bot_config['worker_settings']
+    if worker_settings['workers'] > 0:
+        monitor = None
+        coordinator = Coordinator(worker_settings['socket_path'], send, lambda: guilds_store.guilds_conf)
+        guilds_store.add_listener(coordinator.on_guild_change)
+    else:
+        coordinator = None
+        replay_settings = bot_config['replay_settings']
+        trace_settings = bot_config['trace_settings']
+        monitor = RedditMonitor(red_bot, routing_index, bot_config, send, 
+                                bot_config['dir_paths']['stream_checkpoint'],
+                                replay_settings['record_path'] if replay_settings['record'] else None,
+                                trace_settings['path'] if trace_settings['enabled'] else None)
+        guilds_store.add_listener(monitor.planner.on_guild_change)
+    
+    # Metrics for the endpoint and $stats
+    streams = monitor.streams if monitor is not None else []
+    pipeline = monitor.pipeline if monitor is not None else None
+    caches = monitor.caches() if monitor is not None else {}
+    caches.update({'subreddit_lookups': lookups.subreddits, 'user_lookups': lookups.users, 
+                   'flair_lookups': lookups.flairs})
+    register_gauges(streams, pipeline, dispatcher, caches)
+    
     # Discord commands
     @bot.event
     async def on_ready():
@@ -406,21 +580,16 @@ def main():
         This function executes when turned on if it was off before
         '''
         log_and_print(f'Logged in as {bot.user}', terminal_print=True)
+        startup.mark('gateway_ready')
         
     @bot.event
     async def on_guild_join(guild):
         '''
         This function executes when invited to a new server.
         
-        Adds the server to guilds_conf.json
+        Adds the server to the guilds config
         '''
         
-        # Read in the necessary variables from rnd_config
-        rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
-        
         guild_id = str(guild.id)
         guild_info = {
             'name': guild.name,
@@ -428,31 +597,73 @@ def main():
             'subreddits_to_monitor': {}, # This will contain flairs_to_monitor
             'users_to_monitor': []
         }
-        guilds_conf[guild_id] = guild_info
-        update_config_file(guilds_config_path, guilds_conf)
-        log_and_print(f'Added to `{guild.name}`')
+        await guilds_store.put_guild(guild_id, guild_info)
+        log_and_print(f'Added to `{guild.name}` (shard {guild.shard_id})')
         
     @bot.event
     async def on_guild_remove(guild):
         '''
         This function executes when removed from a server.
         
-        Removes the server from guilds_conf.json
+        Removes the server from the guilds config
         '''
         
-        # Read in the necessary variables from rnd_config
-        rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
-        
         guild_id = str(guild.id)
-        popped_guild = guilds_conf.pop(guild_id)
-        popped_guild_name = popped_guild['name']
-        update_config_file(guilds_config_path, guilds_conf)  
+        popped_guild = await guilds_store.remove_guild(guild_id)
+        popped_guild_name = popped_guild['name'] if popped_guild else guild.name
         
         log_and_print(f'Removed from `{popped_guild_name}`')        
     
+    @bot.command(brief = 'Shows monitoring statistics (bot owner only)')
+    @commands.is_owner()
+    async def stats(ctx):
+        '''
+        Replies with a summary of the monitoring pipeline's metrics
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+        '''
+        log_and_print(f'stats() was called by {ctx.author.name}')
+        await ctx.reply(stats_summary(streams, pipeline, dispatcher, caches, coordinator, shard_health, 
+                                      routing_index, outbox)[:2000])
+
+    profiler = HotPathProfiler(bot_config['trace_settings']['profile_dir'])
+
+    @bot.command(brief = 'Starts or stops profiling the bot (bot owner only)')
+    @commands.is_owner()
+    async def profile(ctx, action: str = 'status', engine: str = 'cprofile'):
+        '''
+        Profiles this process while it keeps running, with cProfile or (if it is
+        installed) pyinstrument. In coordinator/worker mode that is the coordinator,
+        which sends the notifications. The monitoring itself can be profiled 
+        offline with benchmarks/replay_pipeline.py --profile.
+
+        Replies with the profile's file and its hottest functions once stopped
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            action (str, optional): `start`, `stop` or `status`
+            engine (str, optional): `cprofile` or `pyinstrument`
+        '''
+        log_and_print(f'profile(action={action}, engine={engine}) was called by {ctx.author.name}')
+        action = action.lower()
+        try:
+            if action == 'start':
+                profiler.start(engine.lower())
+                reply_msg = f'Started a {profiler.engine} profile, stop it with `profile stop`'
+            elif action == 'stop':
+                path, summary = profiler.stop()
+                reply_msg = f'Wrote the profile to `{path}`\n'
+                reply_msg += f'```\n{summary.strip()[:1900 - len(reply_msg)]}\n```'
+            elif action == 'status':
+                reply_msg = f'A {profiler.engine} profile is running' if profiler.running else 'Not profiling'
+            else:
+                reply_msg = f'Unknown action `{action}`, use one of: start, stop, status'
+        except RuntimeError as e:
+            reply_msg = str(e)
+        await ctx.reply(reply_msg)
+        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+
     @bot.command()
     async def echo(ctx, *text_to_echo: str):
         '''
@@ -467,6 +678,52 @@ def main():
         await ctx.reply(text_to_echo)
         log_and_print(f'Replied to {ctx.author.name} with: \n{text_to_echo}')
         
+    @bot.command(brief = 'Sets immediate or digest delivery of notifications')
+    async def delivery(ctx, mode: str, window: float = None, max_items: int = None, digest_format: str = None):
+        '''
+        Switches between sending every notification as soon as it's matched and 
+        collecting them into digests sent every `window` seconds (or once 
+        `max_items` are waiting), as embeds or as plain text.
+        
+        Replies with a confirmation message
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            mode (str): `immediate` or `digest`
+            window (float, optional): Seconds to collect notifications for
+            max_items (int, optional): Send the digest early once this many notifications are waiting
+            digest_format (str, optional): `embeds` or `text`
+        '''
+        log_and_print(f'delivery(mode={mode}, window={window}, max_items={max_items}, '
+                      f'digest_format={digest_format}) was called')
+        mode = mode.lower()
+        digest_settings = bot_config['digest_settings']
+        window = digest_settings['window'] if window is None else window
+        max_items = digest_settings['max_items'] if max_items is None else max_items
+        digest_format = (digest_format or digest_settings['format']).lower()
+        if mode not in DELIVERY_MODES:
+            reply_msg = f'Unknown mode `{mode}`, use one of: {", ".join(DELIVERY_MODES)}'
+        elif digest_format not in DIGEST_FORMATS:
+            reply_msg = f'Unknown format `{digest_format}`, use one of: {", ".join(DIGEST_FORMATS)}'
+        elif not (digest_settings['min_window'] <= window <= digest_settings['max_window']) or max_items < 1:
+            reply_msg = f'The window must be between {digest_settings["min_window"]} and '
+            reply_msg += f'{digest_settings["max_window"]} seconds, and max_items at least 1'
+        else:
+            def set_delivery(guild_info):
+                if mode == 'immediate':
+                    guild_info.pop('delivery', None)
+                else:
+                    guild_info['delivery'] = {'mode': mode, 'window': window, 'max_items': max_items, 
+                                              'format': digest_format}
+            await guilds_store.update_guild(str(ctx.guild.id), set_delivery)
+            if mode == 'immediate':
+                reply_msg = 'Notifications will be sent as soon as they are found'
+            else:
+                reply_msg = f'Notifications will be sent as {digest_format} digests every {window:g} seconds, '
+                reply_msg += f'or as soon as {max_items} are waiting'
+        await ctx.reply(reply_msg)
+        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}')
+        
     @bot.command(brief = 'Sets the notification channel')
     async def set_channel(ctx, channel_link):
         '''
@@ -487,13 +744,10 @@ def main():
         log_and_print(f'set_channel(channel_link={channel_link}) was called')
         try:
             channel_id = channel_link[2:-1]
-            rdc = RedDiscConsts()
-            bot_config = read_config_file(rdc.config_path)
-            guilds_dir = bot_config['dir_paths']['guilds_conf']
-            guilds_conf = read_config_file(guilds_dir)
             guild = str(ctx.guild.id)
-            guilds_conf[guild]['notification_channel'] = channel_id
-            update_config_file(guilds_dir, guilds_conf)
+            def set_notification_channel(guild_info):
+                guild_info['notification_channel'] = channel_id
+            await guilds_store.update_guild(guild, set_notification_channel)
             reply_msg = f'{channel_link} has been successfully set as the notification channel!'
         except:
             if channel_link[:2] != '<#':
@@ -506,40 +760,32 @@ def main():
         
     @bot.command()
     async def add_subreddit(ctx, subreddit: str):
-        # Read in the necessary variables from rnd_config
-        rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
-        
         if subreddit.startswith('r/'):
             subreddit = subreddit[2:]
         subreddit = subreddit.lower()
                 
-        if sub_exists(subreddit):
+        sub_exists = await lookups.sub_exists(subreddit)
+        if sub_exists:
             srv_id = str(ctx.guild.id)
-            guilds_conf[srv_id]['subreddits_to_monitor'][subreddit] = {'flairs_to_monitor': []}
-            update_config_file(guilds_config_path, guilds_conf)   
+            def add_sub(guild_info):
+                guild_info['subreddits_to_monitor'][subreddit] = {'flairs_to_monitor': []}
+            await guilds_store.update_guild(srv_id, add_sub)
             await ctx.reply(f'r/{subreddit} successfully added to monitoring list!')  
+        elif sub_exists is None:
+            await ctx.reply(f'Could not look up r/{subreddit}, try again')
         else:
             await ctx.reply(f'r/{subreddit} not found')
     
     @bot.command()
     async def rm_subreddit(ctx, subreddit: str):
-        # Read in the necessary variables from rnd_config
-        rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
-        
         if subreddit.startswith('r/'):
             subreddit = subreddit[2:].lower()
         subreddit = subreddit.lower()
         
         srv_id = str(ctx.guild.id)
-        if subreddit in guilds_conf[srv_id]['subreddits_to_monitor']:
-            guilds_conf[srv_id]['subreddits_to_monitor'].pop(subreddit)
-            update_config_file(guilds_config_path, guilds_conf)
+        def rm_sub(guild_info):
+            return guild_info['subreddits_to_monitor'].pop(subreddit, None) is not None
+        if await guilds_store.update_guild(srv_id, rm_sub):
             await ctx.reply(f'r/{subreddit} successfully removed from monitoring list!')  
         else:
             await ctx.reply(f'r/{subreddit} not found in list of subreddits to monitor.')
@@ -547,15 +793,12 @@ def main():
         
     @bot.command()
     async def add_flair(ctx, subreddit: str = None):
-        # Read in the necessary variables from rnd_config
         rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
         
         # Pick a subreddit to add flairs to
         srv_id = str(ctx.guild.id)
-        subreddits = guilds_conf[srv_id]['subreddits_to_monitor'].keys()
+        guild_info = guilds_store.get_guild(srv_id)
+        subreddits = guild_info['subreddits_to_monitor'].keys()
         response = ''
         
         if subreddit is None:
@@ -579,11 +822,11 @@ def main():
                 return
                         
         # Input a list of flairs to monitor
-        flairs = sub_flairs(subreddit)
+        flairs = await lookups.sub_flairs(subreddit)
         reply_msg = 'List all the flairs you want to add, please seperate flairs with commas.\n'
         reply_msg += 'Available flairs (please copy and paste):\n'
         for fl in flairs:
-            if fl not in guilds_conf[srv_id]['subreddits_to_monitor'][subreddit]['flairs_to_monitor']:
+            if fl not in guild_info['subreddits_to_monitor'][subreddit]['flairs_to_monitor']:
                 reply_msg += f'- `{fl}`\n'
         try:
             await ctx.reply(reply_msg)
@@ -610,8 +853,10 @@ def main():
             await ctx.send(reply_msg)
                     
         # Edit guilds file and send confirmation reply
-        guilds_conf[srv_id]['subreddits_to_monitor'][subreddit]['flairs_to_monitor'] += flairs_to_add
-        update_config_file(guilds_config_path, guilds_conf)
+        def add_flairs(guild_info):
+            flair_monitoring = guild_info['subreddits_to_monitor'][subreddit]['flairs_to_monitor']
+            flair_monitoring += [fl for fl in flairs_to_add if fl not in flair_monitoring]
+        await guilds_store.update_guild(srv_id, add_flairs)
         reply_msg = 'Successfully added the following flairs to the monitoring list:\n'
         for i in flairs_to_add:
             reply_msg += f'- `{i}`\n' 
@@ -619,15 +864,12 @@ def main():
         
     @bot.command()
     async def rm_flair(ctx, subreddit: str = None):
-        # Read in the necessary variables from rnd_config
         rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
         
         # Pick a subreddit to add flairs to
         srv_id = str(ctx.guild.id)
-        subreddits = guilds_conf[srv_id]['subreddits_to_monitor'].keys()
+        guild_info = guilds_store.get_guild(srv_id)
+        subreddits = guild_info['subreddits_to_monitor'].keys()
         response = ''
         
         if subreddit is None:
@@ -651,7 +893,7 @@ def main():
                 return
         
         # Input a list of flairs to remove
-        flair_monitoring = guilds_conf[srv_id]['subreddits_to_monitor'][subreddit]['flairs_to_monitor']
+        flair_monitoring = guild_info['subreddits_to_monitor'][subreddit]['flairs_to_monitor']
         reply_msg = 'List all the flairs you want to remove, please seperate flairs with commas.\n'
         reply_msg += 'Available flairs (please copy and paste):\n'
         for fl in flair_monitoring:
@@ -681,61 +923,353 @@ def main():
             await ctx.send(reply_msg)
             
         # Edit guilds file and send confirmation reply
-        for flair in flairs_to_rm:
-            guilds_conf[srv_id]['subreddits_to_monitor'][subreddit]['flairs_to_monitor'].remove(flair)
-        update_config_file(guilds_config_path, guilds_conf)
+        def rm_flairs(guild_info):
+            flair_monitoring = guild_info['subreddits_to_monitor'][subreddit]['flairs_to_monitor']
+            for flair in flairs_to_rm:
+                if flair in flair_monitoring:
+                    flair_monitoring.remove(flair)
+        await guilds_store.update_guild(srv_id, rm_flairs)
         reply_msg = 'Successfully removed the following flairs from the monitoring list:\n'
         for i in flairs_to_rm:
             reply_msg += f'- `{i}`\n' 
         await ctx.reply(reply_msg)     
              
+    def monitored_sub_info(ctx, subreddit: str):
+        # The guild's entry for subreddit in subreddits_to_monitor, None if it isn't monitored
+        guild_info = guilds_store.get_guild(str(ctx.guild.id)) or {}
+        return guild_info.get('subreddits_to_monitor', {}).get(subreddit)
+    
+    @bot.command(brief = 'Notifies about comments and posts containing keywords')
+    async def add_keyword(ctx, subreddit: str, *keywords: str):
+        '''
+        Adds keyword rules to a monitored subreddit. Every comment or post there that 
+        contains one of the keywords (as a whole word, any case) is sent as a notification.
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            subreddit (str): A subreddit the server monitors
+            keywords (str): The keywords, separated by commas, e.g. `rust, async io`
+        '''
+        subreddit = subreddit[2:].lower() if subreddit.startswith('r/') else subreddit.lower()
+        keywords = [normalize_keyword(k) for k in ' '.join(keywords).split(',') if k.strip()]
+        log_and_print(f'add_keyword(subreddit={subreddit}, keywords={keywords}) was called')
+        sub_info = monitored_sub_info(ctx, subreddit)
+        if sub_info is None:
+            await ctx.reply(RedDiscConsts().SUBREDDIT_NOT_FOUND)
+            return
+        if not keywords:
+            await ctx.reply('List the keywords to add, separated by commas')
+            return
+        max_rules = bot_config['rule_settings']['max_keywords_per_subreddit']
+        if len(set(sub_info.get(KEYWORD_RULES, [])) | set(keywords)) > max_rules:
+            await ctx.reply(f'A subreddit can have at most {max_rules} keywords')
+            return
+        
+        def add_keywords(guild_info):
+            rules = guild_info['subreddits_to_monitor'][subreddit].setdefault(KEYWORD_RULES, [])
+            for keyword in keywords:
+                if keyword not in rules:
+                    rules.append(keyword)
+        await guilds_store.update_guild(str(ctx.guild.id), add_keywords)
+        reply_msg = f'Now watching r/{subreddit} for the following keywords:\n'
+        for keyword in keywords:
+            reply_msg += f'- `{keyword}`\n'
+        await ctx.reply(reply_msg)
+    
+    @bot.command(brief = 'Stops notifying about keywords')
+    async def rm_keyword(ctx, subreddit: str, *keywords: str):
+        subreddit = subreddit[2:].lower() if subreddit.startswith('r/') else subreddit.lower()
+        keywords = [normalize_keyword(k) for k in ' '.join(keywords).split(',') if k.strip()]
+        if monitored_sub_info(ctx, subreddit) is None:
+            await ctx.reply(RedDiscConsts().SUBREDDIT_NOT_FOUND)
+            return
+        
+        def rm_keywords(guild_info):
+            rules = guild_info['subreddits_to_monitor'][subreddit].get(KEYWORD_RULES, [])
+            removed = [keyword for keyword in keywords if keyword in rules]
+            for keyword in removed:
+                rules.remove(keyword)
+            return removed
+        removed = await guilds_store.update_guild(str(ctx.guild.id), rm_keywords)
+        if removed:
+            await ctx.reply(f'Removed {len(removed)} keyword(s) from r/{subreddit}')
+        else:
+            await ctx.reply(f'None of those keywords are watched in r/{subreddit}')
+    
+    @bot.command(brief = 'Notifies about comments and posts matching a regex (server administrators only)')
+    @commands.has_guild_permissions(administrator=True)
+    async def add_regex(ctx, subreddit: str, *pattern: str):
+        '''
+        Adds a regular expression rule to a monitored subreddit. Every comment or 
+        post there that it matches (case insensitive) is sent as a notification.
+        Patterns that could backtrack for long, like nested quantifiers, are refused.
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            subreddit (str): A subreddit the server monitors
+            pattern (str): A Python regular expression, e.g. `v[0-9]+ (is )?released`
+        '''
+        subreddit = subreddit[2:].lower() if subreddit.startswith('r/') else subreddit.lower()
+        pattern = ' '.join(pattern).strip('`')
+        log_and_print(f'add_regex(subreddit={subreddit}, pattern={pattern}) was called')
+        sub_info = monitored_sub_info(ctx, subreddit)
+        if sub_info is None:
+            await ctx.reply(RedDiscConsts().SUBREDDIT_NOT_FOUND)
+            return
+        rule_settings = bot_config['rule_settings']
+        problem = validate_regex(pattern)
+        if problem is None and len(pattern) > rule_settings['max_regex_length']:
+            problem = f'it is longer than {rule_settings["max_regex_length"]} characters'
+        if problem is None and len(sub_info.get(REGEX_RULES, [])) >= rule_settings['max_regexes_per_subreddit']:
+            problem = f'a subreddit can have at most {rule_settings["max_regexes_per_subreddit"]} regexes'
+        if problem is not None:
+            await ctx.reply(f'Can\'t add `{pattern}`: {problem}')
+            return
+        
+        def add_pattern(guild_info):
+            rules = guild_info['subreddits_to_monitor'][subreddit].setdefault(REGEX_RULES, [])
+            if pattern not in rules:
+                rules.append(pattern)
+        await guilds_store.update_guild(str(ctx.guild.id), add_pattern)
+        await ctx.reply(f'Now watching r/{subreddit} for `{pattern}`')
+    
+    @add_regex.error
+    async def add_regex_error(ctx, error):
+        if isinstance(error, (commands.MissingPermissions, commands.NoPrivateMessage)):
+            await ctx.reply('Only server administrators can add regex rules')
+        else:
+            log_and_print(f'add_regex failed: {error!r}', level='error')
+            await ctx.reply('Something went wrong, the regex was not added')
+    
+    @bot.command(brief = 'Stops notifying about a regex')
+    async def rm_regex(ctx, subreddit: str, *pattern: str):
+        subreddit = subreddit[2:].lower() if subreddit.startswith('r/') else subreddit.lower()
+        pattern = ' '.join(pattern).strip('`')
+        if monitored_sub_info(ctx, subreddit) is None:
+            await ctx.reply(RedDiscConsts().SUBREDDIT_NOT_FOUND)
+            return
+        
+        def rm_pattern(guild_info):
+            rules = guild_info['subreddits_to_monitor'][subreddit].get(REGEX_RULES, [])
+            if pattern not in rules:
+                return False
+            rules.remove(pattern)
+            return True
+        if await guilds_store.update_guild(str(ctx.guild.id), rm_pattern):
+            await ctx.reply(f'Stopped watching r/{subreddit} for `{pattern}`')
+        else:
+            await ctx.reply(f'`{pattern}` is not watched in r/{subreddit}')
+    
+    @bot.command(brief = 'Lists the keyword and regex rules of a subreddit')
+    async def list_rules(ctx, subreddit: str):
+        subreddit = subreddit[2:].lower() if subreddit.startswith('r/') else subreddit.lower()
+        sub_info = monitored_sub_info(ctx, subreddit)
+        if sub_info is None:
+            await ctx.reply(RedDiscConsts().SUBREDDIT_NOT_FOUND)
+            return
+        reply_msg = f'**Keywords in r/{subreddit}:** '
+        reply_msg += ', '.join(f'`{k}`' for k in sub_info.get(KEYWORD_RULES, [])) or 'none'
+        reply_msg += f'\n**Regexes in r/{subreddit}:**\n'
+        reply_msg += ''.join(f'- `{p}`\n' for p in sub_info.get(REGEX_RULES, [])) or 'none'
+        await ctx.reply(reply_msg[:2000])
+        
     @bot.command()
     async def add_reddit_user(ctx, user: str):
-        # Read in the necessary variables from rnd_config
-        rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
-        
         if user.startswith('u/'):
             user = user[2:]
         user = user.lower()
             
-        if user_exists(user):        
+        user_exists = await lookups.user_exists(user)
+        if user_exists:
             srv_id = str(ctx.guild.id)
-            guilds_conf[srv_id]['users_to_monitor'].append(user)
-            update_config_file(guilds_config_path, guilds_conf)
+            def add_user(guild_info):
+                if user not in guild_info['users_to_monitor']:
+                    guild_info['users_to_monitor'].append(user)
+            await guilds_store.update_guild(srv_id, add_user)
             await ctx.reply(f'u/{user} successfully added to monitoring list!') 
+        elif user_exists is None:
+            await ctx.reply(f'Could not look up u/{user}, try again')
         else: 
             await ctx.reply(f'u/{user} not found') 
         
     @bot.command()
     async def rm_reddit_user(ctx, user: str):
-        # Read in the necessary variables from rnd_config
-        rdc = RedDiscConsts()
-        rnd_config = read_config_file(rdc.config_path)
-        guilds_config_path = rnd_config['dir_paths']['guilds_conf']
-        guilds_conf = read_config_file(guilds_config_path)
-        
         if user.startswith('u/'):
             user = user[2:]
         user = user.lower()
         
         srv_id = str(ctx.guild.id)
-        if user in guilds_conf[srv_id]['users_to_monitor']:
-            guilds_conf[srv_id]['users_to_monitor'].remove(user)
-            update_config_file(guilds_config_path, guilds_conf)
+        def rm_user(guild_info):
+            if user not in guild_info['users_to_monitor']:
+                return False
+            guild_info['users_to_monitor'].remove(user)
+            return True
+        if await guilds_store.update_guild(srv_id, rm_user):
             await ctx.reply(f'u/{user} successfully removed from monitoring list!')  
         else:
             await ctx.reply(f'u/{user} not found in list of Reddit users to monitor.')
 
+    
+    async def bulk_names(ctx, names: tuple, prefix: str) -> list:
+        # Names given with the command and in its attached .txt/.csv files, lower case 
+        # and without their u/ or r/ prefix, in order and without duplicates
+        text = ' '.join(names)
+        bulk_settings = bot_config['bulk_settings']
+        for attachment in ctx.message.attachments:
+            if attachment.size > bulk_settings['max_attachment_bytes']:
+                raise commands.BadArgument(f'{attachment.filename} is larger than '
+                                           f'{bulk_settings["max_attachment_bytes"]} bytes')
+            text += '\n' + (await attachment.read()).decode('utf-8', errors='replace')
+        parsed = {}
+        for name in re.split(r'[\s,;]+', text.lower()):
+            name = re.sub(rf'^/?{prefix}/', '', name.strip('`\'"'))
+            if name:
+                parsed[name] = None
+        if len(parsed) > bulk_settings['max_names']:
+            raise commands.BadArgument(f'At most {bulk_settings["max_names"]} names can be given at once')
+        return list(parsed)
+    
+    async def reply_summary(ctx, sections: list) -> None:
+        # One reply listing the names under each heading, split over several 
+        # messages only when it is longer than Discord allows
+        lines = []
+        for heading, names in sections:
+            if names:
+                lines.append(f'**{heading} ({len(names)}):** ' + ', '.join(f'`{name}`' for name in names))
+        reply_msg = '\n'.join(lines) or 'Nothing to do'
+        for page in paginate([reply_msg]):
+            await ctx.reply(page)
+        log_and_print(f'Replied to {ctx.author.name} with: \n{reply_msg}', terminal_print=False)
+    
+    @bot.command(brief = 'Adds many Reddit users at once')
+    async def add_reddit_users(ctx, *users: str):
+        '''
+        Adds every Reddit user listed to the monitoring list. The accounts are looked 
+        up concurrently, the guild config is written once and a single summary is sent.
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            users (str): The usernames, separated by spaces, commas or new lines. They can 
+                         also (or instead) be listed in an attached .txt or .csv file
+        '''
+        users = await bulk_names(ctx, users, 'u')
+        log_and_print(f'add_reddit_users() was called with {len(users)} user(s)')
+        exists = await lookups.users_exist(users)
+        found = [user for user, user_exists in exists.items() if user_exists]
+        
+        def add_users(guild_info):
+            monitored = guild_info['users_to_monitor']
+            already = set(monitored)
+            monitored.extend(user for user in found if user not in already)
+            return already
+        already = await guilds_store.update_guild(str(ctx.guild.id), add_users)
+        await reply_summary(ctx, [
+            ('Added', [f'u/{user}' for user in found if user not in already]),
+            ('Already monitored', [f'u/{user}' for user in found if user in already]),
+            ('Not found', [f'u/{user}' for user, user_exists in exists.items() if user_exists is False]),
+            ('Lookup failed, try again', [f'u/{user}' for user, user_exists in exists.items() if user_exists is None]),
+        ])
+    
+    @bot.command(brief = 'Removes many Reddit users at once')
+    async def rm_reddit_users(ctx, *users: str):
+        users = await bulk_names(ctx, users, 'u')
+        def rm_users(guild_info):
+            monitored = guild_info['users_to_monitor']
+            removed = set(monitored) & set(users)
+            monitored[:] = [user for user in monitored if user not in removed]
+            return removed
+        removed = await guilds_store.update_guild(str(ctx.guild.id), rm_users)
+        await reply_summary(ctx, [
+            ('Removed', [f'u/{user}' for user in users if user in removed]),
+            ('Not in the monitoring list', [f'u/{user}' for user in users if user not in removed]),
+        ])
+    
+    @bot.command(brief = 'Adds many subreddits at once')
+    async def add_subreddits(ctx, *subreddits: str):
+        '''
+        Adds every subreddit listed to the monitoring list. They are looked up 100 to 
+        a request, the guild config is written once and a single summary is sent.
+
+        Args:
+            ctx (Discord.Context): An object representing the message that called this command
+            subreddits (str): The subreddits, separated by spaces, commas or new lines. They 
+                              can also (or instead) be listed in an attached .txt or .csv file
+        '''
+        subreddits = await bulk_names(ctx, subreddits, 'r')
+        log_and_print(f'add_subreddits() was called with {len(subreddits)} subreddit(s)')
+        exists = await lookups.subs_exist(subreddits)
+        found = [sub for sub, sub_exists in exists.items() if sub_exists]
+        
+        def add_subs(guild_info):
+            monitored = guild_info['subreddits_to_monitor']
+            already = set(monitored)
+            for sub in found:
+                monitored.setdefault(sub, {'flairs_to_monitor': []})
+            return already
+        already = await guilds_store.update_guild(str(ctx.guild.id), add_subs)
+        await reply_summary(ctx, [
+            ('Added', [f'r/{sub}' for sub in found if sub not in already]),
+            ('Already monitored', [f'r/{sub}' for sub in found if sub in already]),
+            ('Not found', [f'r/{sub}' for sub, sub_exists in exists.items() if sub_exists is False]),
+            ('Lookup failed, try again', [f'r/{sub}' for sub, sub_exists in exists.items() if sub_exists is None]),
+        ])
+    
+    @bot.command(brief = 'Removes many subreddits at once')
+    async def rm_subreddits(ctx, *subreddits: str):
+        subreddits = await bulk_names(ctx, subreddits, 'r')
+        def rm_subs(guild_info):
+            monitored = guild_info['subreddits_to_monitor']
+            return {sub for sub in subreddits if monitored.pop(sub, None) is not None}
+        removed = await guilds_store.update_guild(str(ctx.guild.id), rm_subs)
+        await reply_summary(ctx, [
+            ('Removed', [f'r/{sub}' for sub in subreddits if sub in removed]),
+            ('Not in the monitoring list', [f'r/{sub}' for sub in subreddits if sub not in removed]),
+        ])
+    
+    @add_reddit_users.error
+    @rm_reddit_users.error
+    @add_subreddits.error
+    @rm_subreddits.error
+    async def bulk_error(ctx, error):
+        if isinstance(error, commands.BadArgument):
+            await ctx.reply(str(error))
+        else:
+            log_and_print(f'{ctx.command} failed: {error!r}', level='error')
+            await ctx.reply('Something went wrong, nothing was changed')
         
     # Run tasks asynchronously
+    startup.mark('config')
+    
+    # Reddit auth is warmed up while Discord logs in, the streams start right away, 
+    # and the report is logged once both sides are up
     tasks = [
-        asyncio.ensure_future(monitor_new_comments(red_bot, bot)), # Reddit bot
+        asyncio.ensure_future(startup.mark_when('reddit_auth', red_bot.auth.scopes())),
+        asyncio.ensure_future(startup.mark_when('first_notification', dispatcher.first_delivery.wait())),
         asyncio.ensure_future(bot.start(disc_bot_token)), # Discord bot
+        asyncio.ensure_future(guilds_store.watch_external_changes(bot_config['static_settings']['config_watch_interval'])),
     ]
+    startup_phases = ['reddit_auth', 'gateway_ready']
+    if monitor is not None:
+        # Reddit bot
+        tasks += [asyncio.ensure_future(coroutine) for coroutine in monitor.coroutines(dispatcher)]
+        tasks += [
+            asyncio.ensure_future(startup.mark_when('first_comment_page', monitor.comment_stream.first_page.wait())),
+            asyncio.ensure_future(startup.mark_when('first_submission_page', monitor.submission_stream.first_page.wait())),
+        ]
+        if monitor.comment_stream.subreddits:
+            startup_phases.append('first_comment_page')
+    else:
+        tasks.append(asyncio.ensure_future(coordinator.run(worker_settings['workers'], rdc.reddit_username, 
+                                                           rdc.config_path)))
+    if outbox is not None:
+        tasks.append(asyncio.ensure_future(outbox.run(outbox_settings['check_interval'])))
+    tasks.append(asyncio.ensure_future(startup.report_when(startup_phases)))
+    metrics_settings = bot_config['metrics_settings']
+    if metrics_settings['enabled']:
+        tasks.append(asyncio.ensure_future(metrics.serve_metrics(metrics_settings['host'], metrics_settings['port'])))
     loop = asyncio.get_event_loop()
+    if pipeline is not None:
+        pipeline.start()
     # loop.set_debug(True)
     nest_asyncio.apply(loop)
     loop.run_until_complete(asyncio.wait(tasks))
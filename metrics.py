@@ -0,0 +1,286 @@
+import asyncio
+import bisect
+import time
+from contextlib import contextmanager
+from typing import Callable, Dict, Iterable, List, Optional, Union
+
+from utils import log_and_print
+
+
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60, 300)
+
+
+def _format_labels(names: Iterable[str], values: Iterable, extra: str = '') -> str:
+    pairs = [f'{name}="{value}"' for name, value in zip(names, values)]
+    if extra:
+        pairs.append(extra)
+    return '{' + ','.join(pairs) + '}' if pairs else ''
+
+
+class _Metric():
+    TYPE = ''
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        self.name = name
+        self.documentation = documentation
+        self.labels = tuple(labels)
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(name, '')) for name in self.labels)
+
+    def header(self) -> List[str]:
+        return [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} {self.TYPE}']
+
+
+class Counter(_Metric):
+    '''
+    Monotonically increasing count, per combination of label values
+    '''
+    TYPE = 'counter'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = ()):
+        super().__init__(name, documentation, labels)
+        self.values = {}
+
+    def inc(self, amount: float = 1, **labels) -> None:
+        key = self._key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def total(self, **labels) -> float:
+        '''
+        Returns:
+            float: The sum over every series matching the given label values
+        '''
+        return sum(value for key, value in self.values.items()
+                   if all(key[self.labels.index(k)] == str(v) for k, v in labels.items()))
+
+    def render(self) -> List[str]:
+        return self.header() + [f'{self.name}{_format_labels(self.labels, key)} {value}'
+                                for key, value in sorted(self.values.items())]
+
+
+class Gauge(_Metric):
+    '''
+    Value read from a callback when the metrics are scraped. The callback returns
+    either a number, or a dict of label value tuples -> number.
+    '''
+    TYPE = 'gauge'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 func: Optional[Callable[[], Union[float, Dict[tuple, float]]]] = None):
+        super().__init__(name, documentation, labels)
+        self.func = func
+
+    def collect(self) -> Dict[tuple, float]:
+        if self.func is None:
+            return {}
+        value = self.func()
+        return value if isinstance(value, dict) else {(): value}
+
+    def render(self) -> List[str]:
+        try:
+            values = self.collect()
+        except Exception as e:
+            log_and_print(f'Failed to collect gauge {self.name}: {e!r}', level='error', terminal_print=False)
+            return []
+        return self.header() + [f'{self.name}{_format_labels(self.labels, key)} {value}'
+                                for key, value in sorted(values.items())]
+
+
+class Histogram(_Metric):
+    '''
+    Distribution of observed values (e.g. latencies in seconds) over fixed buckets
+    '''
+    TYPE = 'histogram'
+
+    def __init__(self, name: str, documentation: str, labels: Iterable[str] = (),
+                 buckets: Iterable[float] = DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labels)
+        self.buckets = tuple(sorted(buckets))
+        self.series = {}    # label values -> [bucket counts (+ overflow), sum, count]
+
+    def observe(self, value: float, **labels) -> None:
+        key = self._key(labels)
+        series = self.series.get(key)
+        if series is None:
+            series = self.series[key] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect.bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    @contextmanager
+    def time(self, **labels):
+        '''
+        Observes how long the with block took, also when it raises
+        '''
+        started = time.monotonic()
+        try:
+            yield
+        finally:
+            self.observe(time.monotonic() - started, **labels)
+
+    def quantile(self, q: float, **labels) -> Optional[float]:
+        '''
+        Estimates the q quantile over every series matching the given label values,
+        interpolating within the bucket it falls in
+
+        Returns:
+            Optional[float]: The estimate, None if nothing has been observed
+        '''
+        counts = [0] * (len(self.buckets) + 1)
+        for key, series in self.series.items():
+            if all(key[self.labels.index(k)] == str(v) for k, v in labels.items()):
+                counts = [a + b for a, b in zip(counts, series[0])]
+        total = sum(counts)
+        if not total:
+            return None
+        rank = q * total
+        seen = 0
+        for i, count in enumerate(counts):
+            if seen + count >= rank and count:
+                if i == len(self.buckets):
+                    return self.buckets[-1]
+                lower = self.buckets[i - 1] if i > 0 else 0
+                return lower + (self.buckets[i] - lower) * (rank - seen) / count
+            seen += count
+        return self.buckets[-1]
+
+    def render(self) -> List[str]:
+        lines = self.header()
+        for key, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + (float('inf'),), counts):
+                cumulative += bucket_count
+                le = 'le="+Inf"' if bound == float('inf') else f'le="{bound}"'
+                lines.append(f'{self.name}_bucket{_format_labels(self.labels, key, le)} {cumulative}')
+            lines.append(f'{self.name}_sum{_format_labels(self.labels, key)} {total}')
+            lines.append(f'{self.name}_count{_format_labels(self.labels, key)} {count}')
+        return lines
+
+
+class Registry():
+    '''
+    Every metric of the bot, rendered in the Prometheus text exposition format
+    '''
+    def __init__(self):
+        self.metrics = {}
+
+    def _register(self, metric: _Metric) -> _Metric:
+        existing = self.metrics.get(metric.name)
+        if existing is not None:
+            return existing
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, documentation: str, labels: Iterable[str] = ()) -> Counter:
+        return self._register(Counter(name, documentation, labels))
+
+    def histogram(self, name: str, documentation: str, labels: Iterable[str] = (),
+                  buckets: Iterable[float] = DEFAULT_BUCKETS) -> Histogram:
+        return self._register(Histogram(name, documentation, labels, buckets))
+
+    def gauge(self, name: str, documentation: str, labels: Iterable[str] = (),
+              func: Optional[Callable] = None) -> Gauge:
+        '''
+        Registers a gauge, or points an already registered one at func
+        '''
+        gauge = self._register(Gauge(name, documentation, labels, func))
+        if func is not None:
+            gauge.func = func
+        return gauge
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics.values():
+            lines += metric.render()
+        return '\n'.join(lines) + '\n'
+
+
+REGISTRY = Registry()
+
+
+class StartupTimer():
+    '''
+    Records how long after start-up each phase (imports, auth, gateway ready,
+    first stream page...) finished, logs it and exposes it as a gauge
+    '''
+    def __init__(self, started: float, registry: Registry = REGISTRY):
+        self.started = started
+        self.phases = {}
+        self._changed = asyncio.Event()
+        registry.gauge('reddisc_startup_seconds', 'Seconds from start-up to the end of each phase', ['phase'],
+                       lambda: {(phase,): seconds for phase, seconds in self.phases.items()})
+
+    def mark(self, phase: str) -> None:
+        '''
+        Records that phase has just finished, only the first time it is called
+        '''
+        if phase in self.phases:
+            return
+        self.phases[phase] = round(time.perf_counter() - self.started, 3)
+        log_and_print(f'Startup: {phase} after {self.phases[phase]:.2f}s', terminal_print=False)
+        self._changed.set()
+
+    async def mark_when(self, phase: str, awaitable) -> None:
+        '''
+        Marks phase once awaitable is done, unless it fails
+        '''
+        try:
+            await awaitable
+        except Exception as e:
+            log_and_print(f'Startup phase {phase} failed: {e!r}', level='warning')
+            return
+        self.mark(phase)
+
+    def summary(self) -> str:
+        return ', '.join(f'{phase} {seconds:.2f}s' for phase, seconds in
+                         sorted(self.phases.items(), key=lambda item: item[1]))
+
+    async def report_when(self, phases: Iterable[str], timeout: float = 120) -> None:
+        '''
+        Logs a one line timing report once every phase in phases has been marked,
+        or with whatever has been marked after timeout seconds
+        '''
+        phases = set(phases)
+        async def wait_for_phases():
+            while not phases <= set(self.phases):
+                self._changed.clear()
+                await self._changed.wait()
+        try:
+            await asyncio.wait_for(wait_for_phases(), timeout)
+        except asyncio.TimeoutError:
+            missing = ', '.join(sorted(phases - set(self.phases)))
+            log_and_print(f'Startup still waiting for: {missing}', level='warning')
+        log_and_print(f'Startup timing: {self.summary()}')
+
+# Shared by every module that talks to Reddit
+REDDIT_API_LATENCY = REGISTRY.histogram('reddisc_reddit_api_seconds',
+                                        'Reddit API call latency by call type', ['call'])
+
+
+async def serve_metrics(host: str = '127.0.0.1', port: int = 9108, registry: Registry = REGISTRY) -> None:
+    '''
+    Serves registry on http://host:port/metrics until cancelled
+    '''
+    async def handle(reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        try:
+            request_line = await asyncio.wait_for(reader.readline(), 5)
+            while (await asyncio.wait_for(reader.readline(), 5)) not in (b'\r\n', b'\n', b''):
+                pass # headers
+            parts = request_line.decode('latin-1').split()
+            if len(parts) >= 2 and parts[0] == 'GET' and parts[1].split('?')[0] == '/metrics':
+                status, body = '200 OK', registry.render().encode()
+            else:
+                status, body = '404 Not Found', b'Not found\n'
+            writer.write(f'HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4; charset=utf-8\r\n'
+                         f'Content-Length: {len(body)}\r\nConnection: close\r\n\r\n'.encode() + body)
+            await writer.drain()
+        except (asyncio.TimeoutError, ConnectionError):
+            pass
+        finally:
+            writer.close()
+
+    server = await asyncio.start_server(handle, host, port)
+    log_and_print(f'Serving metrics on http://{host}:{port}/metrics')
+    async with server:
+        await server.serve_forever()
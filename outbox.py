@@ -0,0 +1,231 @@
+import asyncio
+import os
+import sqlite3
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import List, Optional, Tuple
+
+from dispatcher import FAILED, DiscordDispatcher
+from metrics import REGISTRY
+from tracing import CURRENT_TRACE
+from utils import log_and_print
+
+
+OUTBOX_RETRIES = REGISTRY.counter('reddisc_outbox_retries_total', 'Notifications sent again after a failed send')
+OUTBOX_EXPIRED = REGISTRY.counter('reddisc_outbox_expired_total',
+                                  'Notifications given up on after max_age seconds of failed sends')
+
+PENDING = 'pending'
+EXPIRED = 'expired'
+
+
+class NotificationOutbox():
+    '''
+    Durable queue in front of the DiscordDispatcher. Every notification is written
+    to a SQLite database (one row per channel) before it is handed to the
+    dispatcher, and the row is only marked delivered once the dispatcher reports
+    the send went out. Sends that failed are retried with exponential backoff
+    (retry_base seconds, doubling up to retry_max), so a Discord outage delays
+    notifications instead of losing them. Whatever was still pending when the
+    process stopped is sent again when it starts, so a notification can arrive
+    twice after a crash but is never lost.
+
+    Rows are written and updated on a single writer thread: inserts made while a
+    commit is running go into the next one, so there is one transaction per batch
+    rather than per notification, and send() only waits for its own batch.
+    A retry of a notification split into pages starts from the first page that
+    didn't go out, as the pages sent are stored with each failed send.
+    Channels that can't be found or written to are marked dropped, rows still not
+    delivered after max_age seconds are marked expired, and finished rows are
+    deleted after keep_finished seconds.
+
+    send() takes the same arguments as DiscordDispatcher.send, so it can be used
+    wherever that is.
+    '''
+    def __init__(self, path: str, dispatcher: DiscordDispatcher, retry_base: float = 5, retry_max: float = 600,
+                 max_age: float = 86400, keep_finished: float = 3600, batch_size: int = 500):
+        self.path = path
+        self.dispatcher = dispatcher
+        self.retry_base = retry_base
+        self.retry_max = retry_max
+        self.max_age = max_age
+        self.keep_finished = keep_finished
+        self.batch_size = batch_size
+        self.pending = 0            # rows not delivered yet, as of the last check
+        self.retried = 0
+        self._conn = None
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='outbox')
+        self._inserts = []          # (rows, future) waiting for the next commit
+        self._results = []          # (outbox id, result, pages sent) waiting for the next commit
+        self._in_flight = set()     # outbox ids handed to the dispatcher and not settled yet
+        self._wakeup = asyncio.Event()
+        self._writer = None
+        dispatcher.add_result_listener(self.settle)
+
+        REGISTRY.gauge('reddisc_outbox_pending', 'Notifications in the outbox not delivered yet',
+                       func=lambda: self.pending)
+
+    def _connect(self) -> sqlite3.Connection:
+        if self._conn is None:
+            os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+            self._conn = sqlite3.connect(self.path, check_same_thread=False)
+            self._conn.execute('PRAGMA journal_mode=WAL')
+            self._conn.execute('PRAGMA synchronous=NORMAL')
+            self._conn.execute('CREATE TABLE IF NOT EXISTS outbox (id INTEGER PRIMARY KEY, guild_id TEXT NOT NULL, '
+                               'channel_id INTEGER NOT NULL, msg_body TEXT NOT NULL, received REAL NOT NULL, '
+                               'status TEXT NOT NULL, attempts INTEGER NOT NULL DEFAULT 0, '
+                               'next_attempt REAL NOT NULL, finished REAL, pages_sent INTEGER NOT NULL DEFAULT 0)')
+            columns = [row[1] for row in self._conn.execute('PRAGMA table_info(outbox)')]
+            if 'pages_sent' not in columns:
+                # Outboxes created before pages were tracked
+                self._conn.execute('ALTER TABLE outbox ADD COLUMN pages_sent INTEGER NOT NULL DEFAULT 0')
+            self._conn.execute('CREATE INDEX IF NOT EXISTS outbox_due ON outbox (status, next_attempt)')
+            self._conn.commit()
+        return self._conn
+
+    def _commit(self, inserts: List[List[tuple]], results: List[Tuple[int, str, int]]) -> List[List[int]]:
+        # Runs on the writer thread, returns the ids of every batch of inserted rows
+        conn = self._connect()
+        now = time.time()
+        ids = []
+        with conn:
+            for rows in inserts:
+                # Not due before retry_base, unless a restart leaves it unsent
+                ids.append([conn.execute('INSERT INTO outbox (guild_id, channel_id, msg_body, received, status, '
+                                         'next_attempt) VALUES (?, ?, ?, ?, ?, ?)',
+                                         row + (PENDING, now + self.retry_base)).lastrowid for row in rows])
+            for outbox_id, result, pages_sent in results:
+                if result == FAILED:
+                    conn.execute('UPDATE outbox SET attempts = attempts + 1, pages_sent = ?, '
+                                 'next_attempt = ? + MIN(?, ? * (1 << MIN(attempts, 20))) WHERE id = ?',
+                                 (pages_sent, now, self.retry_max, self.retry_base, outbox_id))
+                else:
+                    conn.execute('UPDATE outbox SET status = ?, finished = ? WHERE id = ?', (result, now, outbox_id))
+        return ids
+
+    def _ensure_writer(self) -> None:
+        if self._writer is None or self._writer.done():
+            self._writer = asyncio.ensure_future(self._write_loop())
+
+    async def _write_loop(self) -> None:
+        loop = asyncio.get_running_loop()
+        while True:
+            await self._wakeup.wait()
+            self._wakeup.clear()
+            inserts, self._inserts = self._inserts, []
+            results, self._results = self._results, []
+            try:
+                ids = await loop.run_in_executor(self._executor, self._commit, [rows for rows, _ in inserts], results)
+            except Exception as e:
+                log_and_print(f'Failed to write to the outbox: {e!r}', level='error')
+                self._results = results + self._results
+                for _, future in inserts:
+                    if not future.done():
+                        future.set_exception(e)
+                continue
+            for (_, future), batch_ids in zip(inserts, ids):
+                self.pending += len(batch_ids)
+                self._in_flight.update(batch_ids)
+                if not future.done():
+                    future.set_result(batch_ids)
+            # Only now that their backoff is stored can failed sends be picked up for a retry
+            for outbox_id, _, _ in results:
+                self._in_flight.discard(outbox_id)
+
+    async def send(self, srvs_to_send: List[Tuple[str, int]], msg_body: str,
+                   received: Optional[float] = None) -> None:
+        '''
+        Stores msg_body for every (guild id, channel id) in srvs_to_send, then
+        queues it in the dispatcher
+        '''
+        if not srvs_to_send:
+            return
+        received = received if received is not None else time.time()
+        future = asyncio.get_running_loop().create_future()
+        self._inserts.append(([(str(srv), int(chan_id), msg_body, received) for srv, chan_id in srvs_to_send], future))
+        self._wakeup.set()
+        self._ensure_writer()
+        trace = CURRENT_TRACE.get()
+        started = time.perf_counter()
+        try:
+            outbox_ids = await future
+        except Exception:
+            # Better sent without a safety net than not at all
+            await self.dispatcher.send(srvs_to_send, msg_body, received)
+            return
+        if trace is not None:
+            trace.add_span('outbox_write', started, time.perf_counter(), rows=len(outbox_ids))
+        await self.dispatcher.send(srvs_to_send, msg_body, received, outbox_ids=outbox_ids)
+
+    def settle(self, outbox_id: int, result: str, pages_sent: int = 0) -> None:
+        '''
+        Result listener of the dispatcher, records how the send of outbox_id went
+        '''
+        if result != FAILED:
+            self.pending = max(0, self.pending - 1)
+        self._results.append((outbox_id, result, pages_sent))
+        self._wakeup.set()
+        self._ensure_writer()
+
+    def _due(self) -> Tuple[List[tuple], int, int]:
+        # Runs on the writer thread: expires and purges old rows, returns the rows due for a retry
+        conn = self._connect()
+        now = time.time()
+        with conn:
+            expired = conn.execute('UPDATE outbox SET status = ?, finished = ? WHERE status = ? AND received < ?',
+                                   (EXPIRED, now, PENDING, now - self.max_age)).rowcount
+            conn.execute('DELETE FROM outbox WHERE status != ? AND finished < ?', (PENDING, now - self.keep_finished))
+        pending = conn.execute('SELECT COUNT(*) FROM outbox WHERE status = ?', (PENDING,)).fetchone()[0]
+        due = conn.execute('SELECT id, guild_id, channel_id, msg_body, received, pages_sent FROM outbox '
+                           'WHERE status = ? AND next_attempt <= ? ORDER BY id LIMIT ?',
+                           (PENDING, now, self.batch_size + len(self._in_flight))).fetchall()
+        return due, pending, expired
+
+    async def run(self, check_interval: float = 1) -> None:
+        '''
+        Every check_interval seconds, hands the rows that are due for a retry back
+        to the dispatcher. The first check sends whatever the last run left pending.
+        '''
+        loop = asyncio.get_running_loop()
+        first = True
+        try:
+            while True:
+                try:
+                    due, self.pending, expired = await loop.run_in_executor(self._executor, self._due)
+                except sqlite3.Error as e:
+                    log_and_print(f'Failed to read the outbox: {e!r}', level='error')
+                    due, expired = [], 0
+                if expired:
+                    OUTBOX_EXPIRED.inc(expired)
+                    log_and_print(f'Gave up on {expired} notification(s) not delivered within {self.max_age}s',
+                                  level='warning')
+                due = [row for row in due if row[0] not in self._in_flight][:self.batch_size]
+                if first and due:
+                    log_and_print(f'Resending {len(due)} notification(s) left in the outbox')
+                elif due:
+                    OUTBOX_RETRIES.inc(len(due))
+                    self.retried += len(due)
+                first = False
+                for outbox_id, guild_id, chan_id, msg_body, received, pages_sent in due:
+                    self._in_flight.add(outbox_id)
+                    await self.dispatcher.send([(guild_id, chan_id)], msg_body, received, outbox_ids=[outbox_id],
+                                               pages_sent=[pages_sent])
+                await asyncio.sleep(check_interval)
+        finally:
+            await self.close()
+
+    async def close(self) -> None:
+        if self._writer is not None:
+            self._writer.cancel()
+            self._writer = None
+        # Results reported since the last commit are written before closing, on
+        # the writer thread as a commit may still be running there
+        results, self._results = self._results, []
+        if results:
+            self._executor.submit(self._commit, [], results).result()
+        if self._conn is not None:
+            self._executor.submit(self._conn.close).result()
+            self._conn = None
+
+    def stats(self) -> dict:
+        return {'pending': self.pending, 'in_flight': len(self._in_flight), 'retried': self.retried}
@@ -0,0 +1,306 @@
+import asyncio
+import contextlib
+import time
+from typing import Awaitable, Callable, List, Optional, Tuple
+
+import asyncpraw as pr
+
+from caches import EnrichmentCache, ParentInfo, SubmissionInfo
+from metrics import REGISTRY
+from routing import RoutingIndex
+from tracing import CURRENT_TRACE, Trace, Tracer
+from utils import log_and_print
+
+
+ITEMS_MATCHED = REGISTRY.counter('reddisc_items_matched_total',
+                                 'Items that matched at least one guild, by shard', ['kind', 'shard'])
+
+
+class Notification():
+    '''
+    A Reddit item on its way through the NotificationPipeline
+    '''
+    def __init__(self, kind: str, item, shard: str = '', trace: Optional[Trace] = None):
+        self.kind = kind                # 'comment' or 'submission'
+        self.item = item
+        self.shard = shard              # the stream shard it came from
+        self.received = time.time()
+        self.srvs_to_send = []          # (guild id, channel id) pairs
+        self.msg_body = None
+        self.attempts = 0               # failed attempts at its current stage
+        self.trace = trace
+        self.queued = time.perf_counter() # when it was put in its current stage's queue
+
+
+def quote(text: str) -> str:
+    return '> ' + text.replace('\n', '\n> ')
+
+def render_comment(comment: pr.models.Comment, submission: Optional[SubmissionInfo],
+                   parent: Optional[ParentInfo]) -> str:
+    '''
+    Builds the Discord message for a comment from a monitored user
+
+    Args:
+        comment (pr.models.Comment): The comment
+        submission (Optional[SubmissionInfo]): The submission it was posted on, None if it couldn't be loaded
+        parent (Optional[ParentInfo]): The comment it replies to, None for a reply to the post
+                                       or when it couldn't be loaded
+
+    Returns:
+        str: The message body
+    '''
+    msg_body = f'**__r/{comment.subreddit.display_name}__**:\n'
+    if submission is not None:
+        msg_body += f'New comment from __u/{comment.author.name}__ on a post titled **{submission.title}**:\n'
+    else:
+        msg_body += f'New comment from __u/{comment.author.name}__:\n'
+    msg_body += quote(comment.body) + '\n'
+    if parent is not None:
+        msg_body += f'This was a reply to __u/{parent.author}__ who said:\n'
+        msg_body += quote(parent.body) + '\n'
+    elif comment.parent_id.startswith('t3_'):
+        msg_body += 'This was a reply to the original post\n'
+    else:
+        msg_body += 'This was a reply to a comment that could not be loaded\n'
+    msg_body += f'{comment.link_permalink}{comment.id}\n'
+    return msg_body
+
+def render_submission(submission: pr.models.Submission, max_selftext: int) -> str:
+    '''
+    Builds the Discord message for a submission from a monitored user or with a monitored flair
+
+    Args:
+        submission (pr.models.Submission): The submission
+        max_selftext (int): Self-text beyond this many characters is cut off
+
+    Returns:
+        str: The message body
+    '''
+    author = submission.author.name if submission.author is not None else '[deleted]'
+    flair = submission.link_flair_text
+    msg_body = f'**__r/{submission.subreddit.display_name}__**:\n'
+    msg_body += f'New post from __u/{author}__'
+    if flair:
+        msg_body += f' flaired `{flair}`'
+    msg_body += f' titled **{submission.title}**:\n'
+    selftext = submission.selftext
+    if selftext:
+        if len(selftext) > max_selftext:
+            selftext = selftext[:max_selftext] + '...'
+        msg_body += quote(selftext) + '\n'
+    msg_body += f'https://www.reddit.com{submission.permalink}\n'
+    return msg_body
+
+
+def _span(trace: Optional[Trace], name: str, **attrs):
+    return trace.span(name, **attrs) if trace is not None else contextlib.nullcontext({})
+
+async def _traced(trace: Optional[Trace], name: str, awaitable: Awaitable):
+    with _span(trace, name):
+        return await awaitable
+
+
+class NotificationPipeline():
+    '''
+    Turns streamed comments and submissions into Discord notifications in stages:
+
+        ingest -> match -> enrich -> dispatch
+
+    Each stage has its own bounded queue and its own workers, so a slow
+    parent.load() or channel.send only holds up the worker handling it while the
+    streams keep being consumed. Enrichment fetches the submission and the parent
+    comment concurrently, and a notification whose submission or parent can't be
+    loaded is sent without it.
+
+    An item whose stage fails is put back in that stage's queue after retry_delay
+    seconds, doubling with every attempt, up to max_retries times. After that it
+    is given up on without on_done, so it stays in flight for the checkpoint and
+    is backfilled after a restart.
+
+    send is called as send(srvs_to_send, msg_body, received) to deliver a
+    notification, received being the time.time() the item entered the pipeline.
+    on_done, if given, is called with (kind, item) once the pipeline is finished
+    with an item: it was handed to send or matched nobody.
+
+    Given a Tracer, every item carries a Trace timing its steps: the wait for a
+    match worker (receive), route, submission_load and parent_load, render, the
+    waits between stages and the handoff to send. While send runs the trace is in CURRENT_TRACE, so the
+    dispatcher can add a span per channel and finish it once the last send is
+    done. The traces of items nobody is notified about are dropped.
+    '''
+    STAGES = ['match', 'enrich', 'dispatch']
+
+    def __init__(self, routing_index: RoutingIndex, enrichment_cache: EnrichmentCache,
+                 send: Callable[[List[Tuple[str, int]], str, float], Awaitable[None]],
+                 workers: Optional[dict] = None, queue_sizes: Optional[dict] = None,
+                 max_selftext: int = 1000, tracer: Optional[Tracer] = None,
+                 on_done: Optional[Callable[[str, object], None]] = None, max_retries: int = 3,
+                 retry_delay: float = 2):
+        workers = workers or {}
+        queue_sizes = queue_sizes or {}
+        self.routing_index = routing_index
+        self.enrichment_cache = enrichment_cache
+        self.send = send
+        self.max_selftext = max_selftext
+        self.tracer = tracer
+        self.on_done = on_done
+        self.max_retries = max_retries
+        self.retry_delay = retry_delay
+        self.workers = {stage: workers.get(stage, 1) for stage in self.STAGES}
+        self.queues = {stage: asyncio.Queue(maxsize=queue_sizes.get(stage, 1000)) for stage in self.STAGES}
+        self._tasks = []
+        self._retries = set()   # tasks putting failed notifications back in their queue
+
+    async def ingest(self, kind: str, item, shard: str = '') -> None:
+        '''
+        Hands a streamed comment or submission to the pipeline. Only waits when the
+        match queue is full.
+        '''
+        trace = self.tracer.start(kind, item) if self.tracer is not None else None
+        await self.queues['match'].put(Notification(kind, item, shard, trace))
+
+    def queue_depths(self) -> dict:
+        return {stage: queue.qsize() for stage, queue in self.queues.items()}
+
+    async def match(self, notification: Notification) -> bool:
+        item = notification.item
+        if item.author is None:
+            return False # deleted, nobody can be monitoring it
+        trace = notification.trace
+        started = time.perf_counter() if trace is not None else None
+        if notification.kind == 'comment':
+            text = item.body
+            notification.srvs_to_send = self.routing_index.route(
+                item.author.name, item.subreddit.display_name, text)
+        else:
+            text = f'{item.title}\n{item.selftext}'
+            notification.srvs_to_send = self.routing_index.route_submission(
+                item.author.name, item.subreddit.display_name, item.link_flair_text, text)
+        if trace is not None:
+            trace.add_span('route', started, time.perf_counter(), guilds=len(notification.srvs_to_send))
+        if text and self.routing_index.has_regexes(item.subreddit.display_name):
+            with _span(trace, 'regex_match') as attrs:
+                by_regex = await self.routing_index.route_regexes(item.subreddit.display_name, text)
+                attrs['guilds'] = len(by_regex)
+            if by_regex:
+                notification.srvs_to_send = list(dict.fromkeys(notification.srvs_to_send + by_regex))
+        if not notification.srvs_to_send:
+            return False
+        ITEMS_MATCHED.inc(kind=notification.kind, shard=notification.shard)
+        return True
+
+    async def enrich(self, notification: Notification) -> None:
+        item = notification.item
+        trace = notification.trace
+        if notification.kind == 'comment':
+            submission, parent = await asyncio.gather(
+                _traced(trace, 'submission_load', self.enrichment_cache.submission(item)),
+                _traced(trace, 'parent_load', self.enrichment_cache.parent(item)), return_exceptions=True)
+            # Better a notification without the context than none at all
+            if isinstance(submission, Exception):
+                log_and_print(f'Failed to load the submission of comment {item.id}: {submission!r}', level='warning')
+                submission = None
+            if isinstance(parent, Exception):
+                log_and_print(f'Failed to load the parent of comment {item.id}: {parent!r}', level='warning')
+                parent = None
+            with _span(trace, 'render'):
+                notification.msg_body = render_comment(item, submission, parent)
+        else:
+            with _span(trace, 'render'):
+                notification.msg_body = render_submission(item, self.max_selftext)
+
+    async def dispatch(self, notification: Notification) -> None:
+        trace = notification.trace
+        if trace is None:
+            await self.send(notification.srvs_to_send, notification.msg_body, notification.received)
+            return
+        token = CURRENT_TRACE.set(trace)
+        try:
+            with trace.span('handoff', guilds=len(notification.srvs_to_send)):
+                await self.send(notification.srvs_to_send, notification.msg_body, notification.received)
+        finally:
+            CURRENT_TRACE.reset(token)
+        if not trace.handed_off:
+            # Sent on by a worker process, the trace ends here
+            trace.finish()
+
+    async def _worker(self, stage: str) -> None:
+        queue = self.queues[stage]
+        next_queue = {'match': 'enrich', 'enrich': 'dispatch'}.get(stage)
+        while True:
+            notification = await queue.get()
+            trace = notification.trace
+            if trace is not None:
+                # How long it waited for this stage, the first wait is part of receiving it
+                trace.add_span({'match': 'receive', 'enrich': 'enrich_wait', 'dispatch': 'dispatch_wait'}[stage],
+                               notification.queued, time.perf_counter())
+            finished = True
+            try:
+                if stage == 'match':
+                    passed = await self.match(notification)
+                elif stage == 'enrich':
+                    await self.enrich(notification)
+                    passed = True
+                else:
+                    await self.dispatch(notification)
+                    passed = False
+                if passed:
+                    notification.queued = time.perf_counter()
+                    notification.attempts = 0
+                    await self.queues[next_queue].put(notification)
+                    finished = False
+            except Exception as e:
+                # Not finished either way: it is retried, or left in flight to be backfilled after a restart
+                finished = False
+                notification.attempts += 1
+                if notification.attempts <= self.max_retries:
+                    delay = self.retry_delay * 2 ** (notification.attempts - 1)
+                    log_and_print(f'{stage} failed for {notification.kind} {notification.item.id}, '
+                                  f'retrying in {delay:.1f}s: {e!r}', level='warning')
+                    retry = asyncio.ensure_future(self._retry(stage, notification, delay))
+                    self._retries.add(retry)
+                    retry.add_done_callback(self._retries.discard)
+                else:
+                    log_and_print(f'{stage} failed for {notification.kind} {notification.item.id} '
+                                  f'{notification.attempts} times, giving up: {e!r}', level='error')
+                    if trace is not None and not trace.handed_off:
+                        trace.error = f'{stage}: {e!r}'
+                        trace.finish()
+            except asyncio.CancelledError:
+                # Stopping, the item stays in flight and is picked up again after a restart
+                finished = False
+                raise
+            finally:
+                if finished and self.on_done is not None:
+                    self.on_done(notification.kind, notification.item)
+                queue.task_done()
+
+    async def _retry(self, stage: str, notification: Notification, delay: float) -> None:
+        await asyncio.sleep(delay)
+        notification.queued = time.perf_counter()
+        await self.queues[stage].put(notification)
+
+    def start(self) -> None:
+        '''
+        Starts the workers of every stage
+        '''
+        for stage in self.STAGES:
+            for _ in range(self.workers[stage]):
+                self._tasks.append(asyncio.ensure_future(self._worker(stage)))
+
+    async def join(self) -> None:
+        '''
+        Waits until everything ingested so far has been dispatched (or dropped),
+        including the retries of failed stages
+        '''
+        while True:
+            for stage in self.STAGES:
+                await self.queues[stage].join()
+            if not self._retries:
+                return
+            await asyncio.wait(list(self._retries))
+
+    def stop(self) -> None:
+        for task in self._tasks + list(self._retries):
+            task.cancel()
+        self._tasks = []
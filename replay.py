@@ -0,0 +1,219 @@
+import asyncio
+import gzip
+import json
+import os
+import time
+from typing import AsyncIterator, Dict, Optional
+
+from streams import INGEST_LAG, ITEMS_INGESTED
+from utils import log_and_print
+
+
+# What the stream kinds are called in monitor_new_* and in the recording
+KINDS = {'comment': 'comments', 'submission': 'submissions'}
+
+
+def worker_path(path: str, worker_id: int) -> str:
+    '''
+    Returns:
+        str: path with .worker<worker_id> before its .jsonl.gz (or last) extension
+    '''
+    root, ext = (path[:-len('.jsonl.gz')], '.jsonl.gz') if path.endswith('.jsonl.gz') else os.path.splitext(path)
+    return f'{root}.worker{worker_id}{ext}'
+
+
+def _raw_value(value):
+    # Redditors and subreddits are recorded by name, like in Reddit's own JSON
+    name = getattr(value, 'display_name', None) or getattr(value, 'name', None)
+    return name if isinstance(name, str) else str(value)
+
+
+def raw_payload(item) -> dict:
+    '''
+    Returns:
+        dict: The attributes Reddit sent for item (an asyncpraw Comment or Submission),
+              without the client's own state
+    '''
+    return {key: value for key, value in vars(item).items() if not key.startswith('_')}
+
+
+class StreamRecorder():
+    '''
+    Appends every comment and submission the streams deliver to a gzip compressed
+    JSONL file, one {"received": time.time(), "kind": ..., "data": {...}} per line,
+    for ReplaySource to play back later.
+
+    record() only writes to the gzip buffer, run() flushes it every flush_interval
+    seconds and closes the file when cancelled. Appending to an existing recording
+    adds a gzip member, which reads back as one file.
+    '''
+    def __init__(self, path: str):
+        self.path = path
+        self.recorded = 0
+        os.makedirs(os.path.dirname(path) or '.', exist_ok=True)
+        self._file = gzip.open(path, 'at', encoding='utf-8')
+
+    def record(self, kind: str, item) -> None:
+        if self._file is None:
+            return
+        line = json.dumps({'received': time.time(), 'kind': kind, 'data': raw_payload(item)}, default=_raw_value)
+        self._file.write(line + '\n')
+        self.recorded += 1
+
+    def close(self) -> None:
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+            log_and_print(f'Recorded {self.recorded} items to {self.path}')
+
+    async def run(self, flush_interval: float = 30) -> None:
+        try:
+            while True:
+                await asyncio.sleep(flush_interval)
+                try:
+                    self._file.flush()
+                except OSError as e:
+                    log_and_print(f'Failed to flush the stream recording: {e!r}', level='error')
+        finally:
+            self.close()
+
+
+class _Named():
+    def __init__(self, name: str):
+        self.name = name
+        self.display_name = name
+
+    def __str__(self) -> str:
+        return self.name
+
+
+class ReplayItem():
+    '''
+    A recorded comment or submission with the attributes the pipeline reads, and
+    load() / parent() / submission answered from the recording instead of the API
+    '''
+    def __init__(self, replay: 'ReplaySource', kind: str, data: dict):
+        # Recorded fields named like the properties below are answered by the properties
+        self.__dict__.update({key: value for key, value in data.items() if not hasattr(ReplayItem, key)})
+        self._replay = replay
+        self._kind = kind
+        author = data.get('author')
+        self.author = _Named(author) if author and author != '[deleted]' else None
+        self.subreddit = _Named(data.get('subreddit') or '')
+
+    @property
+    def submission(self) -> 'ReplayItem':
+        recorded = self._replay.submissions.get(self.link_id)
+        if recorded is not None:
+            return recorded
+        # Comment listings carry the title and author of the post too
+        return ReplayItem(self._replay, 'submission', {
+            'id': self.link_id.split('_', 1)[-1], 'name': self.link_id, 'title': getattr(self, 'link_title', ''),
+            'author': getattr(self, 'link_author', None), 'subreddit': self.subreddit.display_name,
+            'link_flair_text': None, 'selftext': '', 'created_utc': self.created_utc})
+
+    async def parent(self) -> 'ReplayItem':
+        recorded = self._replay.comments.get(self.parent_id)
+        if recorded is not None:
+            return recorded
+        return ReplayItem(self._replay, 'comment', {'id': self.parent_id.split('_', 1)[-1], 'name': self.parent_id,
+                                                    'author': None, 'body': '[not in the recording]',
+                                                    'subreddit': self.subreddit.display_name})
+
+    async def load(self) -> None:
+        pass
+
+    @property
+    def fullname(self) -> str:
+        return self.__dict__.get('name') or f"{'t1' if self._kind == 'comment' else 't3'}_{self.id}"
+
+
+class ReplayStream():
+    '''
+    Stands in for a ShardedSubredditStream in monitor_new_comments / monitor_new_submissions,
+    yielding the items ReplaySource plays back (None after idle_timeout seconds without one)
+    '''
+    def __init__(self, kind: str, queue_size: int = 1000, idle_timeout: float = 5):
+        self.kind = kind
+        self.subreddits = set()
+        self.shards = []
+        self.last_source = 'replay'
+        self.idle_timeout = idle_timeout
+        self.queue = asyncio.Queue(maxsize=queue_size)
+
+    async def __aiter__(self) -> AsyncIterator[Optional[ReplayItem]]:
+        while True:
+            try:
+                item = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+            except asyncio.TimeoutError:
+                yield None
+                continue
+            ITEMS_INGESTED.inc(kind=self.kind, shard=self.last_source)
+            INGEST_LAG.observe(time.time() - item.created_utc, kind=self.kind)
+            yield item
+
+    def describe(self) -> list:
+        return []
+
+
+class ReplaySource():
+    '''
+    Plays a StreamRecorder recording back into a comment and a submission
+    ReplayStream, with no network access.
+
+    Items are released `speed` times as fast as they were received (0 for as fast
+    as the pipeline takes them), and their created_utc is moved forward so the
+    ingest lag is the one that was recorded. Recorded comments and submissions are
+    kept so replies and posts later in the recording are enriched from them.
+
+    Args:
+        path (str): The recording
+        speed (float, optional): Playback speed, 0 for no delays. Defaults to 1.
+        queue_size (int, optional): Items each stream buffers. Defaults to 1000.
+    '''
+    def __init__(self, path: str, speed: float = 1, queue_size: int = 1000):
+        self.path = path
+        self.speed = speed
+        self.streams = {kind: ReplayStream(kind, queue_size) for kind in KINDS.values()}
+        self.comments = {}      # fullname -> ReplayItem
+        self.submissions = {}   # fullname -> ReplayItem
+        self.replayed = 0
+        self.skipped = 0
+        self.done = asyncio.Event()
+
+    def stream(self, kind: str) -> ReplayStream:
+        return self.streams[kind]
+
+    async def run(self) -> None:
+        started = None
+        try:
+            with gzip.open(self.path, 'rt', encoding='utf-8') as fp:
+                for line in fp:
+                    try:
+                        record = json.loads(line)
+                        kind = KINDS[record['kind']]
+                    except (ValueError, KeyError):
+                        self.skipped += 1
+                        continue
+                    if started is None:
+                        started = (record['received'], time.monotonic())
+                    if self.speed > 0:
+                        due = started[1] + (record['received'] - started[0]) / self.speed
+                        if due > time.monotonic():
+                            await asyncio.sleep(due - time.monotonic())
+                    item = ReplayItem(self, record['kind'], record['data'])
+                    if 'created_utc' in record['data']:
+                        item.created_utc = record['data']['created_utc'] + time.time() - record['received']
+                    (self.comments if kind == 'comments' else self.submissions)[item.fullname] = item
+                    await self.streams[kind].queue.put(item)
+                    self.replayed += 1
+        except (OSError, EOFError) as e:
+            log_and_print(f'Stopped replaying {self.path}: {e!r}', level='error')
+        finally:
+            if self.skipped:
+                log_and_print(f'Skipped {self.skipped} unreadable lines of {self.path}', level='warning')
+            self.done.set()
+
+    def stats(self) -> Dict[str, int]:
+        return {'replayed': self.replayed, 'skipped': self.skipped,
+                'comments': len(self.comments), 'submissions': len(self.submissions)}
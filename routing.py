@@ -0,0 +1,254 @@
+from typing import Iterable, List, Optional, Set, Tuple
+
+from rules import KEYWORD_RULES, REGEX_RULES, RuleMatcher
+
+
+class RoutingIndex():
+    '''
+    In-memory index of everything the guilds are monitoring.
+
+    It is built once from guilds_conf and then kept up to date by the bot
+    commands, so deciding who to notify about a comment is a couple of dict
+    lookups instead of a re-read of the config files.
+
+    All subreddit and user names are stored lower case, guild ids are the
+    string keys used in guilds_conf.json.
+
+    Keyword and regex rules are kept in a RuleMatcher, which matches the text of
+    an item against the rules of every guild at once. route() and
+    route_submission() cover the keyword rules, the regex rules are matched out
+    of the event loop by route_regexes().
+    '''
+    def __init__(self):
+        self.guilds = {}        # guild id -> {'subreddits': set, 'users': set, 'flairs': set}
+        self.channels = {}      # guild id -> notification channel id (int)
+        self.user_routes = {}   # (author, subreddit) -> set of guild ids
+        self.flair_routes = {}  # (subreddit, flair) -> set of guild ids
+        self.sub_guilds = {}    # subreddit -> set of guild ids
+        self.user_guilds = {}   # author -> set of guild ids
+        self.rules = RuleMatcher()
+
+    @classmethod
+    def from_guilds_conf(cls, guilds_conf: dict) -> 'RoutingIndex':
+        '''
+        Builds an index from the contents of guilds_conf.json
+
+        Args:
+            guilds_conf (dict): The guilds config, keyed by guild id
+
+        Returns:
+            RoutingIndex: An index covering every guild in guilds_conf
+        '''
+        index = cls()
+        for guild_id, guild_info in guilds_conf.items():
+            if not isinstance(guild_info, dict):
+                continue # e.g. last_modified_time
+            index.update_guild(guild_id, guild_info)
+        return index
+
+    @staticmethod
+    def _add(table: dict, key, guild_id: str) -> None:
+        table.setdefault(key, set()).add(guild_id)
+
+    @staticmethod
+    def _discard(table: dict, key, guild_id: str) -> None:
+        guilds = table.get(key)
+        if guilds is None:
+            return
+        guilds.discard(guild_id)
+        if not guilds:
+            del table[key]
+
+    def remove_guild(self, guild_id: str) -> None:
+        '''
+        Drops every route belonging to guild_id
+
+        Args:
+            guild_id (str): The guild to remove
+        '''
+        guild_id = str(guild_id)
+        entry = self.guilds.pop(guild_id, None)
+        self.channels.pop(guild_id, None)
+        if entry is None:
+            return
+
+        for sub in entry['subreddits']:
+            self._discard(self.sub_guilds, sub, guild_id)
+            for user in entry['users']:
+                self._discard(self.user_routes, (user, sub), guild_id)
+        for user in entry['users']:
+            self._discard(self.user_guilds, user, guild_id)
+        for sub_flair in entry['flairs']:
+            self._discard(self.flair_routes, sub_flair, guild_id)
+        for sub, (keywords, regexes) in entry['rules'].items():
+            self.rules.remove(guild_id, sub, keywords, regexes)
+
+    def update_guild(self, guild_id: str, guild_info: dict) -> None:
+        '''
+        (Re)indexes a single guild. Call this after any change to the guild's entry in guilds_conf.
+
+        Args:
+            guild_id (str): The guild that changed
+            guild_info (dict): The guild's entry in guilds_conf
+        '''
+        guild_id = str(guild_id)
+        self.remove_guild(guild_id)
+
+        subreddits = {sub.lower() for sub in guild_info.get('subreddits_to_monitor', {})}
+        users = {usr.lower() for usr in guild_info.get('users_to_monitor', [])}
+        flairs = set()
+        rules = {}
+        for sub, sub_info in guild_info.get('subreddits_to_monitor', {}).items():
+            for fl in sub_info.get('flairs_to_monitor', []):
+                flairs.add((sub.lower(), fl))
+            keywords, regexes = sub_info.get(KEYWORD_RULES, []), sub_info.get(REGEX_RULES, [])
+            if keywords or regexes:
+                rules[sub.lower()] = (list(keywords), list(regexes))
+        self.guilds[guild_id] = {'subreddits': subreddits, 'users': users, 'flairs': flairs, 'rules': rules}
+
+        channel = str(guild_info.get('notification_channel', ''))
+        if channel.isdigit():
+            self.channels[guild_id] = int(channel)
+
+        for sub in subreddits:
+            self._add(self.sub_guilds, sub, guild_id)
+            for user in users:
+                self._add(self.user_routes, (user, sub), guild_id)
+        for user in users:
+            self._add(self.user_guilds, user, guild_id)
+        for sub_flair in flairs:
+            self._add(self.flair_routes, sub_flair, guild_id)
+        for sub, (keywords, regexes) in rules.items():
+            self.rules.add(guild_id, sub, keywords, regexes)
+
+    def apply(self, guild_id: str, guild_info: Optional[dict]) -> None:
+        '''
+        Listener for GuildsConfStore, re-indexes guild_id or removes it when guild_info is None
+        '''
+        if guild_info is None:
+            self.remove_guild(guild_id)
+        else:
+            self.update_guild(guild_id, guild_info)
+
+    def _with_channels(self, guild_ids: Iterable[str]) -> List[Tuple[str, int]]:
+        # Guilds that haven't run set_channel yet have nowhere to send to
+        channels = self.channels
+        return [(g, channels[g]) for g in guild_ids if g in channels]
+
+    def route(self, author: str, subreddit: str, text: Optional[str] = None) -> List[Tuple[str, int]]:
+        '''
+        Returns the guilds (and their notification channels) that monitor author in 
+        subreddit, or have a keyword rule there that text matches
+
+        Args:
+            author (str): Reddit username, any case
+            subreddit (str): Subreddit display name, any case
+            text (Optional[str]): The comment body, to match against the rules
+
+        Returns:
+            List[Tuple[str, int]]: (guild id, channel id) pairs to notify
+        '''
+        subreddit = subreddit.lower()
+        guild_ids = self.user_routes.get((author.lower(), subreddit))
+        if text and self.rules.has_rules(subreddit):
+            by_rule = self.rules.match_keywords(subreddit, text)
+            if by_rule:
+                guild_ids = guild_ids | by_rule if guild_ids else by_rule
+        if not guild_ids:
+            return []
+        return self._with_channels(guild_ids)
+
+    def has_regexes(self, subreddit: str) -> bool:
+        return self.rules.has_regexes(subreddit.lower())
+
+    async def route_regexes(self, subreddit: str, text: str) -> List[Tuple[str, int]]:
+        '''
+        Returns the guilds (and their notification channels) with a regex rule in
+        subreddit that text matches
+
+        Args:
+            subreddit (str): Subreddit display name, any case
+            text (str): The comment body, or the submission title and self-text
+
+        Returns:
+            List[Tuple[str, int]]: (guild id, channel id) pairs to notify
+        '''
+        guild_ids = await self.rules.match_regexes(subreddit.lower(), text)
+        if not guild_ids:
+            return []
+        return self._with_channels(guild_ids)
+
+    def route_flair(self, subreddit: str, flair: str) -> List[Tuple[str, int]]:
+        '''
+        Returns the guilds (and their notification channels) that monitor flair in subreddit
+
+        Args:
+            subreddit (str): Subreddit display name, any case
+            flair (str): The link flair text, as listed in the subreddit's flair templates
+
+        Returns:
+            List[Tuple[str, int]]: (guild id, channel id) pairs to notify
+        '''
+        guild_ids = self.flair_routes.get((subreddit.lower(), flair))
+        if not guild_ids:
+            return []
+        return self._with_channels(guild_ids)
+
+    def route_submission(self, author: str, subreddit: str, flair: Optional[str],
+                         text: Optional[str] = None) -> List[Tuple[str, int]]:
+        '''
+        Returns the guilds (and their notification channels) that monitor either the
+        submission's author or its flair in subreddit, or have a keyword rule there
+        that text matches, each guild at most once
+
+        Args:
+            author (str): Reddit username, any case
+            subreddit (str): Subreddit display name, any case
+            flair (Optional[str]): The submission's link_flair_text, None if it has no flair
+            text (Optional[str]): The title and self-text, to match against the rules
+
+        Returns:
+            List[Tuple[str, int]]: (guild id, channel id) pairs to notify
+        '''
+        subreddit = subreddit.lower()
+        by_author = self.user_routes.get((author.lower(), subreddit))
+        by_flair = self.flair_routes.get((subreddit, flair)) if flair else None
+        by_rule = self.rules.match_keywords(subreddit, text) if text and self.rules.has_rules(subreddit) else None
+        matched = [guild_ids for guild_ids in (by_author, by_flair, by_rule) if guild_ids]
+        if not matched:
+            return []
+        if len(matched) == 1:
+            return self._with_channels(matched[0])
+        return self._with_channels(set().union(*matched))
+
+    def subreddit_users(self, subreddit: str) -> Set[str]:
+        '''
+        Returns:
+            Set[str]: Every Reddit user monitored in subreddit by at least one guild
+        '''
+        users = set()
+        for guild_id in self.sub_guilds.get(subreddit.lower(), ()):
+            users |= self.guilds[guild_id]['users']
+        return users
+
+    def has_flairs(self, subreddit: str) -> bool:
+        '''
+        Returns:
+            bool: True if any guild monitors flairs in subreddit
+        '''
+        subreddit = subreddit.lower()
+        return any(sub == subreddit for sub, _ in self.flair_routes)
+
+    def subreddits(self) -> Set[str]:
+        '''
+        Returns:
+            Set[str]: Every subreddit monitored by at least one guild
+        '''
+        return set(self.sub_guilds)
+
+    def users(self) -> Set[str]:
+        '''
+        Returns:
+            Set[str]: Every Reddit user monitored by at least one guild
+        '''
+        return set(self.user_guilds)
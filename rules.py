@@ -0,0 +1,496 @@
+import asyncio
+import multiprocessing
+import re
+from collections import deque
+from typing import Dict, Iterable, List, Optional, Set, Tuple
+
+try:
+    from re import _parser as sre_parse, _constants as sre_constants
+except ImportError: # Python < 3.11
+    import sre_parse, sre_constants
+
+from metrics import REGISTRY
+from utils import log_and_print
+
+
+KEYWORD_RULES = 'keywords_to_monitor'
+REGEX_RULES = 'regexes_to_monitor'
+# Group references break when patterns are joined into one alternation
+_BACKREFERENCE = re.compile(r'\\[1-9]|\(\?P=')
+_REPEATS = {sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT, getattr(sre_constants, 'POSSESSIVE_REPEAT', None)}
+
+REGEX_TIMEOUTS = REGISTRY.counter('reddisc_regex_timeouts_total',
+                                  'Regex rule searches given up on after the time budget')
+
+
+def normalize_keyword(keyword: str) -> str:
+    return ' '.join(keyword.lower().split())
+
+
+def validate_regex(pattern: str) -> Optional[str]:
+    '''
+    Returns:
+        Optional[str]: Why pattern can't be used as a rule, None if it can
+    '''
+    try:
+        compiled = re.compile(pattern, re.IGNORECASE)
+    except re.error as e:
+        return str(e)
+    if compiled.search(''):
+        return 'it matches everything'
+    if _BACKREFERENCE.search(pattern):
+        return 'backreferences are not supported'
+    if _ambiguous_repeat(sre_parse.parse(pattern, re.IGNORECASE)):
+        return 'repeating a group that itself repeats or has alternatives can take forever to match, ' \
+               'use a character class like `[ab]+` instead'
+    return None
+
+
+def _first_literal(branch: list) -> Optional[str]:
+    if branch and branch[0][0] is sre_constants.LITERAL:
+        return chr(branch[0][1]).lower()
+    return None
+
+def _ambiguous_repeat(parsed, in_repeat: bool = False) -> bool:
+    '''
+    Returns:
+        bool: True if something repeated a variable number of times can itself be
+              matched in more than one way (a nested quantifier, or alternatives not
+              told apart by their first character), the patterns that backtrack
+              catastrophically like `(a+)+$`
+    '''
+    for op, av in parsed:
+        if op in _REPEATS:
+            low, high, sub = av
+            variable = high > low
+            if variable and in_repeat:
+                return True
+            if _ambiguous_repeat(sub, in_repeat or variable):
+                return True
+        elif op is sre_constants.BRANCH:
+            branches = av[1]
+            if in_repeat:
+                firsts = [_first_literal(branch) for branch in branches]
+                if None in firsts or len(set(firsts)) < len(firsts):
+                    return True
+            if any(_ambiguous_repeat(branch, in_repeat) for branch in branches):
+                return True
+        elif op is sre_constants.SUBPATTERN:
+            if _ambiguous_repeat(av[-1], in_repeat):
+                return True
+        elif op in (sre_constants.ASSERT, sre_constants.ASSERT_NOT):
+            if _ambiguous_repeat(av[1], in_repeat):
+                return True
+        elif op is getattr(sre_constants, 'ATOMIC_GROUP', None):
+            if _ambiguous_repeat(av, in_repeat):
+                return True
+        elif op is sre_constants.GROUPREF_EXISTS:
+            if any(branch is not None and _ambiguous_repeat(branch, in_repeat) for branch in av[1:]):
+                return True
+    return False
+
+
+def _compile_rules(patterns: Tuple[str, ...]) -> Tuple[Optional[re.Pattern], list, list]:
+    # The patterns that can be are joined into one alternation tried first, the
+    # others (backreferences, or the join failing) are always tried on their own
+    joinable, standalone = [], []
+    for index, pattern in enumerate(patterns):
+        try:
+            regex = re.compile(pattern, re.IGNORECASE)
+        except re.error:
+            continue
+        (standalone if _BACKREFERENCE.search(pattern) else joinable).append((regex, index))
+    combined = None
+    if joinable:
+        try:
+            combined = re.compile('|'.join(f'(?:{patterns[index]})' for _, index in joinable), re.IGNORECASE)
+        except re.error:
+            # e.g. repeated group names, fall back to trying each one
+            joinable, standalone = [], joinable + standalone
+    return combined, joinable, standalone
+
+def _search_rules(rules: Tuple[Optional[re.Pattern], list, list], text: str) -> List[int]:
+    combined, joinable, standalone = rules
+    candidates = joinable + standalone if combined is not None and combined.search(text) else standalone
+    return [index for regex, index in candidates if regex.search(text)]
+
+def _regex_worker(conn) -> None:
+    # Runs in a RegexSandbox process: answers (patterns, text) with the indexes of
+    # the patterns text matches
+    compiled = {}
+    conn.send('ready')
+    while True:
+        try:
+            patterns, text = conn.recv()
+        except (EOFError, OSError):
+            return
+        rules = compiled.get(patterns)
+        if rules is None:
+            if len(compiled) >= 1000:
+                compiled.clear()
+            rules = compiled[patterns] = _compile_rules(patterns)
+        conn.send(_search_rules(rules, text))
+
+
+class RegexSandbox():
+    '''
+    Matches regex rules in separate processes, so a pattern that backtracks for
+    long can't hold up the event loop (and with it the streams and the Discord
+    gateway) for every guild.
+
+    Each search gets `timeout` seconds. One that takes longer is counted as no
+    match, and the process running it is killed and replaced (in the background,
+    the other processes keep searching meanwhile). The processes are started on
+    the first search.
+    '''
+    def __init__(self, processes: int = 1, timeout: float = 0.25):
+        self.processes = processes
+        self.timeout = timeout
+        self.timeouts = 0
+        self._idle = None           # asyncio.Queue of (process, connection)
+        self._workers = []
+
+    def configure(self, processes: int = 1, timeout: float = 0.25) -> None:
+        self.processes = processes
+        self.timeout = timeout
+
+    def _spawn(self) -> tuple:
+        # Runs in a thread, returns once the process is ready so its start up
+        # isn't taken out of the first search's time budget
+        context = multiprocessing.get_context('spawn')
+        conn, child_conn = context.Pipe()
+        process = context.Process(target=_regex_worker, args=(child_conn,), name='reddisc-regex', daemon=True)
+        process.start()
+        child_conn.close()
+        conn.recv()
+        worker = (process, conn)
+        self._workers.append(worker)
+        return worker
+
+    def _retire(self, worker: tuple) -> None:
+        process, conn = worker
+        process.kill()
+        process.join()
+        conn.close()
+        self._workers.remove(worker)
+
+    async def _replace(self, worker: Optional[tuple] = None) -> None:
+        if worker is not None:
+            await asyncio.to_thread(self._retire, worker)
+        try:
+            self._idle.put_nowait(await asyncio.to_thread(self._spawn))
+        except (EOFError, OSError) as e:
+            log_and_print(f'Failed to start a regex process: {e!r}', level='error')
+            await asyncio.sleep(5)
+            asyncio.ensure_future(self._replace())
+
+    def _call(self, worker: tuple, patterns: Tuple[str, ...], text: str) -> List[int]:
+        # Runs in a thread, waiting on the pipe doesn't hold the GIL
+        _, conn = worker
+        conn.send((patterns, text))
+        if not conn.poll(self.timeout):
+            raise TimeoutError
+        return conn.recv()
+
+    async def search(self, patterns: Tuple[str, ...], text: str) -> List[int]:
+        '''
+        Returns:
+            List[int]: Indexes of the patterns that text matches, case insensitive
+        '''
+        if self._idle is None:
+            self._idle = asyncio.Queue()
+            for _ in range(self.processes):
+                asyncio.ensure_future(self._replace())
+        worker = await self._idle.get()
+        answered = False
+        try:
+            matches = await asyncio.to_thread(self._call, worker, patterns, text)
+            answered = True
+            return matches
+        except TimeoutError:
+            self.timeouts += 1
+            REGEX_TIMEOUTS.inc()
+            log_and_print(f'Gave up matching {len(text)} characters against {patterns} after {self.timeout}s',
+                          level='warning', terminal_print=False)
+            return []
+        except (EOFError, OSError) as e:
+            log_and_print(f'Regex process failed: {e!r}', level='error')
+            return []
+        finally:
+            if answered:
+                self._idle.put_nowait(worker)
+            else:
+                # Stuck, dead, or cancelled mid-search with its answer still to come
+                asyncio.ensure_future(self._replace(worker))
+
+    def close(self) -> None:
+        for worker in list(self._workers):
+            self._retire(worker)
+        self._idle = None
+
+
+REGEX_SANDBOX = RegexSandbox()
+
+
+class AhoCorasick():
+    '''
+    Aho-Corasick automaton finding every occurrence of a set of literal strings
+    in one pass over the text, however many strings there are.
+
+    Build it with add() for every string and then build(). search() reports each
+    string found as a whole word (not preceded or followed by a letter, digit or
+    underscore).
+    '''
+    def __init__(self):
+        self._goto = [{}]           # state -> {char: next state}
+        self._fail = [0]
+        self._output = [[]]         # state -> ids of the strings ending there
+        self._lengths = []          # string id -> length
+        self._built = True
+
+    def add(self, string: str) -> int:
+        '''
+        Returns:
+            int: The id search() reports the string by
+        '''
+        state = 0
+        for char in string:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        string_id = len(self._lengths)
+        self._output[state].append(string_id)
+        self._lengths.append(len(string))
+        self._built = False
+        return string_id
+
+    def build(self) -> None:
+        '''
+        Computes the failure links, breadth first, and merges each state's output
+        with that of its failure state
+        '''
+        goto, fail, output = self._goto, self._fail, self._output
+        queue = deque(goto[0].values())
+        for state in queue:
+            fail[state] = 0
+        while queue:
+            state = queue.popleft()
+            for char, next_state in goto[state].items():
+                queue.append(next_state)
+                fallback = fail[state]
+                while fallback and char not in goto[fallback]:
+                    fallback = fail[fallback]
+                fail[next_state] = goto[fallback].get(char, 0)
+                output[next_state] = output[next_state] + output[fail[next_state]]
+        self._built = True
+
+    def search(self, text: str) -> Set[int]:
+        '''
+        Args:
+            text (str): Text to search, already lower cased like the strings added
+
+        Returns:
+            Set[int]: Ids of the strings found in text as whole words
+        '''
+        if not self._built:
+            self.build()
+        goto, fail, output, lengths = self._goto, self._fail, self._output, self._lengths
+        found = set()
+        state = 0
+        last = len(text) - 1
+        for end, char in enumerate(text):
+            while state and char not in goto[state]:
+                state = fail[state]
+            state = goto[state].get(char, 0)
+            if output[state]:
+                for string_id in output[state]:
+                    start = end - lengths[string_id] + 1
+                    if (start == 0 or not _is_word_char(text[start - 1])) and \
+                            (end == last or not _is_word_char(text[end + 1])):
+                        found.add(string_id)
+        return found
+
+    def __len__(self) -> int:
+        return len(self._lengths)
+
+
+def _is_word_char(char: str) -> bool:
+    return char.isalnum() or char == '_'
+
+
+class RuleMatcher():
+    '''
+    Keyword and regex alert rules of every guild, compiled so that matching an
+    item costs about the same however many rules there are.
+
+    The keywords of each subreddit, from every guild, go into one AhoCorasick
+    automaton that match_keywords() runs once over the text.
+
+    match_regexes() hands the text to REGEX_SANDBOX, out of the event loop and
+    with a time budget. There the regexes of each subreddit are joined into one
+    alternation that is tried first, and only when it matches are that
+    subreddit's regexes checked one by one to find which guilds they belong to.
+    Regexes that can't be joined (backreferences) are always checked on their
+    own. Patterns validate_regex rejects are skipped, as guilds_conf can be
+    edited by hand.
+
+    When a subreddit's keywords change, its automaton is rebuilt in a thread on the
+    next match, and the old one keeps being used (without the removed keywords)
+    until the new one is swapped in, so a rule edit or config reload never holds
+    up the event loop. Only a subreddit's first automaton is built on the spot.
+    Its regexes are rebuilt on the next match after they change.
+    '''
+    def __init__(self):
+        self.keywords = {}      # (subreddit, keyword) -> set of guild ids
+        self.regexes = {}       # (subreddit, pattern) -> set of guild ids
+        self._sub_keywords = {} # subreddit -> set of its keywords
+        self._automata = {}     # subreddit -> (AhoCorasick, automaton string id -> keyword)
+        self._stale = set()     # subreddits whose keywords changed since their automaton was built
+        self._rebuilds = {}     # subreddit -> task building its new automaton
+        self._patterns = {}     # subreddit -> tuple of its usable regexes, as sent to the sandbox
+        self._sub_rules = {}    # subreddit -> number of rules
+
+    @staticmethod
+    def _add(table: dict, key, guild_id: str) -> None:
+        table.setdefault(key, set()).add(guild_id)
+
+    @staticmethod
+    def _discard(table: dict, key, guild_id: str) -> bool:
+        guilds = table.get(key)
+        if guilds is None:
+            return False
+        guilds.discard(guild_id)
+        if not guilds:
+            del table[key]
+            return True
+        return False
+
+    def _count(self, subreddit: str, change: int) -> None:
+        count = self._sub_rules.get(subreddit, 0) + change
+        if count:
+            self._sub_rules[subreddit] = count
+        else:
+            self._sub_rules.pop(subreddit, None)
+
+    def add(self, guild_id: str, subreddit: str, keywords: Iterable[str], regexes: Iterable[str]) -> None:
+        '''
+        Adds guild_id's rules for subreddit (lower case)
+        '''
+        for keyword in keywords:
+            key = (subreddit, normalize_keyword(keyword))
+            if key not in self.keywords:
+                self._sub_keywords.setdefault(subreddit, set()).add(key[1])
+                self._stale.add(subreddit)
+                self._count(subreddit, 1)
+            self._add(self.keywords, key, guild_id)
+        for pattern in regexes:
+            if (subreddit, pattern) not in self.regexes:
+                self._patterns.pop(subreddit, None)
+                self._count(subreddit, 1)
+            self._add(self.regexes, (subreddit, pattern), guild_id)
+
+    def remove(self, guild_id: str, subreddit: str, keywords: Iterable[str], regexes: Iterable[str]) -> None:
+        '''
+        Removes guild_id's rules for subreddit (lower case)
+        '''
+        for keyword in keywords:
+            key = (subreddit, normalize_keyword(keyword))
+            if self._discard(self.keywords, key, guild_id):
+                self._discard(self._sub_keywords, subreddit, key[1])
+                self._stale.add(subreddit)
+                self._count(subreddit, -1)
+        for pattern in regexes:
+            if self._discard(self.regexes, (subreddit, pattern), guild_id):
+                self._patterns.pop(subreddit, None)
+                self._count(subreddit, -1)
+
+    def has_rules(self, subreddit: str) -> bool:
+        return subreddit in self._sub_rules
+
+    @staticmethod
+    def _build_keywords(keywords: List[str]) -> Tuple[AhoCorasick, List[str]]:
+        automaton = AhoCorasick()
+        for keyword in keywords:
+            automaton.add(keyword)
+        automaton.build()
+        return automaton, keywords
+
+    async def _rebuild(self, subreddit: str) -> None:
+        try:
+            # Keywords can change again while a build runs, then it is built once more
+            while subreddit in self._stale:
+                self._stale.discard(subreddit)
+                keywords = list(self._sub_keywords.get(subreddit, ()))
+                if keywords:
+                    self._automata[subreddit] = await asyncio.to_thread(self._build_keywords, keywords)
+                else:
+                    self._automata.pop(subreddit, None)
+        finally:
+            self._rebuilds.pop(subreddit, None)
+
+    def _automaton(self, subreddit: str) -> Optional[Tuple[AhoCorasick, List[str]]]:
+        if subreddit in self._stale and subreddit not in self._rebuilds:
+            if subreddit in self._automata:
+                self._rebuilds[subreddit] = asyncio.ensure_future(self._rebuild(subreddit))
+            else:
+                # Nothing to match with in the meantime
+                self._stale.discard(subreddit)
+                keywords = list(self._sub_keywords.get(subreddit, ()))
+                if keywords:
+                    self._automata[subreddit] = self._build_keywords(keywords)
+        return self._automata.get(subreddit)
+
+    def has_regexes(self, subreddit: str) -> bool:
+        return bool(self._regex_patterns(subreddit)) if subreddit in self._sub_rules else False
+
+    def _regex_patterns(self, subreddit: str) -> Tuple[str, ...]:
+        patterns = self._patterns.get(subreddit)
+        if patterns is None:
+            patterns = tuple(sorted(pattern for sub, pattern in self.regexes
+                                    if sub == subreddit and validate_regex(pattern) is None))
+            self._patterns[subreddit] = patterns
+        return patterns
+
+    def match_keywords(self, subreddit: str, text: str) -> Set[str]:
+        '''
+        Args:
+            subreddit (str): Subreddit the item was posted in, lower case
+            text (str): The comment body, or the submission title and self-text
+
+        Returns:
+            Set[str]: Ids of the guilds with a keyword rule in subreddit that text matches
+        '''
+        guild_ids = set()
+        if subreddit not in self._sub_keywords and subreddit not in self._automata:
+            return guild_ids
+        built = self._automaton(subreddit)
+        if built is None:
+            return guild_ids
+        automaton, keyword_ids = built
+        # Keywords are stored with single spaces, so the text is searched the same way
+        for keyword_id in automaton.search(normalize_keyword(text)):
+            # The automaton can be older than the rules, removed keywords no longer match
+            guild_ids |= self.keywords.get((subreddit, keyword_ids[keyword_id]), set())
+        return guild_ids
+
+    async def match_regexes(self, subreddit: str, text: str) -> Set[str]:
+        '''
+        Returns:
+            Set[str]: Ids of the guilds with a regex rule in subreddit that text matches
+        '''
+        guild_ids = set()
+        patterns = self._regex_patterns(subreddit) if subreddit in self._sub_rules else ()
+        if not patterns:
+            return guild_ids
+        for index in await REGEX_SANDBOX.search(patterns, text):
+            # The rules can have changed while the sandbox was searching
+            guild_ids |= self.regexes.get((subreddit, patterns[index]), set())
+        return guild_ids
+
+    def stats(self) -> Dict[str, int]:
+        return {'keywords': len(self.keywords), 'regexes': len(self.regexes)}
@@ -0,0 +1,569 @@
+import asyncio
+import time
+from collections import OrderedDict
+from typing import AsyncIterator, Awaitable, Callable, Dict, Iterable, List, Optional, Set
+
+import asyncpraw as pr
+
+from budget import REDDIT_BUDGET, STREAM
+from metrics import REGISTRY
+from utils import log_and_print
+
+
+ITEMS_INGESTED = REGISTRY.counter('reddisc_items_ingested_total',
+                                  'Items delivered by the streams, by shard', ['kind', 'shard'])
+INGEST_LAG = REGISTRY.histogram('reddisc_ingest_lag_seconds',
+                                'Time from an item being posted to it being ingested', ['kind'],
+                                buckets=(1, 2, 5, 10, 20, 30, 60, 120, 300, 600, 1800))
+
+
+class SeenIds():
+    '''
+    Bounded set of recently seen item ids, oldest ids are forgotten first
+    '''
+    def __init__(self, max_items: int = 5000):
+        self.max_items = max_items
+        self._ids = OrderedDict()
+
+    def __contains__(self, item_id: str) -> bool:
+        return item_id in self._ids
+
+    def __len__(self) -> int:
+        return len(self._ids)
+
+    def add(self, item_id: str) -> bool:
+        '''
+        Adds item_id to the set
+
+        Returns:
+            bool: False if item_id had already been seen
+        '''
+        if item_id in self._ids:
+            return False
+        self._ids[item_id] = None
+        if len(self._ids) > self.max_items:
+            self._ids.popitem(last=False)
+        return True
+
+    def recent(self, count: int) -> List[str]:
+        '''
+        Returns:
+            List[str]: Up to count of the most recently added ids, oldest first
+        '''
+        ids = list(self._ids)
+        return ids[-count:] if count else []
+
+
+class PollCadence():
+    '''
+    Decides how long to wait between two polls of a listing page.
+
+    The arrival rate of new items is tracked as an exponentially weighted moving
+    average, and the next poll is timed so that about target_fill of the page will
+    be new by then, within min_interval and max_interval seconds. A page that came
+    back entirely new may have overflowed, so the next poll happens at min_interval.
+    Polls that find nothing new let the rate decay, which backs the interval off.
+    '''
+    def __init__(self, min_interval: float = 1, max_interval: float = 30, target_fill: float = 0.5,
+                 page_limit: int = 100, alpha: float = 0.3):
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.target_fill = target_fill
+        self.page_limit = page_limit
+        self.alpha = alpha
+        self.rate = None    # new items per second
+        self.interval = min_interval
+        self.last_fill = 0.0
+
+    def _clamp(self, interval: float) -> float:
+        return min(self.max_interval, max(self.min_interval, interval))
+
+    def start(self, page: List) -> float:
+        '''
+        Estimates the arrival rate from the timestamps on the first page fetched
+
+        Returns:
+            float: Seconds until the next poll
+        '''
+        if len(page) >= 2:
+            times = [item.created_utc for item in page]
+            span = max(times) - min(times)
+            self.rate = (len(page) - 1) / span if span > 0 else None
+        return self._update_interval(len(page))
+
+    def update(self, new: int, elapsed: float) -> float:
+        '''
+        Args:
+            new (int): How many items on the page hadn't been seen before
+            elapsed (float): Seconds since the previous poll
+
+        Returns:
+            float: Seconds until the next poll
+        '''
+        observed = new / max(elapsed, 1e-3)
+        self.rate = observed if self.rate is None else self.alpha * observed + (1 - self.alpha) * self.rate
+        return self._update_interval(new)
+
+    def _update_interval(self, new: int) -> float:
+        self.last_fill = new / self.page_limit
+        if new >= self.page_limit:
+            self.interval = self.min_interval
+        elif not self.rate:
+            self.interval = self.max_interval
+        else:
+            self.interval = self._clamp(self.target_fill * self.page_limit / self.rate)
+        return self.interval
+
+
+class SubredditStream():
+    '''
+    Comment (or submission) stream over a set of subreddits that can be re-pointed
+    at a different set while it is running.
+
+    reconfigure() swaps the underlying asyncpraw stream as soon as possible, even if
+    the current one is backing off. The new stream is started without skip_existing,
+    so comments posted around the swap in subreddits that were already monitored are
+    still delivered, while the ids seen so far stop them being delivered twice.
+    Comments older than the moment a subreddit started being monitored are dropped.
+
+    The stream polls the newest page of `r/a+b+c/comments` (or `/new`) itself, on a
+    PollCadence adapted to how busy these subreddits are, rather than on asyncpraw's
+    fixed backoff.
+
+    Iterating yields comments (submissions when kind is 'submissions'), or None
+    after every poll that found nothing new.
+    '''
+    def __init__(self, reddit_instance: pr.Reddit, subreddits: Iterable[str],
+                 cadence: Optional[PollCadence] = None, skip_existing: bool = True,
+                 seen_ids: Optional[SeenIds] = None, since: Optional[Dict[str, float]] = None,
+                 kind: str = 'comments', name: str = '', first_page: Optional[asyncio.Event] = None):
+        assert kind in ['comments', 'submissions'], "`kind` must be one of ['comments', 'submissions']"
+        self.kind = kind
+        self.name = name or kind
+        self.first_page = first_page if first_page is not None else asyncio.Event()
+        self.reddit = reddit_instance
+        self.subreddits = set(subreddits)
+        self.cadence = cadence if cadence is not None else PollCadence()
+        self.skip_existing = skip_existing
+        self.seen_ids = seen_ids if seen_ids is not None else SeenIds()
+        self._pending = None
+        self._swap = asyncio.Event()
+        # subreddit -> created_utc before which its items are ignored
+        self._since = dict(since) if since else {}
+
+    @property
+    def target_subreddits(self) -> Set[str]:
+        '''
+        The subreddits this stream is (or is about to start) monitoring
+        '''
+        return self._pending if self._pending is not None else self.subreddits
+
+    def since(self, subreddit: str) -> Optional[float]:
+        return self._since.get(subreddit)
+
+    def reconfigure(self, subreddits: Iterable[str], since: Optional[Dict[str, float]] = None) -> None:
+        '''
+        Requests a switch to a new set of subreddits, takes effect on the next item
+
+        Args:
+            subreddits (Iterable[str]): The new set of subreddits
+            since (Dict[str, float], optional): Start times for subreddits that are being 
+                handed over from another stream, so nothing posted after them is lost
+        '''
+        subreddits = set(subreddits)
+        if since:
+            self._since.update({sub: ts for sub, ts in since.items() if sub not in self.subreddits})
+        if subreddits == self.target_subreddits:
+            return
+        self._pending = subreddits
+        self._swap.set()
+
+    async def _poll(self, skip_existing: bool) -> AsyncIterator:
+        subreddit = await self.reddit.subreddit('+'.join(sorted(self.subreddits)))
+        listing = subreddit.comments if self.kind == 'comments' else subreddit.new
+        page_limit = self.cadence.page_limit
+        listed = SeenIds(2 * page_limit)
+        last_poll = None
+        while True:
+            polled = time.monotonic()
+            async with REDDIT_BUDGET.request(STREAM, call=f'{self.kind}_listing'):
+                page = [item async for item in listing(limit=page_limit)]
+            new = [item for item in page if listed.add(item.id)]
+            if last_poll is None:
+                self.first_page.set()
+                self.cadence.start(page)
+                if skip_existing:
+                    new = []
+            else:
+                self.cadence.update(len(new), polled - last_poll)
+            last_poll = polled
+
+            for item in reversed(new):
+                yield item
+            if not new:
+                yield None
+            await asyncio.sleep(max(0, self.cadence.interval - (time.monotonic() - polled)))
+
+    async def _open(self, skip_existing: bool) -> Optional[AsyncIterator]:
+        if not self.subreddits:
+            return None
+        return self._poll(skip_existing)
+
+    async def _close(self, stream: Optional[AsyncIterator], next_item: Optional[asyncio.Future]) -> None:
+        if next_item is not None and not next_item.done():
+            next_item.cancel()
+            await asyncio.wait({next_item})
+        if stream is not None:
+            await stream.aclose()
+
+    async def __aiter__(self):
+        if self.skip_existing:
+            now = time.time()
+            self._since = {sub: self._since.get(sub, now) for sub in self.subreddits}
+        stream = await self._open(self.skip_existing)
+        # If iteration is restarted (e.g. after a network error) catch up on what was missed
+        self.skip_existing = False
+        next_item = None
+        swap_waiter = asyncio.ensure_future(self._swap.wait())
+        try:
+            while True:
+                if stream is not None and next_item is None:
+                    next_item = asyncio.ensure_future(stream.__anext__())
+                waiting = {swap_waiter} if next_item is None else {next_item, swap_waiter}
+                await asyncio.wait(waiting, return_when=asyncio.FIRST_COMPLETED)
+
+                if next_item is not None and next_item.done():
+                    item = next_item.result()
+                    next_item = None
+                    if item is None:
+                        yield None
+                        continue
+                    if not self.seen_ids.add(item.id):
+                        continue
+                    if self._since and item.created_utc < \
+                            self._since.get(item.subreddit.display_name.lower(), 0):
+                        continue
+                    yield item
+                    continue
+
+                # Swap to the new set of subreddits
+                await self._close(stream, next_item)
+                next_item = None
+                cutover = time.time()
+                self._since = {sub: self._since.get(sub, 0 if sub in self.subreddits else cutover)
+                               for sub in self._pending}
+                self.subreddits = self._pending
+                self._pending = None
+                self._swap.clear()
+                swap_waiter = asyncio.ensure_future(self._swap.wait())
+                log_and_print('Update - now monitoring the following subreddits:')
+                for sub in sorted(self.subreddits):
+                    log_and_print(f'- {sub}')
+                stream = await self._open(skip_existing=False)
+        finally:
+            swap_waiter.cancel()
+            await self._close(stream, next_item)
+
+
+class CommentRates():
+    '''
+    Tracks how many comments per minute each subreddit receives, as an
+    exponentially weighted moving average updated once a minute.
+
+    Subreddits in frozen are not being streamed, so their rate doesn't decay with
+    the missing comments and is only updated by sample().
+    '''
+    def __init__(self, alpha: float = 0.3, window: float = 60):
+        self.alpha = alpha
+        self.window = window
+        self.rates = {}
+        self._counts = {}
+        self._window_start = time.monotonic()
+        self.frozen = set()
+
+    def record(self, subreddit: str) -> None:
+        if subreddit in self.frozen:
+            return
+        self._counts[subreddit] = self._counts.get(subreddit, 0) + 1
+        now = time.monotonic()
+        if now - self._window_start >= self.window:
+            self._roll(now)
+
+    def _roll(self, now: float) -> None:
+        minutes = (now - self._window_start) / 60
+        for sub in (set(self.rates) | set(self._counts)) - self.frozen:
+            observed = self._counts.get(sub, 0) / minutes
+            self.rates[sub] = self.alpha * observed + (1 - self.alpha) * self.rates.get(sub, observed)
+        self._counts = {}
+        self._window_start = now
+
+    def sample(self, subreddit: str, observed: float) -> None:
+        '''
+        Folds in a comments per minute rate measured some other way, for subreddits that aren't streamed
+        '''
+        self.rates[subreddit] = self.alpha * observed + (1 - self.alpha) * self.rates.get(subreddit, observed)
+
+    def rate(self, subreddit: str) -> float:
+        '''
+        Returns:
+            float: Comments per minute, 0 for subreddits that haven't been observed yet
+        '''
+        return self.rates.get(subreddit, 0.0)
+
+
+def plan_shards(subreddits: Iterable[str], rates: Optional[CommentRates] = None,
+                max_chars: int = 1000, max_rate: float = 600) -> List[List[str]]:
+    '''
+    Splits subreddits into groups small enough to stream as one `r/a+b+c` multireddit
+
+    Busiest subreddits are placed first, each into the least busy group that still has
+    room for it, so a group's name stays within max_chars and its combined comment rate
+    within max_rate whenever possible. A subreddit that is busier than max_rate on its
+    own gets a group to itself.
+
+    Args:
+        subreddits (Iterable[str]): Subreddits to split
+        rates (CommentRates, optional): Observed comment rates. Defaults to None (all equal).
+        max_chars (int, optional): Maximum length of a `+` joined group. Defaults to 1000.
+        max_rate (float, optional): Maximum comments per minute per group. Defaults to 600.
+
+    Returns:
+        List[List[str]]: The groups of subreddits
+    '''
+    rate = rates.rate if rates is not None else (lambda sub: 0.0)
+    groups = [] # [chars, rate, subs]
+    for sub in sorted(subreddits, key=lambda sub: (-rate(sub), sub)):
+        sub_rate = rate(sub)
+        fits = [g for g in groups
+                if g[0] + 1 + len(sub) <= max_chars and g[1] + sub_rate <= max_rate]
+        if fits:
+            group = min(fits, key=lambda g: (g[1], g[0]))
+            group[0] += 1 + len(sub)
+            group[1] += sub_rate
+            group[2].append(sub)
+        else:
+            groups.append([len(sub), sub_rate, [sub]])
+    return [g[2] for g in groups]
+
+
+class ShardedSubredditStream():
+    '''
+    Streams comments (or submissions) from many subreddits by splitting them across several
+    SubredditStreams (shards), each running in its own task and feeding one bounded
+    queue. The shards share one set of seen ids, so a comment is only delivered once.
+
+    Subreddits are added to and removed from shards in place when reconfigure() is
+    called, and shards that get busier than max_rate are split every
+    rebalance_interval seconds. A subreddit moved to another shard keeps its start
+    time, so nothing is dropped on the way.
+
+    Every shard polls on its own PollCadence, built from cadence_settings, so quiet
+    shards are polled less often than busy ones.
+
+    A backfill loader set with backfill_first() is run before the shards are
+    started, and the items it returns are delivered ahead of anything streamed.
+
+    Iterating yields items, or None after idle_timeout seconds without one.
+    last_source is the name of the shard the last item came from ('injected' for
+    items fed in with inject()).
+    '''
+    def __init__(self, reddit_instance: pr.Reddit, subreddits: Iterable[str],
+                 cadence_settings: Optional[dict] = None, skip_existing: bool = True,
+                 max_chars: int = 1000, max_rate: float = 600, queue_size: int = 1000,
+                 idle_timeout: float = 60, rebalance_interval: float = 300, seen_ids_size: int = 20000,
+                 kind: str = 'comments'):
+        self.kind = kind
+        self.reddit = reddit_instance
+        self.subreddits = set(subreddits)
+        self.cadence_settings = cadence_settings or {}
+        self.skip_existing = skip_existing
+        self.max_chars = max_chars
+        self.max_rate = max_rate
+        self.idle_timeout = idle_timeout
+        self.rebalance_interval = rebalance_interval
+        self.seen_ids = SeenIds(seen_ids_size)
+        self.rates = CommentRates()
+        self.queue = asyncio.Queue(maxsize=queue_size)
+        self.shards = []
+        self._tasks = {}
+        self._running = False
+        self._backfill = None
+        self._starter = None
+        self._unrated = 0   # queued backfill items, kept out of the comment rates
+        self._shard_count = 0
+        self.last_source = None
+        self.first_page = asyncio.Event()   # set once any shard has fetched a page
+
+    def _shard_rate(self, subreddits: Iterable[str]) -> float:
+        return sum(self.rates.rate(sub) for sub in subreddits)
+
+    def _add_shard(self, subreddits: Iterable[str], since: Optional[Dict[str, float]] = None,
+                   skip_existing: bool = False) -> SubredditStream:
+        self._shard_count += 1
+        shard = SubredditStream(self.reddit, subreddits, cadence=PollCadence(**self.cadence_settings),
+                                skip_existing=skip_existing, seen_ids=self.seen_ids, since=since,
+                                kind=self.kind, name=f'{self.kind}-{self._shard_count}',
+                                first_page=self.first_page)
+        self.shards.append(shard)
+        if self._running:
+            self._tasks[shard] = asyncio.ensure_future(self._run_shard(shard))
+        return shard
+
+    def _drop_empty_shards(self) -> None:
+        for shard in [s for s in self.shards if not s.target_subreddits]:
+            self.shards.remove(shard)
+            task = self._tasks.pop(shard, None)
+            if task is not None:
+                task.cancel()
+
+    async def _run_shard(self, shard: SubredditStream) -> None:
+        while True:
+            try:
+                async for item in shard:
+                    if item is not None:
+                        await self.queue.put((shard.name, item))
+                return
+            except asyncio.CancelledError:
+                raise
+            except Exception as e:
+                subs = '+'.join(sorted(shard.target_subreddits))
+                log_and_print(f'{self.kind.capitalize()} stream for r/{subs} failed, restarting: {e!r}', level='error')
+                await asyncio.sleep(5)
+
+    def reconfigure(self, subreddits: Iterable[str]) -> None:
+        '''
+        Switches to monitoring a new set of subreddits, only shards whose subreddits
+        changed are restarted
+        '''
+        subreddits = set(subreddits)
+        if not self._running:
+            self.subreddits = subreddits
+            return
+        removed = self.subreddits - subreddits
+        added = subreddits - self.subreddits
+        self.subreddits = subreddits
+        if removed:
+            for shard in self.shards:
+                if shard.target_subreddits & removed:
+                    shard.reconfigure(shard.target_subreddits - removed)
+            self._drop_empty_shards()
+
+        # Put new subreddits into shards with room to spare, or new shards
+        additions = {}
+        for group in plan_shards(added, self.rates, self.max_chars, self.max_rate):
+            for sub in group:
+                target = None
+                for shard in self.shards:
+                    subs = additions.get(shard, shard.target_subreddits)
+                    if len('+'.join(subs)) + 1 + len(sub) <= self.max_chars \
+                            and self._shard_rate(subs) + self.rates.rate(sub) <= self.max_rate:
+                        target = shard
+                        break
+                if target is None:
+                    target = self._add_shard([], skip_existing=False)
+                additions[target] = additions.get(target, target.target_subreddits) | {sub}
+        for shard, subs in additions.items():
+            shard.reconfigure(subs)
+
+    def rebalance(self) -> None:
+        '''
+        Splits shards whose observed comment rate is above max_rate
+        '''
+        for shard in list(self.shards):
+            subs = shard.target_subreddits
+            if len(subs) < 2 or self._shard_rate(subs) <= self.max_rate:
+                continue
+            groups = plan_shards(subs, self.rates, self.max_chars, self.max_rate)
+            if len(groups) < 2:
+                continue
+            log_and_print(f'Splitting a {self.kind} stream of {len(subs)} subreddits into {len(groups)}')
+            shard.reconfigure(groups[0])
+            for group in groups[1:]:
+                since = {sub: shard.since(sub) for sub in group if shard.since(sub) is not None}
+                self._add_shard(group, since=since)
+
+    async def inject(self, item) -> bool:
+        '''
+        Feeds an item fetched some other way (e.g. by polling a user) into the stream
+
+        Returns:
+            bool: False if the item had already been delivered
+        '''
+        if not self.seen_ids.add(item.id):
+            return False
+        await self.queue.put(('injected', item))
+        return True
+
+    def backfill_first(self, loader: Callable[[Set[str]], Awaitable[List]], since: float) -> None:
+        '''
+        Makes the stream deliver the items returned by loader(subreddits), in order,
+        before it starts streaming. Once they are queued the shards start without
+        skip_existing, dropping anything created before since, while the shared seen
+        ids filter out what was backfilled.
+        '''
+        self._backfill = (loader, since)
+
+    async def _start(self) -> None:
+        since = None
+        if self._backfill is not None:
+            (loader, backfill_since), self._backfill = self._backfill, None
+            try:
+                items = await loader(set(self.subreddits))
+                log_and_print(f'Backfilling {len(items)} {self.kind} posted while the bot was down')
+                self._unrated = len(items)
+                for item in items:
+                    await self.inject(item)
+                self.skip_existing = False
+                since = backfill_since
+            except Exception as e:
+                log_and_print(f'Backfill of {self.kind} failed: {e!r}', level='error')
+
+        for group in plan_shards(self.subreddits, self.rates, self.max_chars, self.max_rate):
+            self._add_shard(group, skip_existing=self.skip_existing,
+                            since={sub: since for sub in group} if since is not None else None)
+        self._running = True
+        for shard in self.shards:
+            self._tasks[shard] = asyncio.ensure_future(self._run_shard(shard))
+
+    def describe(self) -> List[dict]:
+        '''
+        Returns:
+            List[dict]: The subreddits, observed comment rate and polling cadence of every shard
+        '''
+        return [{'shard': shard.name, 'subreddits': sorted(shard.target_subreddits),
+                 'rate': self._shard_rate(shard.target_subreddits),
+                 'poll_interval': round(shard.cadence.interval, 2),
+                 'page_fill': round(shard.cadence.last_fill, 2)} for shard in self.shards]
+
+    async def __aiter__(self):
+        if not self._running and self._starter is None:
+            self._starter = asyncio.ensure_future(self._start())
+
+        last_rebalance = time.monotonic()
+        try:
+            while True:
+                try:
+                    source, item = await asyncio.wait_for(self.queue.get(), self.idle_timeout)
+                except asyncio.TimeoutError:
+                    yield None
+                    continue
+                self.last_source = source
+                ITEMS_INGESTED.inc(kind=self.kind, shard=source)
+                INGEST_LAG.observe(time.time() - item.created_utc, kind=self.kind)
+                if self._unrated:
+                    self._unrated -= 1
+                else:
+                    self.rates.record(item.subreddit.display_name.lower())
+                yield item
+
+                if time.monotonic() - last_rebalance >= self.rebalance_interval:
+                    last_rebalance = time.monotonic()
+                    self.rebalance()
+        finally:
+            if self._starter is not None:
+                self._starter.cancel()
+                self._starter = None
+            for task in self._tasks.values():
+                task.cancel()
+            self._tasks = {}
+            self._running = False
@@ -0,0 +1,207 @@
+import asyncio
+import contextvars
+import cProfile
+import io
+import itertools
+import json
+import os
+import pstats
+import random
+import time
+from contextlib import contextmanager
+from typing import List
+
+from metrics import REGISTRY
+from utils import log_and_print
+
+
+SPAN_DURATION = REGISTRY.histogram('reddisc_trace_span_seconds', 'Duration of each traced step of a notification',
+                                   ['span'])
+
+# The trace of the notification being sent, so the dispatcher (behind the outbox
+# or not) can add its send spans without it being passed through every send()
+CURRENT_TRACE = contextvars.ContextVar('current_trace', default=None)
+
+_trace_ids = itertools.count(1)
+
+
+class Trace():
+    '''
+    Timed spans of one comment or submission on its way through the pipeline:
+    receive (waiting for a match worker), route, submission_load, parent_load,
+    render, the waits between stages, the handoff to send, and a send span per
+    guild channel.
+
+    Spans are stored relative to when the item was received. The trace is
+    finished by the pipeline, or by the dispatcher once every channel send of
+    the notification has settled, and then handed to the Tracer.
+    '''
+    def __init__(self, tracer: 'Tracer', kind: str, item):
+        self.tracer = tracer
+        self.trace_id = next(_trace_ids)
+        self.kind = kind
+        self.item_id = getattr(item, 'id', None)
+        self.subreddit = item.subreddit.display_name if getattr(item, 'subreddit', None) is not None else None
+        self.received = time.time()
+        created = getattr(item, 'created_utc', None)
+        self.ingest_lag = self.received - created if created is not None else None
+        self.started = time.perf_counter()
+        self.spans = []             # (name, start, end, attrs), perf_counter times
+        self.handed_off = False     # the dispatcher finishes it once the sends are done
+        self.error = None
+        self.finished = None
+
+    def add_span(self, name: str, start: float, end: float, **attrs) -> None:
+        self.spans.append((name, start, end, attrs))
+        SPAN_DURATION.observe(end - start, span=name)
+
+    @contextmanager
+    def span(self, name: str, **attrs):
+        start = time.perf_counter()
+        try:
+            yield attrs # can be added to while the span runs
+        finally:
+            self.add_span(name, start, time.perf_counter(), **attrs)
+
+    def finish(self) -> None:
+        if self.finished is None:
+            self.finished = time.perf_counter()
+            self.tracer.submit(self)
+
+    @property
+    def duration(self) -> float:
+        return (self.finished or time.perf_counter()) - self.started
+
+    def to_dict(self) -> dict:
+        ms = lambda seconds: round(seconds * 1000, 3)
+        return {'trace_id': self.trace_id, 'kind': self.kind, 'id': self.item_id, 'subreddit': self.subreddit,
+                'received': self.received, 'duration_ms': ms(self.duration),
+                'ingest_lag_ms': ms(self.ingest_lag) if self.ingest_lag is not None else None, 'error': self.error,
+                'spans': [dict(name=name, start_ms=ms(start - self.started), duration_ms=ms(end - start), **attrs)
+                          for name, start, end, attrs in sorted(self.spans, key=lambda span: span[1])]}
+
+
+class Tracer():
+    '''
+    Writes finished traces as JSON lines: every trace that took longer than
+    slow_threshold seconds or failed, and sample_rate of the others.
+    Lines are buffered and flushed by run() every flush_interval seconds.
+
+    Args:
+        path (str): The JSONL file traces are appended to
+        slow_threshold (float, optional): Seconds from receive to the last send above
+            which a trace is always written. Defaults to 5.
+        sample_rate (float, optional): Share of the other traces written. Defaults to 0.01.
+    '''
+    def __init__(self, path: str, slow_threshold: float = 5, sample_rate: float = 0.01):
+        self.path = path
+        self.slow_threshold = slow_threshold
+        self.sample_rate = sample_rate
+        self.finished = 0
+        self.written = 0
+        self.slow = 0
+        self._lines = []
+        self._random = random.Random()
+
+    def start(self, kind: str, item) -> Trace:
+        return Trace(self, kind, item)
+
+    def submit(self, trace: Trace) -> None:
+        self.finished += 1
+        slow = trace.duration >= self.slow_threshold
+        if not slow and trace.error is None and self._random.random() >= self.sample_rate:
+            return
+        self.slow += slow
+        record = trace.to_dict()
+        record['slow'] = slow
+        self._lines.append(json.dumps(record, default=str))
+        self.written += 1
+
+    def flush(self) -> None:
+        lines, self._lines = self._lines, []
+        if not lines:
+            return
+        os.makedirs(os.path.dirname(self.path) or '.', exist_ok=True)
+        with open(self.path, 'a') as fp:
+            fp.write('\n'.join(lines) + '\n')
+
+    async def run(self, flush_interval: float = 5) -> None:
+        try:
+            while True:
+                await asyncio.sleep(flush_interval)
+                try:
+                    self.flush()
+                except OSError as e:
+                    log_and_print(f'Failed to write traces to {self.path}: {e!r}', level='error')
+        finally:
+            self.flush()
+
+    def stats(self) -> dict:
+        return {'finished': self.finished, 'written': self.written, 'slow': self.slow}
+
+
+class HotPathProfiler():
+    '''
+    Profiles the event loop's thread between start() and stop(), so the bot can be
+    profiled while it runs. Uses cProfile, or pyinstrument when it is installed
+    and asked for. The result is written to out_dir.
+    '''
+    ENGINES = ['cprofile', 'pyinstrument']
+
+    def __init__(self, out_dir: str):
+        self.out_dir = out_dir
+        self.engine = None
+        self.started = None
+        self._profiler = None
+
+    @property
+    def running(self) -> bool:
+        return self._profiler is not None
+
+    def start(self, engine: str = 'cprofile') -> None:
+        '''
+        Raises:
+            RuntimeError: When already running, or the engine isn't available
+        '''
+        if self.running:
+            raise RuntimeError(f'A {self.engine} profile is already running')
+        if engine not in self.ENGINES:
+            raise RuntimeError(f'Unknown profiler `{engine}`, must be one of {self.ENGINES}')
+        if engine == 'pyinstrument':
+            try:
+                from pyinstrument import Profiler
+            except ImportError:
+                raise RuntimeError('pyinstrument is not installed, run `pip install pyinstrument` or use cprofile')
+            profiler = Profiler(async_mode='disabled')
+        else:
+            profiler = cProfile.Profile()
+        profiler.start() if engine == 'pyinstrument' else profiler.enable()
+        self._profiler = profiler
+        self.engine = engine
+        self.started = time.monotonic()
+
+    def stop(self, top: int = 15) -> List[str]:
+        '''
+        Returns:
+            List[str]: Path of the written profile, and a summary of the hottest functions
+        '''
+        if not self.running:
+            raise RuntimeError('No profile is running')
+        profiler, self._profiler = self._profiler, None
+        os.makedirs(self.out_dir, exist_ok=True)
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime())
+        if self.engine == 'pyinstrument':
+            profiler.stop()
+            path = os.path.join(self.out_dir, f'profile_{stamp}.html')
+            with open(path, 'w') as fp:
+                fp.write(profiler.output_html())
+            summary = profiler.output_text(unicode=False, color=False)
+        else:
+            profiler.disable()
+            path = os.path.join(self.out_dir, f'profile_{stamp}.prof')
+            profiler.dump_stats(path)
+            stream = io.StringIO()
+            pstats.Stats(profiler, stream=stream).sort_stats('cumulative').print_stats(top)
+            summary = stream.getvalue()
+        log_and_print(f'Wrote a {time.monotonic() - self.started:.0f}s {self.engine} profile to {path}')
+        return [path, summary]
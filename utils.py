@@ -0,0 +1,133 @@
+import atexit
+import json
+import logging as log
+import logging.handlers
+import os
+import queue
+import sys
+from datetime import datetime as dt
+from typing import Optional
+
+
+LEVELS = {'debug': log.DEBUG, 'info': log.INFO, 'warning': log.WARNING, 
+          'error': log.ERROR, 'critical': log.CRITICAL}
+
+_log_listener = None
+
+
+class _TerminalFilter(log.Filter):
+    '''
+    Lets through the records that log_and_print was asked to echo to the terminal,
+    and warnings and errors from other libraries
+    '''
+    def filter(self, record: log.LogRecord) -> bool:
+        return getattr(record, 'terminal', record.levelno >= log.WARNING)
+
+
+def setup_logging(log_dir: str, level: str = 'debug', retention_days: int = 14,
+                  terminal_echo: bool = True, module_levels: Optional[dict] = None,
+                  filename: str = 'rnd_log.log') -> None:
+    '''
+    Routes all logging through a queue to a background thread that writes
+    log_dir/filename, rotated at midnight and kept for retention_days days, and
+    (if terminal_echo) echoes what log_and_print marks for the terminal to stdout.
+    Nothing is written or printed on the caller's thread.
+
+    Args:
+        log_dir (str): Directory of the log files
+        level (str, optional): Root log level. Defaults to 'debug'.
+        retention_days (int, optional): Rotated files to keep. Defaults to 14.
+        terminal_echo (bool, optional): Echo messages to the terminal. Defaults to True.
+        module_levels (dict, optional): Logger name -> level, e.g. {'discord': 'info'}
+        filename (str, optional): Name of the log file. Defaults to 'rnd_log.log'.
+    '''
+    global _log_listener
+    if _log_listener is not None:
+        _log_listener.stop()
+
+    os.makedirs(log_dir, exist_ok=True)
+    file_handler = log.handlers.TimedRotatingFileHandler(os.path.join(log_dir, filename), 
+                                                             when='midnight', backupCount=retention_days,
+                                                             encoding='utf-8')
+    file_handler.setFormatter(log.Formatter('%(asctime)s [%(levelname)s] %(name)s: %(message)s'))
+    handlers = [file_handler]
+    if terminal_echo:
+        terminal_handler = log.StreamHandler(sys.stdout)
+        terminal_handler.addFilter(_TerminalFilter())
+        handlers.append(terminal_handler)
+
+    log_queue = queue.SimpleQueue()
+    root_logger = log.getLogger()
+    for handler in list(root_logger.handlers):
+        root_logger.removeHandler(handler)
+    root_logger.addHandler(log.handlers.QueueHandler(log_queue))
+    root_logger.setLevel(LEVELS[level.lower()])
+    for name, module_level in (module_levels or {}).items():
+        log.getLogger(name).setLevel(LEVELS[module_level.lower()])
+
+    _log_listener = log.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    _log_listener.start()
+    atexit.register(_log_listener.stop)
+
+
+def log_and_print(message: str, level: str = 'info', terminal_print: bool = True) -> None:
+    '''
+    str, str -> None
+    
+    Custom function for logging and printing a message. Function doesn't output anything.
+    Messages are logged to the calling module's logger, so levels can be set per module.
+    Once setup_logging() has run, printing happens on the logging thread.
+    Possible levels:
+    - debug
+    - info
+    - warning
+    - error
+    - critical
+    '''
+    levelno = LEVELS[level]
+    logger = log.getLogger(sys._getframe(1).f_globals.get('__name__', 'root'))
+    if _log_listener is None:
+        # Logging isn't set up yet (e.g. during the start up prompts)
+        if terminal_print:
+            print(message)
+        logger.log(levelno, message)
+    elif logger.isEnabledFor(levelno):
+        logger.log(levelno, message, extra={'terminal': terminal_print})
+        
+def utc_str_now() -> str:
+    '''
+    Returns the current time in UTC
+
+    Returns:
+        str: The current datetime
+    '''
+    return str(dt.utcnow()) + ' UTC' 
+        
+def read_config_file(config_dir: str) -> dict:
+    '''
+    Reads in the given ...config.json file
+
+    Args:
+        config_dir (str): File path to the ...config.json file
+
+    Returns:
+        dict: Contains the configuration parameters for the bot
+    '''
+    
+    with open(config_dir) as fp:
+        config_dict = json.load(fp)
+    
+    return config_dict
+
+def update_config_file(config_dir: str, config_dict: dict) -> None:
+    '''
+    Updates the ...config.json file using config_dict
+
+    Args:
+        config_dir (str): File path to the ...config.json file
+        config_dict (dict): Dictionary containing the config settings for the bot
+    '''
+
+    config_dict['last_modified_time'] = utc_str_now()
+    with open(config_dir, mode = 'w') as fp:
+        json.dump(config_dict, fp)
@@ -0,0 +1,354 @@
+import asyncio
+import copy
+import hashlib
+import json
+import multiprocessing
+import os
+import time
+from typing import Callable, Dict, Iterable, List, Optional
+
+from utils import log_and_print
+
+
+def partition(subreddits: Iterable[str], worker_ids: Iterable[int]) -> Dict[str, int]:
+    '''
+    Assigns every subreddit to a worker by rendezvous hashing, so adding or losing a
+    worker only moves the subreddits that have to move
+
+    Args:
+        subreddits (Iterable[str]): Subreddit names, lower case
+        worker_ids (Iterable[int]): The workers currently connected
+
+    Returns:
+        Dict[str, int]: subreddit -> worker id
+    '''
+    worker_ids = sorted(worker_ids)
+    if not worker_ids:
+        return {}
+    def weight(sub: str, worker_id: int) -> bytes:
+        return hashlib.md5(f'{sub}:{worker_id}'.encode()).digest()
+    return {sub: max(worker_ids, key=lambda worker_id: weight(sub, worker_id)) for sub in subreddits}
+
+
+def filter_guilds_conf(guilds_conf: dict, subreddits: Iterable[str]) -> dict:
+    '''
+    Returns:
+        dict: A copy of guilds_conf in which each guild only monitors the given subreddits
+    '''
+    subreddits = set(subreddits)
+    filtered = {}
+    for guild_id, guild_info in guilds_conf.items():
+        if not isinstance(guild_info, dict):
+            continue # e.g. last_modified_time
+        guild_info = copy.deepcopy(guild_info)
+        guild_info['subreddits_to_monitor'] = {sub: sub_info for sub, sub_info in
+                                               guild_info.get('subreddits_to_monitor', {}).items()
+                                               if sub.lower() in subreddits}
+        filtered[guild_id] = guild_info
+    return filtered
+
+
+async def _send_message(writer: asyncio.StreamWriter, message: dict) -> None:
+    writer.write(json.dumps(message).encode() + b'\n')
+    await writer.drain()
+
+
+class Coordinator():
+    '''
+    Runs in the process that owns the Discord bot and the guilds config, and hands
+    the Reddit side of the bot to worker processes.
+
+    Monitored subreddits are partitioned across the workers connected to the Unix
+    socket at socket_path. Each worker is sent the guilds config filtered to its
+    own subreddits, streams and matches those locally, and sends back ready-to-send
+    notifications, which are handed to send (NotificationOutbox.send or
+    DiscordDispatcher.send). Partitions are recomputed and pushed whenever the
+    guilds config changes or a worker connects or disconnects.
+
+    Workers report how far their stream checkpoint has got. When a subreddit moves
+    to another worker, the new owner is sent the previous owner's last reported
+    position with its config (or, without a report, the time the previous owner
+    was given the subreddit), and backfills the subreddit from there, so nothing
+    posted during the handover is missed.
+
+    Messages are JSON, one per line:
+        worker -> coordinator: {"type": "hello", "worker": id}
+                               {"type": "notify", "srvs": [[guild, channel]], "msg_body": str, "received": t}
+                               {"type": "progress", "positions": {"comments": t, "submissions": t}}
+        coordinator -> worker: {"type": "conf", "guilds_conf": {...}, "handover": {subreddit: positions}}
+    '''
+    def __init__(self, socket_path: str, send: Callable, get_guilds_conf: Callable[[], dict]):
+        self.socket_path = socket_path
+        self.send = send
+        self.get_guilds_conf = get_guilds_conf
+        self.workers = {}       # worker id -> StreamWriter
+        self.assignment = {}    # subreddit -> worker id
+        self.progress = {}      # worker id -> last reported {kind: created_utc}, kept after it disconnects
+        self.notifications = 0
+        self._assigned_at = {}  # subreddit -> time.time() it was given to its current owner
+        self._sent_confs = {}   # worker id -> last conf pushed to it
+        self._dirty = asyncio.Event()
+        self._processes = {}    # worker id -> multiprocessing.Process
+
+    def on_guild_change(self, guild_id: str, guild_info: Optional[dict]) -> None:
+        '''
+        Listener for GuildsConfStore
+        '''
+        self._dirty.set()
+
+    def _subreddits(self) -> set:
+        subreddits = set()
+        for guild_info in self.get_guilds_conf().values():
+            if isinstance(guild_info, dict):
+                subreddits |= {sub.lower() for sub in guild_info.get('subreddits_to_monitor', {})}
+        return subreddits
+
+    async def rebalance(self) -> None:
+        '''
+        Recomputes the partition and sends every worker whose share changed its new config
+        '''
+        guilds_conf = self.get_guilds_conf()
+        previous, self.assignment = self.assignment, partition(self._subreddits(), self.workers)
+        now = time.time()
+        handovers = {}          # worker id -> {subreddit: positions to backfill it from}
+        for sub, owner in self.assignment.items():
+            previous_owner = previous.get(sub)
+            if previous_owner == owner:
+                continue
+            if previous_owner is not None:
+                assigned_at = self._assigned_at.get(sub, now)
+                positions = self.progress.get(previous_owner) or {'comments': assigned_at, 'submissions': assigned_at}
+                handovers.setdefault(owner, {})[sub] = positions
+            self._assigned_at[sub] = now
+        for sub in set(self._assigned_at) - set(self.assignment):
+            del self._assigned_at[sub]
+        for worker_id, writer in list(self.workers.items()):
+            owned = [sub for sub, owner in self.assignment.items() if owner == worker_id]
+            worker_conf = filter_guilds_conf(guilds_conf, owned)
+            if self._sent_confs.get(worker_id) == worker_conf:
+                continue
+            try:
+                await _send_message(writer, {'type': 'conf', 'guilds_conf': worker_conf,
+                                             'handover': handovers.get(worker_id, {})})
+                self._sent_confs[worker_id] = worker_conf
+                log_and_print(f'Worker {worker_id} now monitors {len(owned)} subreddits', terminal_print=False)
+            except ConnectionError as e:
+                log_and_print(f'Failed to update worker {worker_id}: {e!r}', level='error')
+
+    async def _handle(self, reader: asyncio.StreamReader, writer: asyncio.StreamWriter) -> None:
+        worker_id = None
+        try:
+            hello = json.loads(await reader.readline() or b'{}')
+            if hello.get('type') != 'hello':
+                return
+            worker_id = hello['worker']
+            self.workers[worker_id] = writer
+            self._sent_confs.pop(worker_id, None)
+            log_and_print(f'Worker {worker_id} connected')
+            self._dirty.set()
+
+            while True:
+                line = await reader.readline()
+                if not line:
+                    break
+                message = json.loads(line)
+                if message.get('type') == 'notify':
+                    self.notifications += 1
+                    await self.send([tuple(srv) for srv in message['srvs']], message['msg_body'], message['received'])
+                elif message.get('type') == 'progress':
+                    self.progress[worker_id] = message['positions']
+        except (ConnectionError, json.JSONDecodeError) as e:
+            log_and_print(f'Connection to worker {worker_id} failed: {e!r}', level='error')
+        finally:
+            if worker_id is not None and self.workers.get(worker_id) is writer:
+                del self.workers[worker_id]
+                self._sent_confs.pop(worker_id, None)
+                log_and_print(f'Worker {worker_id} disconnected, rebalancing', level='warning')
+                self._dirty.set()
+            writer.close()
+
+    def spawn_workers(self, count: int, reddit_username: str, config_path: str) -> None:
+        '''
+        Starts (or restarts) worker processes 0..count-1 that connect back to this coordinator
+        '''
+        context = multiprocessing.get_context('spawn')
+        for worker_id in range(count):
+            process = self._processes.get(worker_id)
+            if process is not None and process.is_alive():
+                continue
+            if process is not None:
+                log_and_print(f'Worker {worker_id} exited with {process.exitcode}, restarting', level='error')
+            process = context.Process(target=run_worker, name=f'reddisc-worker-{worker_id}', daemon=True,
+                                      args=(worker_id, self.socket_path, reddit_username, config_path))
+            process.start()
+            self._processes[worker_id] = process
+
+    async def run(self, workers: int = 0, reddit_username: str = '', config_path: str = 'config.json',
+                  check_interval: float = 5) -> None:
+        '''
+        Serves the socket, keeps workers partitioned and, if workers > 0, keeps that
+        many worker processes running
+        '''
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        server = await asyncio.start_unix_server(self._handle, path=self.socket_path)
+        log_and_print(f'Coordinator listening on {self.socket_path}')
+        try:
+            while True:
+                if workers:
+                    self.spawn_workers(workers, reddit_username, config_path)
+                try:
+                    await asyncio.wait_for(self._dirty.wait(), check_interval)
+                except asyncio.TimeoutError:
+                    continue
+                self._dirty.clear()
+                await self.rebalance()
+        finally:
+            server.close()
+            for process in self._processes.values():
+                process.terminate()
+
+    def describe(self) -> List[dict]:
+        '''
+        Returns:
+            List[dict]: Every connected worker and how many subreddits it owns
+        '''
+        return [{'worker': worker_id,
+                 'subreddits': sum(1 for owner in self.assignment.values() if owner == worker_id)}
+                for worker_id in sorted(self.workers)]
+
+
+class CoordinatorLink():
+    '''
+    A worker's connection to the Coordinator. Config updates are passed to
+    on_conf(guilds_conf, handover), and send() forwards notifications, waiting
+    while the connection is being re-established. first_conf is set once the
+    first config has been applied.
+    '''
+    def __init__(self, worker_id: int, socket_path: str, on_conf: Callable[[dict, dict], None],
+                 retry_interval: float = 2):
+        self.worker_id = worker_id
+        self.socket_path = socket_path
+        self.on_conf = on_conf
+        self.retry_interval = retry_interval
+        self._writer = None
+        self._connected = asyncio.Event()
+        self.first_conf = asyncio.Event()
+
+    async def send(self, srvs_to_send: list, msg_body: str, received: float) -> None:
+        while True:
+            await self._connected.wait()
+            try:
+                await _send_message(self._writer, {'type': 'notify', 'srvs': srvs_to_send,
+                                                   'msg_body': msg_body, 'received': received})
+                return
+            except ConnectionError:
+                self._connected.clear()
+
+    async def report_progress(self, positions: Dict[str, float]) -> None:
+        '''
+        Tells the coordinator how far the stream checkpoint has got, skipped while disconnected
+        '''
+        if not self._connected.is_set():
+            return
+        try:
+            await _send_message(self._writer, {'type': 'progress', 'positions': positions})
+        except ConnectionError:
+            self._connected.clear()
+
+    async def run(self) -> None:
+        while True:
+            try:
+                reader, writer = await asyncio.open_unix_connection(self.socket_path)
+            except (ConnectionError, FileNotFoundError):
+                await asyncio.sleep(self.retry_interval)
+                continue
+            try:
+                await _send_message(writer, {'type': 'hello', 'worker': self.worker_id})
+                self._writer = writer
+                self._connected.set()
+                while True:
+                    line = await reader.readline()
+                    if not line:
+                        break
+                    message = json.loads(line)
+                    if message.get('type') == 'conf':
+                        self.on_conf(message['guilds_conf'], message.get('handover', {}))
+                        self.first_conf.set()
+            except ConnectionError as e:
+                log_and_print(f'Lost the coordinator: {e!r}', level='error')
+            finally:
+                self._connected.clear()
+                writer.close()
+            log_and_print('Disconnected from the coordinator, reconnecting', level='warning')
+            await asyncio.sleep(self.retry_interval)
+
+
+def run_worker(worker_id: int, socket_path: str, reddit_username: str, config_path: str = 'config.json') -> None:
+    '''
+    Entry point of a worker process: monitors the subreddits the coordinator gives
+    it and sends the resulting notifications back
+    '''
+    # Imported here as main imports this module
+    import asyncpraw as pr
+    import metrics
+    from budget import REDDIT_BUDGET
+    from main import RedditMonitor
+    from replay import worker_path
+    from rules import REGEX_SANDBOX
+    from routing import RoutingIndex
+    from utils import read_config_file, setup_logging
+
+    bot_config = read_config_file(config_path)
+    logging_settings = bot_config['logging_settings']
+    setup_logging(bot_config['dir_paths']['log_file_dir'], level=logging_settings['level'],
+                  retention_days=logging_settings['retention_days'], terminal_echo=False,
+                  module_levels=logging_settings['module_levels'], filename=f'rnd_log_worker{worker_id}.log')
+
+    async def work():
+        red_bot = pr.Reddit(reddit_username)
+        # Workers share the account's rate limit, each follows it from its own responses
+        REDDIT_BUDGET.configure(**bot_config['budget_settings'])
+        REDDIT_BUDGET.attach(red_bot)
+        rule_settings = bot_config['rule_settings']
+        REGEX_SANDBOX.configure(processes=rule_settings['regex_processes'], timeout=rule_settings['regex_timeout'])
+        routing_index = RoutingIndex()
+        def apply_conf(guilds_conf: dict, handover: dict) -> None:
+            for guild_id in set(routing_index.guilds) - set(guilds_conf):
+                routing_index.remove_guild(guild_id)
+            for guild_id, guild_info in guilds_conf.items():
+                routing_index.update_guild(guild_id, guild_info)
+            monitor.planner.replan()
+            if handover:
+                asyncio.ensure_future(monitor.take_over(handover))
+        link = CoordinatorLink(worker_id, socket_path, apply_conf)
+        replay_settings = bot_config['replay_settings']
+        record_path = worker_path(replay_settings['record_path'], worker_id) if replay_settings['record'] else None
+        trace_settings = bot_config['trace_settings']
+        trace_path = worker_path(trace_settings['path'], worker_id) if trace_settings['enabled'] else None
+        monitor = RedditMonitor(red_bot, routing_index, bot_config, link.send,
+                                f"{bot_config['dir_paths']['stream_checkpoint']}.worker{worker_id}", record_path,
+                                trace_path)
+        log_and_print(f'Worker {worker_id} started (pid {os.getpid()})')
+
+        async def report_progress(interval: float) -> None:
+            while True:
+                await asyncio.sleep(interval)
+                positions = {kind: state['created_utc'] for kind, state in monitor.checkpoint.state.items()}
+                if positions:
+                    await link.report_progress(positions)
+
+        tasks = [asyncio.ensure_future(link.run())]
+        # The streams (and the checkpoint's backfill) only start once the coordinator
+        # has said which subreddits are this worker's
+        await link.first_conf.wait()
+        tasks += [asyncio.ensure_future(coroutine) for coroutine in monitor.coroutines()]
+        tasks.append(asyncio.ensure_future(report_progress(bot_config['worker_settings']['progress_interval'])))
+        metrics_settings = bot_config['metrics_settings']
+        if metrics_settings['enabled']:
+            tasks.append(asyncio.ensure_future(metrics.serve_metrics(
+                metrics_settings['host'], metrics_settings['port'] + 1 + worker_id)))
+        monitor.pipeline.start()
+        await asyncio.wait(tasks, return_when=asyncio.FIRST_EXCEPTION)
+
+    asyncio.run(work())